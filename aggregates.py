@@ -0,0 +1,85 @@
+import numpy as np
+
+class DisjointSet:
+    """
+    Union-find over the integers 0 to size - 1, with union by size and path halving
+    """
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            (a, b) = (b, a)
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+
+class Aggregate:
+    """
+    A group of robots connected through each other's neighbours
+
+    members -- robot IDs, in ascending order
+    centre  -- (x, y) centroid of the members' positions, in metres
+    radius  -- distance from the centre to the furthest member, in metres
+    """
+    def __init__(self, members, centre, radius):
+        self.members = members
+        self.centre = centre
+        self.radius = radius
+
+    def __len__(self):
+        return len(self.members)
+
+
+"""
+Splits robots into aggregates: the connected components of the graph whose edges are the robots' neighbours
+
+Robots that cannot sense any other robot are not part of an aggregate.
+
+robots -- dictionary of robots by ID, each with a position and a dictionary of neighbours by ID
+
+Returns a list of Aggregates, biggest first
+"""
+def findAggregates(robots):
+    ids = list(robots.keys())
+    if not ids:
+        return []
+
+    index = {id: i for i, id in enumerate(ids)}
+    components = DisjointSet(len(ids))
+    for i, robot in enumerate(robots.values()):
+        for neighbour_id in robot.neighbours:
+            if neighbour_id in index:
+                components.union(i, index[neighbour_id])
+
+    # Label every robot with its component, then work out sizes, centroids and radii with a few array operations
+    roots = [components.find(i) for i in range(len(ids))]
+    (labels, component, sizes) = np.unique(roots, return_inverse=True, return_counts=True)
+    positions = np.array([(robot.position.x, robot.position.y) for robot in robots.values()])
+
+    centres = np.stack([np.bincount(component, weights=positions[:, 0]),
+                        np.bincount(component, weights=positions[:, 1])], axis=1) / sizes[:, np.newaxis]
+    offsets = positions - centres[component]
+    radii = np.zeros(len(sizes))
+    np.maximum.at(radii, component, np.hypot(offsets[:, 0], offsets[:, 1]))
+
+    members = [[] for size in sizes]
+    for i, label in enumerate(component.tolist()):
+        members[label].append(ids[i])
+
+    aggregates = [Aggregate(sorted(members[label]), tuple(centres[label].tolist()), float(radii[label]))
+                  for label in range(len(sizes)) if sizes[label] > 1]
+    aggregates.sort(key=len, reverse=True)
+    return aggregates
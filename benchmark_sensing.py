@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Benchmark of the virtual sensors worked out by processRobots, from 10 to 200 robots.
+#
+# Times the per-pair Python loop the tracker used to run (reproduced below) against senseRobots(), which works
+# out every range and bearing with one set of NumPy array operations. Robots are placed at random in a 2m x 1m
+# arena, so no camera or tags are needed:
+#
+#   python3 benchmark_sensing.py
+#   python3 benchmark_sensing.py --robots 10 50 100 200 --repeats 50 --output sensing.json
+
+import argparse
+import json
+import random
+import sys
+import time
+import numpy as np
+from server import Robot, SensorReading, Team, rangeAndBearing, senseRobots
+from tags import TagBatch
+from vector2d import Vector2D
+
+ARENA_WIDTH = 2.0 # Metres
+ARENA_HEIGHT = 1.0 # Metres
+TAG_SIZE = 40 # Pixels
+
+"""
+The previous processRobots loop: one range, bearing and normalisation per pair of robots
+"""
+def loopSense(robots, ball, red_goal, blue_goal):
+    for id, robot in robots.items():
+        (x, y, orientation) = (robot.position.x, robot.position.y, robot.orientation)
+
+        for other_id, other_robot in robots.items():
+            if id != other_id:
+                robot.neighbours[other_id] = SensorReading(*rangeAndBearing(x, y, orientation, other_robot.position),
+                                                           other_robot.orientation)
+
+        robot.ball = SensorReading(*rangeAndBearing(x, y, orientation, ball))
+        goal1 = SensorReading(*rangeAndBearing(x, y, orientation, red_goal))
+        goal2 = SensorReading(*rangeAndBearing(x, y, orientation, blue_goal))
+
+        if robot.team == Team.BLUE:
+            robot.strike_goal = goal1
+            robot.defend_goal = goal2
+        else:
+            robot.strike_goal = goal2
+            robot.defend_goal = goal1
+
+"""
+num_robots robots with random poses, built from synthetic tags as the tracker builds them
+"""
+def makeRobots(num_robots, seed=1):
+    generator = random.Random(seed)
+    ids = list(range(2, 2 + num_robots))
+
+    # Square tags rotated to a random heading
+    corners = []
+    for id in ids:
+        heading = generator.uniform(-np.pi, np.pi)
+        offsets = [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+        rotation = np.array([[np.cos(heading), -np.sin(heading)], [np.sin(heading), np.cos(heading)]])
+        corners.append([(rotation @ (np.array(offset) * TAG_SIZE / 2)) + 1000 for offset in offsets])
+    tags = TagBatch(ids, np.array(corners, dtype=np.float32).reshape(-1, 1, 4, 2))
+
+    robots = {}
+    for index, id in enumerate(ids):
+        position = Vector2D(generator.uniform(0, ARENA_WIDTH), generator.uniform(0, ARENA_HEIGHT))
+        robots[id] = Robot(tags.tag(index), position, tags.tag(index).angle, time.time())
+        robots[id].team = Team.BLUE if index % 2 else Team.RED
+    return robots
+
+def timeSense(sense, num_robots, repeats):
+    robots = makeRobots(num_robots)
+    ball = Vector2D(ARENA_WIDTH / 2, ARENA_HEIGHT / 2)
+    red_goal = Vector2D(0, ARENA_HEIGHT / 2)
+    blue_goal = Vector2D(ARENA_WIDTH, ARENA_HEIGHT / 2)
+
+    durations = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        sense(robots, ball, red_goal, blue_goal)
+        durations.append(time.perf_counter() - start)
+
+    durations = np.array(durations) * 1000 # In milliseconds
+    return {"p50_ms": round(float(np.percentile(durations, 50)), 3),
+            "p99_ms": round(float(np.percentile(durations, 99)), 3)}, robots
+
+"""
+Checks that both implementations give the same readings, to within rounding
+"""
+def check(loop_robots, engine_robots):
+    for id, robot in loop_robots.items():
+        other = engine_robots[id]
+        readings = [(robot.ball, other.ball), (robot.strike_goal, other.strike_goal), (robot.defend_goal, other.defend_goal)]
+        readings += [(robot.neighbours[neighbour_id], other.neighbours[neighbour_id]) for neighbour_id in robot.neighbours]
+        for (expected, actual) in readings:
+            bearing_error = abs((expected.bearing - actual.bearing + 180) % 360 - 180)
+            if abs(expected.range - actual.range) > 1e-9 or bearing_error > 1e-6:
+                return False
+    return True
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument("-r", "--robots", type=int, nargs="+",
+        default=[10, 20, 50, 100, 150, 200],
+        help="robot counts to benchmark")
+
+    ap.add_argument("-n", "--repeats", type=int,
+        default=20,
+        help="timed runs per robot count")
+
+    ap.add_argument("-o", "--output", type=str,
+        default=None,
+        help="write JSON results to this file instead of stdout")
+
+    args = ap.parse_args()
+
+    runs = []
+    for num_robots in args.robots:
+        (loop, loop_robots) = timeSense(loopSense, num_robots, args.repeats)
+        (engine, engine_robots) = timeSense(senseRobots, num_robots, args.repeats)
+        speedup = round(loop["p50_ms"] / engine["p50_ms"], 1) if engine["p50_ms"] > 0 else None
+        runs.append({"robots": num_robots, "loop": loop, "engine": engine, "speedup": speedup,
+                     "matches": check(loop_robots, engine_robots)})
+
+        print(f"{num_robots:>4} robots: loop p50 {loop['p50_ms']:>9.3f} ms, engine p50 {engine['p50_ms']:>9.3f} ms "
+              f"({speedup}x){'' if runs[-1]['matches'] else '  READINGS DIFFER'}", file=sys.stderr)
+
+    output = json.dumps({"repeats": args.repeats, "runs": runs}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmark of the tracking pipeline over synthetic arena frames.
+#
+# Renders DICT_4X4_100 tags at known poses (as generate_tag.py does), then feeds each frame through detection,
+# Tag construction, processArUco, processRobots, the game logic, the drawing routines and the get_robots
+# serialization, timing every stage. Results are written as JSON so that two runs can be compared:
+#
+#   python3 benchmark_tracker.py --output before.json
+#   python3 benchmark_tracker.py --output after.json
+#   python3 benchmark_tracker.py --compare before.json after.json
+#
+# The frames can also be saved with --save DIR and replayed with: python3 server.py --source DIR --fast
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from detection import make_detector
+from pipeline import Frame
+from tags import TagBatch
+from server import GameState, Tracker, World, DETECTION_MODE, FULL_SCAN_INTERVAL, DETECTION_TILES, TILE_OVERLAP, DETECTION_SCALE
+
+WIDTH = 1920
+HEIGHT = 1080
+TAG_SIZE = 40 # Marker size in pixels, roughly a robot tag seen by the arena camera
+CELL_SIZE = 105 # Robots are placed one per grid cell so that tags never overlap
+MAX_ROBOTS = 98 # DICT_4X4_100 has 100 IDs; 0 is reserved for the corners and 1 for the ball
+CORNER_POSITIONS = [(90, 90), (WIDTH - 90, 90), (90, HEIGHT - 90), (WIDTH - 90, HEIGHT - 90)]
+BALL_ID = 1
+
+"""
+A marker with a white border, as printed on the robots
+"""
+def render_tag(dictionary, id, size):
+    marker = np.zeros((size, size), dtype="uint8")
+    cv2.aruco.drawMarker(dictionary, id, size, marker, 1)
+    border = size // 4
+    marker = cv2.copyMakeBorder(marker, border, border, border, border, cv2.BORDER_CONSTANT, value=255)
+    return cv2.cvtColor(marker, cv2.COLOR_GRAY2BGR)
+
+"""
+Pastes a tag image onto the frame, centred on (x, y) and rotated anticlockwise by angle degrees
+"""
+def place_tag(frame, tag_image, x, y, angle):
+    size = int(math.ceil(tag_image.shape[0] * math.sqrt(2))) + 2
+    rotation = cv2.getRotationMatrix2D((tag_image.shape[1] / 2, tag_image.shape[0] / 2), angle, 1)
+    rotation[0, 2] += size / 2 - tag_image.shape[1] / 2
+    rotation[1, 2] += size / 2 - tag_image.shape[0] / 2
+    rotated = cv2.warpAffine(tag_image, rotation, (size, size), flags=cv2.INTER_LINEAR, borderValue=(255, 255, 255))
+
+    x1 = int(x - size / 2)
+    y1 = int(y - size / 2)
+    frame[y1:y1 + size, x1:x1 + size] = rotated
+
+"""
+Robot, ball and corner poses for one frame
+
+Each pose is (id, x, y, angle). Robots start in random grid cells and drift and turn a little every frame.
+"""
+class Arena:
+    def __init__(self, num_robots, seed=1):
+        self.random = random.Random(seed)
+
+        cells = [(x, y) for x in range(200, WIDTH - 200, CELL_SIZE) for y in range(180, HEIGHT - 120, CELL_SIZE)]
+        self.random.shuffle(cells)
+
+        # The ball gets its own cell, like a robot
+        self.robots = []
+        for id, (x, y) in zip([BALL_ID] + list(range(2, 2 + num_robots)), cells):
+            self.robots.append([id, x, y, self.random.uniform(-180, 180), x, y])
+
+    def step(self):
+        for robot in self.robots:
+            (id, x, y, angle, cell_x, cell_y) = robot
+            # Stay within a few pixels of the cell centre so tags never overlap
+            robot[1] = min(max(x + self.random.uniform(-3, 3), cell_x - 8), cell_x + 8)
+            robot[2] = min(max(y + self.random.uniform(-3, 3), cell_y - 8), cell_y + 8)
+            robot[3] = angle + self.random.uniform(-5, 5)
+
+    def poses(self):
+        corners = [(0, x, y, 0) for (x, y) in CORNER_POSITIONS]
+        return corners + [tuple(robot[:4]) for robot in self.robots]
+
+"""
+Renders a sequence of arena frames with num_robots robots
+"""
+def make_frames(num_robots, num_frames):
+    dictionary = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_100)
+    tag_images = {id: render_tag(dictionary, id, TAG_SIZE) for id in range(2 + num_robots)}
+    arena = Arena(num_robots)
+
+    frames = []
+    for i in range(num_frames):
+        frame = np.full((HEIGHT, WIDTH, 3), 200, dtype="uint8")
+        for (id, x, y, angle) in arena.poses():
+            place_tag(frame, tag_images[id], x, y, angle)
+        frames.append(frame)
+        arena.step()
+    return frames
+
+def summarise(durations):
+    durations = np.array(durations) * 1000 # In milliseconds
+    mean = float(durations.mean())
+    return {"mean_ms": round(mean, 3),
+            "p50_ms": round(float(np.percentile(durations, 50)), 3),
+            "p99_ms": round(float(np.percentile(durations, 99)), 3),
+            "fps": round(1000 / mean, 1) if mean > 0 else None}
+
+"""
+Runs every frame through the tracker stages and returns per-stage and total timings
+"""
+def benchmark(num_robots, num_frames, detection_mode, save_directory=None):
+    frames = make_frames(num_robots, num_frames + 1)
+
+    # The tracker is given the frames as a recorded source, so no camera is needed
+    directory = save_directory or tempfile.mkdtemp(prefix="swarmhack_benchmark_")
+    os.makedirs(directory, exist_ok=True)
+    for i, frame in enumerate(frames if save_directory else frames[:1]):
+        cv2.imwrite(os.path.join(directory, f"robots_{num_robots:03d}_frame_{i:04d}.png"), frame)
+
+    tracker = Tracker(headless=True, source=directory, realtime=False)
+
+    if not save_directory:
+        shutil.rmtree(directory)
+
+    if detection_mode is not None:
+        tracker.detector.close()
+        tracker.detector = make_detector(detection_mode, full_scan_interval=FULL_SCAN_INTERVAL,
+                                         tiles=DETECTION_TILES, overlap=TILE_OVERLAP, scale=DETECTION_SCALE)
+
+    # Calibrate on the first frame, then set up teams and zones
+    (raw_tags, tag_ids) = tracker.detector.detect(frames[0])
+    tracker.processArUco(tag_ids, raw_tags, time.time())
+    tracker.processRobots()
+    tracker.command("assign_teams")
+    tracker.command("build_zones")
+    tracker.applyCommands()
+
+    stages = ["detect", "tag", "processArUco", "processRobots", "processGame", "draw", "serialize"]
+    durations = {stage: [] for stage in stages}
+    totals = []
+    detected = []
+
+    for i, image in enumerate(frames[1:]):
+        times = {}
+        frame = Frame(image, time.time(), i + 1)
+
+        start = time.perf_counter()
+        (frame.raw_tags, frame.tag_ids) = tracker.detector.detect(image)
+        times["detect"] = time.perf_counter() - start
+
+        detected.append(len(frame.tag_ids) if frame.tag_ids is not None else 0)
+
+        start = time.perf_counter()
+        tags = TagBatch(frame.tag_ids, frame.raw_tags)
+        times["tag"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tracker.processArUco(frame.tag_ids, frame.raw_tags, frame.timestamp, frame.sequence)
+        times["processArUco"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tracker.processRobots()
+        times["processRobots"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tracker.timer.update()
+        tracker.processGame()
+        world = World(frame, tracker.robots, True, tracker.timer.time_left, tracker.ball.position, GameState(tracker))
+        times["processGame"] = time.perf_counter() - start
+
+        image = image.copy() # Drawing is done on the frame, so keep the original for the next run
+        start = time.perf_counter()
+        overlay = image.copy()
+        tracker.drawBoundingBox(image)
+        tracker.drawZones(image, world.game)
+        tracker.drawGoals(image)
+        tracker.drawBall(image, world.game.ball_tag)
+        tracker.drawRobots(image, world.robots, world.game.rule_breakers)
+        tracker.drawGame(image, world.game)
+        image = cv2.addWeighted(overlay, 0.3, image, 0.7, 0)
+        times["draw"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tracker.publish(world)
+        json.dumps(tracker.snapshot.robots_reply)
+        times["serialize"] = time.perf_counter() - start
+
+        for stage in stages:
+            durations[stage].append(times[stage])
+        totals.append(sum(times[stage] for stage in stages if stage != "tag")) # processArUco already builds the TagBatch
+
+    tracker.detector.close()
+
+    return {"robots": num_robots,
+            "expected_tags": len(CORNER_POSITIONS) + 1 + num_robots,
+            "detected_tags": round(float(np.mean(detected)), 2),
+            "stages": {stage: summarise(durations[stage]) for stage in stages},
+            "total": summarise(totals)}
+
+def print_results(results):
+    for result in results["runs"]:
+        print(f"{result['robots']} robots ({result['detected_tags']}/{result['expected_tags']} tags detected): "
+              f"{result['total']['fps']} fps, p50 {result['total']['p50_ms']} ms, p99 {result['total']['p99_ms']} ms",
+              file=sys.stderr)
+        for stage, stats in result["stages"].items():
+            print(f"    {stage:<14} p50 {stats['p50_ms']:>9.3f} ms  p99 {stats['p99_ms']:>9.3f} ms  {stats['fps']} fps",
+                  file=sys.stderr)
+
+"""
+Prints the change in p50 latency of every stage between two result files
+"""
+def compare(before_path, after_path):
+    with open(before_path) as file:
+        before = {run["robots"]: run for run in json.load(file)["runs"]}
+    with open(after_path) as file:
+        after = {run["robots"]: run for run in json.load(file)["runs"]}
+
+    for robots in sorted(set(before) & set(after)):
+        print(f"{robots} robots")
+        old_stages = dict(before[robots]["stages"], total=before[robots]["total"])
+        new_stages = dict(after[robots]["stages"], total=after[robots]["total"])
+        for stage in old_stages:
+            if stage not in new_stages:
+                continue
+            old = old_stages[stage]["p50_ms"]
+            new = new_stages[stage]["p50_ms"]
+            change = (new - old) / old * 100 if old > 0 else 0
+            print(f"    {stage:<14} p50 {old:>9.3f} ms -> {new:>9.3f} ms  ({change:+.1f}%)")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument("-r", "--robots", type=int, nargs="+",
+        default=[5, 10, 20, 50, 100],
+        help="robot counts to benchmark (at most 98 robots fit in DICT_4X4_100)")
+
+    ap.add_argument("-f", "--frames", type=int,
+        default=30,
+        help="frames per robot count")
+
+    ap.add_argument("-d", "--detector", type=str,
+        default=None,
+        help="detection mode to use instead of the server's DETECTION_MODE (full, incremental, tiled or pyramid)")
+
+    ap.add_argument("-o", "--output", type=str,
+        default=None,
+        help="write JSON results to this file instead of stdout")
+
+    ap.add_argument("--save", type=str,
+        default=None,
+        help="keep the synthetic frames in this directory")
+
+    ap.add_argument("--compare", type=str, nargs=2, metavar=("BEFORE", "AFTER"),
+        help="compare two result files instead of running the benchmark")
+
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    runs = []
+    for num_robots in args.robots:
+        if num_robots > MAX_ROBOTS:
+            print(f"[INFO] Only {MAX_ROBOTS} robot tags are available, benchmarking {MAX_ROBOTS} instead of {num_robots}",
+                  file=sys.stderr)
+            num_robots = MAX_ROBOTS
+        runs.append(benchmark(num_robots, args.frames, args.detector, args.save))
+
+    results = {"frame_size": [WIDTH, HEIGHT],
+               "frames": args.frames,
+               "detector": args.detector or DETECTION_MODE,
+               "runs": runs}
+
+    print_results(results)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
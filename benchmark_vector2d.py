@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of Vector2D with and without __slots__, against NumPy arrays.
+#
+# For each swarm size, times a typical per-frame calculation done one Vector2D at a time (with and without
+# __slots__) and once on an (N, 2) NumPy array, the way sensing.py works: offsets from every robot to a target,
+# their distances and polar angles, a scaled sum, and dot products. Also reports the memory used per vector:
+#
+#   python3 benchmark_vector2d.py
+#   python3 benchmark_vector2d.py --sizes 10 100 1000 --repeats 200 --output vector2d.json
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+import numpy as np
+from vector2d import Vector2D
+
+class DictVector2D:
+    """Vector2D as it was before __slots__, with x and y in a per-instance __dict__ (the methods used below)."""
+
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y
+
+    def __sub__(self, other):
+        return DictVector2D(self.x - other.x, self.y - other.y)
+
+    def __add__(self, other):
+        return DictVector2D(self.x + other.x, self.y + other.y)
+
+    def __mul__(self, scalar):
+        if isinstance(scalar, int) or isinstance(scalar, float):
+            return DictVector2D(self.x*scalar, self.y*scalar)
+        raise NotImplementedError('Can only multiply Vector2D by a scalar')
+
+    def __abs__(self):
+        return math.sqrt(self.x**2 + self.y**2)
+
+    def to_polar(self):
+        return self.__abs__(), math.atan2(self.y, self.x)
+
+def objectSwarm(vector_type, points, target):
+    vectors = [vector_type(x, y) for (x, y) in points]
+    target = vector_type(target.x, target.y)
+    total = vector_type(0, 0)
+    polar = []
+    dots = []
+    for vector in vectors:
+        offset = target - vector
+        polar.append(offset.to_polar())
+        total = total + offset * 0.5
+        dots.append(offset.dot(target))
+    return total, polar, dots
+
+def arraySwarm(points, target):
+    vectors = np.array(points, dtype=np.float64)
+    target = np.array((target.x, target.y))
+    offsets = target - vectors
+    ranges = np.hypot(offsets[:, 0], offsets[:, 1])
+    bearings = np.arctan2(offsets[:, 1], offsets[:, 0])
+    total = (offsets * 0.5).sum(axis=0)
+    dots = offsets @ target
+    return total, (ranges, bearings), dots
+
+def timeRuns(function, repeats):
+    durations = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return round(float(np.percentile(np.array(durations) * 1e6, 50)), 1) # Median, in microseconds
+
+def bytesPerVector(make, count=10000):
+    tracemalloc.start()
+    vectors = make(count)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(current / count, 1)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument("-s", "--sizes", type=int, nargs="+",
+        default=[10, 50, 100, 200, 1000],
+        help="numbers of vectors to benchmark")
+
+    ap.add_argument("-n", "--repeats", type=int,
+        default=100,
+        help="timed runs per size")
+
+    ap.add_argument("-o", "--output", type=str,
+        default=None,
+        help="write JSON results to this file instead of stdout")
+
+    args = ap.parse_args()
+
+    generator = random.Random(1)
+    target = Vector2D(1.0, 0.5)
+
+    memory = {"dict": bytesPerVector(lambda n: [DictVector2D(0.5, 0.5) for i in range(n)]),
+              "slots": bytesPerVector(lambda n: [Vector2D(0.5, 0.5) for i in range(n)]),
+              "array": bytesPerVector(lambda n: np.zeros((n, 2)))}
+
+    print("Memory per vector:", file=sys.stderr)
+    print(f"    dict Vector2D   {memory['dict']:8.1f} bytes", file=sys.stderr)
+    print(f"    slot Vector2D   {memory['slots']:8.1f} bytes", file=sys.stderr)
+    print(f"    NumPy array     {memory['array']:8.1f} bytes", file=sys.stderr)
+
+    print("Median time per swarm calculation:", file=sys.stderr)
+    runs = []
+    for size in args.sizes:
+        points = [(generator.uniform(0, 2), generator.uniform(0, 1)) for i in range(size)]
+        run = {"vectors": size,
+               "dict_us": timeRuns(lambda: objectSwarm(DictVector2D, points, target), args.repeats),
+               "slots_us": timeRuns(lambda: objectSwarm(Vector2D, points, target), args.repeats),
+               "array_us": timeRuns(lambda: arraySwarm(points, target), args.repeats)}
+        runs.append(run)
+
+        print(f"    {size:>5} vectors: dict {run['dict_us']:>9.1f} us, slots {run['slots_us']:>9.1f} us, "
+              f"array {run['array_us']:>9.1f} us ({run['slots_us'] / run['array_us']:.1f}x faster than slots)",
+              file=sys.stderr)
+
+    output = json.dumps({"repeats": args.repeats, "bytes_per_vector": memory, "runs": runs}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
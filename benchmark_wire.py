@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Benchmark of the JSON and binary encodings of get_robots replies, from 10 to 200 robots.
+#
+# Builds replies shaped like the tracker's, with every robot sensing every other one, and reports the bytes
+# each encoding puts on the wire and the median time to encode and decode them. Binary replies are decoded both
+# straight into NumPy arrays and into the same dictionaries JSON gives:
+#
+#   python3 benchmark_wire.py
+#   python3 benchmark_wire.py --robots 10 50 100 200 --repeats 50 --output wire.json
+
+import argparse
+import json
+import random
+import sys
+import time
+import numpy as np
+import wire
+from ballgame_roles import Role, Team
+from replies import encode_json
+
+"""
+A full get_robots reply for num_robots robots, as buildRobotsReply would give
+"""
+def makeReply(num_robots, seed=1):
+    generator = random.Random(seed)
+    ids = list(range(2, 2 + num_robots))
+    roles = {id: generator.choice(list(Role)).name for id in ids}
+    teams = {id: generator.choice([Team.RED, Team.BLUE]).name for id in ids}
+
+    def reading():
+        return {"range": round(generator.uniform(0, 2), 2), "bearing": round(generator.uniform(-180, 180), 2)}
+
+    reply = {}
+    for id in ids:
+        reply[id] = {"orientation": round(generator.uniform(-180, 180), 2),
+                     "velocity": {"x": round(generator.gauss(0, 0.1), 3), "y": round(generator.gauss(0, 0.1), 3),
+                                  "angular": round(generator.gauss(0, 10), 2)},
+                     "pose_age": round(generator.uniform(0, 0.1), 3),
+                     "role": roles[id],
+                     "team": teams[id],
+                     "remaining_time": 120,
+                     "progress_through_zone": round(generator.uniform(0, 1), 2),
+                     "ball": reading(),
+                     "their_goal": reading(),
+                     "our_goal": reading(),
+                     "players": {other_id: dict(reading(), team=teams[other_id], role=roles[other_id],
+                                                orientation=round(generator.uniform(-180, 180), 2))
+                                 for other_id in ids if other_id != id}}
+    return reply
+
+def timeRuns(function, repeats):
+    durations = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return round(float(np.percentile(np.array(durations) * 1000, 50)), 3) # Median, in milliseconds
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument("-r", "--robots", type=int, nargs="+",
+        default=[10, 20, 50, 100, 150, 200],
+        help="robot counts to benchmark")
+
+    ap.add_argument("-n", "--repeats", type=int,
+        default=20,
+        help="timed runs per robot count")
+
+    ap.add_argument("-o", "--output", type=str,
+        default=None,
+        help="write JSON results to this file instead of stdout")
+
+    args = ap.parse_args()
+
+    runs = []
+    for num_robots in args.robots:
+        reply = makeReply(num_robots)
+        header = {"frame": 1, "captured": time.time(), "published": time.time()}
+        json_message = encode_json(reply, header)
+        binary_message = wire.encode(reply, header)
+
+        run = {"robots": num_robots,
+               "json": {"bytes": len(json_message.encode()),
+                        "encode_ms": timeRuns(lambda: encode_json(reply, header), args.repeats),
+                        "decode_ms": timeRuns(lambda: json.loads(json_message), args.repeats)},
+               "binary": {"bytes": len(binary_message),
+                          "encode_ms": timeRuns(lambda: wire.encode(reply, header), args.repeats),
+                          "decode_ms": timeRuns(lambda: wire.decode(binary_message), args.repeats),
+                          "decode_reply_ms": timeRuns(lambda: wire.decode_reply(binary_message), args.repeats)}}
+        runs.append(run)
+
+        print(f"{num_robots:>4} robots: JSON {run['json']['bytes']:>9} bytes, binary {run['binary']['bytes']:>9} bytes "
+              f"({run['json']['bytes'] / run['binary']['bytes']:.1f}x smaller); "
+              f"decode JSON {run['json']['decode_ms']:>8.3f} ms, NumPy {run['binary']['decode_ms']:>8.3f} ms",
+              file=sys.stderr)
+
+    output = json.dumps({"repeats": args.repeats, "runs": runs}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
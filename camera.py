@@ -1,9 +1,14 @@
 import cv2
+import os
 import sys
+import threading
+import time
+
+READ_RETRY_DELAY = 0.01 # Seconds to wait before reading the camera again after a failed read
 
 class Camera:
-	
-    def __init__(self):
+
+    def __init__(self, threaded=False):
 
         self.cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
 
@@ -21,6 +26,219 @@ class Camera:
         self.cap.set(cv2.CAP_PROP_AUTOFOCUS, 0)
         self.cap.set(cv2.CAP_PROP_FOCUS, focus)
 
-    def get_frame(self):
+        self.threaded = threaded
+        self.sequence = 0 # Number of frames read from the camera so far
+        self.last_sequence = 0 # Sequence number of the last frame handed out by get_frame()
+        self.frames_dropped = 0 # Total number of frames that were overwritten before anyone asked for them
+
+        if self.threaded:
+            # Latest-frame slot: the reader thread replaces front with each new frame under the condition's lock
+            self.front = None
+            self.front_timestamp = 0
+            self.new_frame = threading.Condition()
+            self.running = True
+            self.reader = threading.Thread(target=self.read_frames, daemon=True)
+            self.reader.start()
+
+    """
+    Reads one frame from the camera, returning (ok, frame, timestamp)
+
+    The frame is stamped as soon as the driver hands it over, before it is decoded, so decoding does not add to
+    its age. The stamp still lags the exposure by however long the frame waited in the driver's queue, up to about
+    one frame period while capture keeps up. CAP_PROP_POS_MSEC is not used instead: V4L2 gives it on the monotonic
+    clock rather than time.time(), and not every OpenCV build fills it in.
+    """
+    def read(self):
+        if not self.cap.grab():
+            return False, None, time.time()
+        timestamp = time.time()
+        ret, frame = self.cap.retrieve()
+        return ret, frame, timestamp
+
+    """
+    Reader thread for threaded capture mode. Keeps only the newest frame, so the V4L2 queue never backs up
+    behind a slow consumer.
+    """
+    def read_frames(self):
+        while self.running:
+            ret, frame, timestamp = self.read()
+
+            if not ret:
+                time.sleep(READ_RETRY_DELAY) # Don't spin while the camera is returning errors
+                continue
+
+            with self.new_frame:
+                self.front = frame
+                self.front_timestamp = timestamp
+                self.sequence += 1
+                self.new_frame.notify_all()
+
+    """
+    Returns (frame, timestamp, sequence, dropped)
+
+    frame     -- the newest camera image
+    timestamp -- time.time() at which the driver handed the frame over (see read())
+    sequence  -- frame sequence number, starting at 1
+    dropped   -- number of frames captured but never returned since the previous call
+
+    In threaded mode this never waits for the camera once the first frame has arrived, unless block is set,
+    in which case it waits until a frame newer than the last one returned is available.
+    """
+    def get_frame(self, block=False):
+        if not self.threaded:
+            ret, frame, timestamp = self.read()
+            while not ret: # A live camera has no end, so a failed read is retried rather than returned
+                time.sleep(READ_RETRY_DELAY)
+                ret, frame, timestamp = self.read()
+            self.sequence += 1
+            self.last_sequence = self.sequence
+            return frame, timestamp, self.sequence, 0
+
+        with self.new_frame:
+            while self.front is None or (block and self.sequence == self.last_sequence):
+                self.new_frame.wait()
+
+            frame = self.front
+            timestamp = self.front_timestamp
+            sequence = self.sequence
+
+        dropped = max(sequence - self.last_sequence - 1, 0)
+        self.frames_dropped += dropped
+        self.last_sequence = sequence
+
+        return frame, timestamp, sequence, dropped
+
+    def release(self):
+        if self.threaded:
+            self.running = False
+            self.reader.join()
+        self.cap.release()
+
+
+class FileSource:
+    """
+    Base class for recorded frame sources, with the same get_frame() interface as Camera
+
+    fps      -- frame rate of the recording
+    realtime -- pace frames at fps like a live camera, skipping frames when the consumer falls behind;
+                otherwise return every frame as fast as possible
+
+    Frames are stamped with the time they were captured at in the recording, counted from the first frame returned,
+    whether or not they are paced. Filter velocities, pose ages and eviction then come out the same at any replay
+    speed, so a recording can be used as a regression test.
+
+    Subclasses implement read_frame() and skip_frame() for the frame at self.position.
+    """
+    def __init__(self, fps, realtime):
+        self.fps = fps
+        self.realtime = realtime
+        self.position = 0 # Index of the next frame in the recording
+        self.start_time = None # time.time() when the first frame was returned; frame 0's timestamp
+        self.frames_dropped = 0
+
+    """
+    Returns (frame, timestamp, sequence, dropped) like Camera.get_frame(). frame is None at the end of the recording.
+    """
+    def get_frame(self, block=False):
+        dropped = 0
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        if self.realtime:
+            now = time.time()
+            due = self.start_time + self.position / self.fps # Time at which the next frame would be captured
+            if due > now:
+                time.sleep(due - now)
+            else:
+                # Behind the recording: skip the frames a live camera would have replaced
+                behind = int((now - self.start_time) * self.fps) - self.position
+                for i in range(behind):
+                    if not self.skip_frame():
+                        break
+                    self.position += 1
+                    dropped += 1
+
+        frame = self.read_frame()
+        timestamp = self.start_time + self.position / self.fps # When the frame was captured, in recording time
+
+        if frame is None:
+            return None, timestamp, self.position, dropped
+
+        self.position += 1
+        self.frames_dropped += dropped
+        return frame, timestamp, self.position, dropped
+
+    def release(self):
+        pass
+
+
+class VideoFileSource(FileSource):
+    """
+    Frames from a recorded video file
+
+    path -- video file readable by cv2.VideoCapture
+    fps  -- playback rate (default: the rate stored in the file, or 30)
+    """
+    def __init__(self, path, realtime=True, fps=None):
+        self.cap = cv2.VideoCapture(path)
+
+        if not self.cap.isOpened():
+            print(f"Cannot open video file {path}")
+            sys.exit(0)
+
+        if fps is None:
+            fps = self.cap.get(cv2.CAP_PROP_FPS) or 30
+
+        FileSource.__init__(self, fps, realtime)
+
+    def read_frame(self):
         ret, frame = self.cap.read()
-        return frame
\ No newline at end of file
+        return frame if ret else None
+
+    def skip_frame(self):
+        return self.cap.grab()
+
+    def release(self):
+        self.cap.release()
+
+
+class ImageSequenceSource(FileSource):
+    """
+    Frames from a directory of images, in filename order
+
+    directory -- directory containing .png, .jpg, .jpeg or .bmp files
+    fps       -- playback rate
+    """
+    def __init__(self, directory, realtime=True, fps=30):
+        extensions = (".png", ".jpg", ".jpeg", ".bmp")
+        self.files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                            if name.lower().endswith(extensions))
+
+        if not self.files:
+            print(f"No images found in {directory}")
+            sys.exit(0)
+
+        FileSource.__init__(self, fps, realtime)
+
+    def read_frame(self):
+        if self.position >= len(self.files):
+            return None
+        return cv2.imread(self.files[self.position])
+
+    def skip_frame(self):
+        return self.position < len(self.files)
+
+
+"""
+Opens a frame source
+
+source   -- None for the live camera, a directory of images, or a video file
+realtime -- for recorded sources, pace frames like a live camera rather than running as fast as possible
+threaded -- for the live camera, use threaded latest-frame capture
+"""
+def make_source(source=None, realtime=True, threaded=False):
+    if source is None:
+        return Camera(threaded=threaded)
+    if os.path.isdir(source):
+        return ImageSequenceSource(source, realtime)
+    return VideoFileSource(source, realtime)
@@ -0,0 +1,387 @@
+import cv2
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+
+ARUCO_DICTIONARY = cv2.aruco.DICT_4X4_100
+
+"""
+Removes repeated detections of the same tag, e.g. from overlapping search windows or tiles
+
+Two detections are the same tag if they share an ID and their centres are within tolerance pixels.
+Corner tags all share ID 0, so the ID alone is not enough.
+"""
+def remove_duplicates(raw_tags, ids, tolerance=2):
+    unique_tags = []
+    unique_ids = []
+    unique_centres = []
+    for raw_tag, id in zip(raw_tags, ids):
+        centre = raw_tag.reshape(4, 2).mean(axis=0)
+        if not any(other_id == id and np.linalg.norm(other_centre - centre) < tolerance
+                   for other_id, other_centre in zip(unique_ids, unique_centres)):
+            unique_tags.append(raw_tag)
+            unique_ids.append(id)
+            unique_centres.append(centre)
+    return unique_tags, unique_ids
+
+"""
+Packs a list of tags back into the (raw_tags, tag_ids) layout returned by cv2.aruco.detectMarkers
+"""
+def as_detect_markers_output(raw_tags, ids):
+    if not ids:
+        return (), None
+    return tuple(raw_tags), np.array(ids, dtype=np.int32).reshape(-1, 1)
+
+class ArucoDetector:
+    """
+    Full-frame ArUco detection
+
+    detect() returns (raw_tags, tag_ids) in the same layout as cv2.aruco.detectMarkers
+    """
+    def __init__(self):
+        self.aruco_dictionary = cv2.aruco.Dictionary_get(ARUCO_DICTIONARY)
+        self.aruco_parameters = cv2.aruco.DetectorParameters_create()
+        self.full_scans = 0
+
+    def detect_markers(self, image):
+        (raw_tags, tag_ids, rejected) = cv2.aruco.detectMarkers(image, self.aruco_dictionary, parameters=self.aruco_parameters)
+        return raw_tags, tag_ids
+
+    def detect(self, image):
+        self.full_scans += 1
+        return self.detect_markers(image)
+
+    def get_stats(self):
+        return {"mode": "full", "full_scans": self.full_scans}
+
+    def close(self):
+        pass
+
+
+class TrackedTag:
+    def __init__(self, id, corners):
+        self.id = id
+        self.corners = corners # (4, 2) array of corner positions in pixels
+        self.velocity = np.zeros((4, 2), dtype=np.float32) # Corner displacement per frame
+
+    def centre(self):
+        return self.corners.mean(axis=0)
+
+    def update(self, corners):
+        self.velocity = corners - self.corners
+        self.corners = corners
+
+    def predict(self):
+        return self.corners + self.velocity
+
+
+class RoiDetector(ArucoDetector):
+    """
+    Incremental detection guided by each tag's last known corners and velocity
+
+    Only small windows around the predicted tag positions are searched. A full-frame scan is still done
+    every full_scan_interval frames, and whenever a tracked tag is not found in its window, so that new
+    robots are picked up.
+
+    full_scan_interval -- frames between full-frame scans
+    margin             -- padding around each predicted tag, as a multiple of the tag size
+    """
+    def __init__(self, full_scan_interval=15, margin=1.0):
+        ArucoDetector.__init__(self)
+        self.full_scan_interval = full_scan_interval
+        self.margin = margin
+        self.tracks = []
+        self.frames_since_full_scan = 0
+        self.roi_scans = 0
+        self.roi_pixels = 0 # Pixels searched in the most recent ROI scan
+        self.frame_pixels = 0
+
+    """
+    Search windows (x1, y1, x2, y2) around the predicted corners of every tracked tag, merged where they overlap
+    """
+    def search_windows(self, width, height):
+        windows = []
+        for track in self.tracks:
+            predicted = track.predict()
+            (x1, y1) = predicted.min(axis=0)
+            (x2, y2) = predicted.max(axis=0)
+            padding = max(x2 - x1, y2 - y1) * self.margin + np.abs(track.velocity).max()
+            windows.append([max(int(x1 - padding), 0), max(int(y1 - padding), 0),
+                            min(int(x2 + padding) + 1, width), min(int(y2 + padding) + 1, height)])
+
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(windows)):
+                for j in range(i + 1, len(windows)):
+                    a = windows[i]
+                    b = windows[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        windows[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del windows[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        return windows
+
+    def detect_windows(self, image, windows):
+        raw_tags = []
+        ids = []
+        for (x1, y1, x2, y2) in windows:
+            window_tags, window_ids = self.detect_markers(image[y1:y2, x1:x2])
+            if window_ids is None:
+                continue
+            offset = np.array([x1, y1], dtype=np.float32)
+            for raw_tag, id in zip(window_tags, window_ids[:, 0]):
+                raw_tags.append(raw_tag + offset) # Map window coordinates back to frame coordinates
+                ids.append(int(id))
+        return raw_tags, ids
+
+    """
+    Matches detections to tracked tags by ID and nearest centre, since the corner tags all share ID 0.
+    Returns False if any tracked tag was not found.
+    """
+    def update_tracks(self, raw_tags, ids, full_scan):
+        unmatched = list(self.tracks)
+        matches = []
+        for raw_tag, id in zip(raw_tags, ids):
+            corners = raw_tag.reshape(4, 2)
+            centre = corners.mean(axis=0)
+            candidates = [track for track in unmatched if track.id == id]
+            if candidates:
+                track = min(candidates, key=lambda t: np.linalg.norm(t.centre() - centre))
+                unmatched.remove(track)
+            else:
+                track = None
+            matches.append((track, id, corners))
+
+        if unmatched and not full_scan:
+            return False
+
+        self.tracks = []
+        for track, id, corners in matches:
+            if track is None:
+                track = TrackedTag(id, corners)
+            else:
+                track.update(corners)
+            self.tracks.append(track)
+        return True
+
+    def detect(self, image):
+        (height, width) = image.shape[:2]
+        self.frame_pixels = width * height
+        self.frames_since_full_scan += 1
+
+        if self.tracks and self.frames_since_full_scan < self.full_scan_interval:
+            windows = self.search_windows(width, height)
+            raw_tags, ids = self.detect_windows(image, windows)
+            self.roi_scans += 1
+            self.roi_pixels = sum((x2 - x1) * (y2 - y1) for (x1, y1, x2, y2) in windows)
+
+            # Drop duplicates of the same tag found in more than one window
+            raw_tags, ids = remove_duplicates(raw_tags, ids)
+
+            if self.update_tracks(raw_tags, ids, False):
+                return as_detect_markers_output(raw_tags, ids)
+
+        # Periodic full scan, or a tracked tag was lost
+        self.frames_since_full_scan = 0
+        raw_tags, tag_ids = ArucoDetector.detect(self, image)
+        ids = [] if tag_ids is None else [int(id) for id in tag_ids[:, 0]]
+        self.update_tracks(raw_tags, ids, True)
+        return raw_tags, tag_ids
+
+    def get_stats(self):
+        return {"mode": "incremental",
+                "full_scans": self.full_scans,
+                "roi_scans": self.roi_scans,
+                "tracked_tags": len(self.tracks),
+                "roi_fraction": self.roi_pixels / self.frame_pixels if self.frame_pixels else 0}
+
+
+# Per-process state for TiledDetector's worker pool
+worker_dictionary = None
+worker_parameters = None
+worker_frames = {} # Shared memory blocks this worker has attached to, by name
+
+def init_tile_worker():
+    global worker_dictionary, worker_parameters
+    worker_dictionary = cv2.aruco.Dictionary_get(ARUCO_DICTIONARY)
+    worker_parameters = cv2.aruco.DetectorParameters_create()
+
+"""
+Runs detectMarkers on one tile of the grayscale frame held in shared memory.
+Returns a list of (id, corners) with corners in frame coordinates.
+"""
+def detect_tile(job):
+    (name, shape, (x1, y1, x2, y2)) = job
+
+    if name not in worker_frames:
+        for old in worker_frames.values():
+            old.close()
+        worker_frames.clear()
+        worker_frames[name] = shared_memory.SharedMemory(name=name)
+
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=worker_frames[name].buf)
+    (raw_tags, tag_ids, rejected) = cv2.aruco.detectMarkers(frame[y1:y2, x1:x2], worker_dictionary, parameters=worker_parameters)
+
+    if tag_ids is None:
+        return []
+
+    offset = np.array([x1, y1], dtype=np.float32)
+    return [(int(id), raw_tag + offset) for raw_tag, id in zip(raw_tags, tag_ids[:, 0])]
+
+
+class TiledDetector(ArucoDetector):
+    """
+    Splits each frame into overlapping tiles and detects on them in a pool of worker processes
+
+    The grayscale frame is copied once into shared memory, so only tile coordinates are sent to the workers.
+    Tags found twice in an overlap band are merged.
+
+    tiles   -- (columns, rows) to split the frame into
+    overlap -- pixels shared between neighbouring tiles; must be larger than the biggest tag in the image
+    workers -- number of worker processes (default: one per tile, capped at the number of cores)
+    """
+    def __init__(self, tiles=(2, 2), overlap=160, workers=None):
+        ArucoDetector.__init__(self)
+        self.tiles = tiles
+        self.overlap = overlap
+        if workers is None:
+            workers = min(tiles[0] * tiles[1], multiprocessing.cpu_count())
+        self.workers = workers
+        # Workers are started by a fork server rather than forked from the tracker, which may have other threads
+        # (e.g. the camera reader) holding locks at the time
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(workers, initializer=init_tile_worker)
+        self.frame = None
+        self.shared_frame = None
+        self.tile_boxes = []
+
+    """
+    Tile boxes (x1, y1, x2, y2) covering a width x height frame, each grown by half the overlap on every inner edge
+    """
+    def make_tiles(self, width, height):
+        (columns, rows) = self.tiles
+        half_overlap = self.overlap // 2
+        boxes = []
+        for row in range(rows):
+            for column in range(columns):
+                x1 = max(width * column // columns - half_overlap, 0)
+                x2 = min(width * (column + 1) // columns + half_overlap, width)
+                y1 = max(height * row // rows - half_overlap, 0)
+                y2 = min(height * (row + 1) // rows + half_overlap, height)
+                boxes.append((x1, y1, x2, y2))
+        return boxes
+
+    def allocate(self, shape):
+        if self.shared_frame is not None:
+            self.shared_frame.close()
+            self.shared_frame.unlink()
+        self.shared_frame = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self.frame = np.ndarray(shape, dtype=np.uint8, buffer=self.shared_frame.buf)
+        self.tile_boxes = self.make_tiles(shape[1], shape[0])
+
+    def detect(self, image):
+        self.full_scans += 1
+
+        if image.ndim == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = image
+
+        if self.frame is None or self.frame.shape != gray.shape:
+            self.allocate(gray.shape)
+        self.frame[:] = gray
+
+        jobs = [(self.shared_frame.name, self.frame.shape, box) for box in self.tile_boxes]
+
+        raw_tags = []
+        ids = []
+        for tile in self.pool.map(detect_tile, jobs):
+            for id, raw_tag in tile:
+                raw_tags.append(raw_tag)
+                ids.append(id)
+
+        raw_tags, ids = remove_duplicates(raw_tags, ids)
+        return as_detect_markers_output(raw_tags, ids)
+
+    def close(self):
+        self.pool.terminate()
+        if self.shared_frame is not None:
+            self.shared_frame.close()
+            self.shared_frame.unlink()
+            self.shared_frame = None
+
+    def get_stats(self):
+        return {"mode": "tiled",
+                "full_scans": self.full_scans,
+                "tiles": len(self.tile_boxes),
+                "overlap": self.overlap,
+                "workers": self.workers}
+
+
+class PyramidDetector(ArucoDetector):
+    """
+    Multi-scale detection: finds markers on a downscaled grayscale frame, then refines their corners to
+    sub-pixel accuracy on the full-resolution image
+
+    scale -- downscale factor for the detection pass, e.g. 0.5 for half resolution
+    """
+    def __init__(self, scale=0.5):
+        ArucoDetector.__init__(self)
+        self.scale = scale
+        self.refine_window = (max(int(round(1 / scale)), 2) + 1,) * 2 # Half-size of the cornerSubPix search window
+        self.refine_criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+
+    def detect(self, image):
+        self.full_scans += 1
+
+        if image.ndim == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = image
+
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        raw_tags, tag_ids = self.detect_markers(small)
+
+        if tag_ids is None:
+            return raw_tags, tag_ids
+
+        # Scale candidate corners back up and refine them all in one call on the full-resolution image
+        corners = np.concatenate(raw_tags).reshape(-1, 1, 2) / self.scale
+        corners = np.ascontiguousarray(corners, dtype=np.float32)
+        cv2.cornerSubPix(gray, corners, self.refine_window, (-1, -1), self.refine_criteria)
+
+        return tuple(corners.reshape(-1, 1, 4, 2)), tag_ids
+
+    def get_stats(self):
+        return {"mode": "pyramid", "full_scans": self.full_scans, "scale": self.scale}
+
+
+"""
+Creates a detector for the given mode
+
+mode               -- "full" (detectMarkers on every whole frame), "incremental" (RoiDetector)
+                      "tiled" (TiledDetector) or "pyramid" (PyramidDetector)
+full_scan_interval -- frames between full-frame scans in incremental mode
+tiles              -- (columns, rows) in tiled mode
+overlap            -- pixels shared between neighbouring tiles in tiled mode
+workers            -- worker processes in tiled mode
+scale              -- downscale factor for the detection pass in pyramid mode
+"""
+def make_detector(mode, full_scan_interval=15, tiles=(2, 2), overlap=160, workers=None, scale=0.5):
+    if mode == "full":
+        return ArucoDetector()
+    if mode == "incremental":
+        return RoiDetector(full_scan_interval)
+    if mode == "tiled":
+        return TiledDetector(tiles, overlap, workers)
+    if mode == "pyramid":
+        return PyramidDetector(scale)
+    raise ValueError(f"Unknown detection mode: {mode}")
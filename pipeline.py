@@ -0,0 +1,190 @@
+import threading
+import time
+import traceback
+from stats import LatencyHistogram
+
+STALL_TIME = 2.0 # Seconds without finishing an item after which a stage reports 0 fps
+
+class LatestQueue:
+    """
+    A bounded queue holding at most one item, where a new item replaces any item not yet taken
+
+    Producers never wait, and a slow consumer always gets the newest item instead of working through a backlog.
+    dropped counts the items that were replaced before anyone took them.
+
+    lossless -- instead of replacing, make put() wait until the previous item has been taken (used when
+                replaying recordings as fast as possible, where every frame should be processed)
+    """
+    def __init__(self, lossless=False):
+        self.item = None
+        self.has_item = False
+        self.dropped = 0
+        self.lossless = lossless
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        with self.condition:
+            if self.lossless:
+                self.condition.wait_for(lambda: not self.has_item)
+            elif self.has_item:
+                self.dropped += 1
+            self.item = item
+            self.has_item = True
+            self.condition.notify_all()
+
+    """
+    Waits for the next item. Returns None if timeout (in seconds) passes first.
+    """
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.has_item, timeout):
+                return None
+            item = self.item
+            self.item = None
+            self.has_item = False
+            self.condition.notify_all()
+            return item
+
+
+class Frame:
+    """
+    A camera frame as it passes through the tracker pipeline
+
+    image     -- the camera image
+    timestamp -- time.time() at which the frame was captured
+    sequence  -- camera sequence number
+    raw_tags  -- corner arrays from detection, in the cv2.aruco.detectMarkers layout
+    tag_ids   -- IDs from detection, in the cv2.aruco.detectMarkers layout (None if no tags were found)
+    """
+    def __init__(self, image, timestamp, sequence):
+        self.image = image
+        self.timestamp = timestamp
+        self.sequence = sequence
+        self.raw_tags = ()
+        self.tag_ids = None
+
+
+class Stage(threading.Thread):
+    """
+    One stage of the tracker pipeline, running on its own thread
+
+    Takes the newest item from its input queue, passes it to function and puts the result (unless None) on
+    every output queue. A stage with no input calls function(None) in a loop, e.g. to read the camera.
+
+    name     -- name used when reporting
+    function -- the work done for each item
+    input    -- LatestQueue to read from, or None
+    outputs  -- LatestQueues to write results to
+    rate     -- maximum number of items per second (None for no limit); items arriving in between are dropped
+
+    An exception from function is printed and the item skipped, so one bad frame cannot stop the stage for good.
+    """
+    def __init__(self, name, function, input=None, outputs=(), rate=None):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.function = function
+        self.input = input
+        self.outputs = outputs
+        self.rate = rate
+        self.running = True
+
+        self.processed = 0
+        self.busy = False # Whether an item is being worked on
+        self.errors = 0 # Items whose function raised an exception
+        self.latency = LatencyHistogram() # Time spent in function for each item
+        self.fps = 0
+        self.busy_time = 0 # Seconds spent in function during the current reporting window
+        self.utilisation = 0 # Fraction of the last reporting window spent in function
+        self.window_start = time.time()
+        self.window_count = 0
+
+    def run(self):
+        while self.running:
+            if self.input is None:
+                item = None
+            else:
+                item = self.input.get(timeout=0.5)
+                if item is None:
+                    continue
+
+            self.busy = True
+            start = time.time()
+            try:
+                result = self.function(item)
+            except Exception:
+                self.busy = False
+                self.errors += 1
+                print(f"Error in {self.name} stage:")
+                traceback.print_exc()
+                time.sleep(0.1) # Don't flood the console if every item fails
+                continue
+            end = time.time()
+            self.latency.record(end - start)
+
+            if result is not None:
+                for output in self.outputs:
+                    output.put(result)
+            self.busy = False
+
+            self.count(end - start, end)
+
+            if self.rate:
+                time.sleep(max(start + 1 / self.rate - time.time(), 0))
+
+    """
+    Updates throughput once per second
+    """
+    def count(self, duration, now):
+        self.processed += 1
+        self.window_count += 1
+        self.busy_time += duration
+        elapsed = now - self.window_start
+        if elapsed >= 1.0:
+            self.fps = self.window_count / elapsed
+            self.utilisation = self.busy_time / elapsed
+            self.window_start = now
+            self.window_count = 0
+            self.busy_time = 0
+
+    def stop(self):
+        self.running = False
+
+    def get_stats(self):
+        # fps and utilisation are only updated as items finish, so a stage that has stopped finishing them
+        # would otherwise keep reporting its last rate
+        stall_time = max(STALL_TIME, 2 / self.rate) if self.rate else STALL_TIME
+        stalled = time.time() - self.window_start > stall_time
+        return {"fps": 0 if stalled else round(self.fps, 1),
+                "processed": self.processed,
+                "errors": self.errors,
+                "utilisation": 0 if stalled else round(self.utilisation, 2),
+                "dropped": self.input.dropped if self.input is not None else 0,
+                "latency": self.latency.get_stats()}
+
+
+"""
+Waits until every item already in the pipeline has been worked through, e.g. at the end of a recording
+
+stages -- the pipeline's stages, other than those with no input, which should have stopped producing
+timeout -- seconds to wait at most
+"""
+def drain(stages, timeout=10.0):
+    deadline = time.time() + timeout
+    idle_checks = 0
+    while idle_checks < 2 and time.time() < deadline: # Twice in a row, in case an item was between queue and stage
+        idle = all(not stage.busy and (stage.input is None or not stage.input.has_item) for stage in stages)
+        idle_checks = idle_checks + 1 if idle else 0
+        time.sleep(0.05)
+
+
+"""
+One line summary of stage throughput, e.g. "capture 30.0 fps | detect 29.9 fps (12 dropped) | ..."
+"""
+def report(stages):
+    parts = []
+    for stage in stages:
+        stats = stage.get_stats()
+        part = f"{stage.name} {stats['fps']:.1f} fps"
+        if stats["dropped"]:
+            part += f" ({stats['dropped']} dropped)"
+        parts.append(part)
+    return " | ".join(parts)
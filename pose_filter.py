@@ -0,0 +1,151 @@
+import angles
+
+POSITION_NOISE = 0.004 ** 2 # Variance of a measured position, in m² (about 2 pixels of tag jitter)
+ORIENTATION_NOISE = 2.0 ** 2 # Variance of a measured orientation, in degrees²
+ACCELERATION_NOISE = 0.5 ** 2 # How quickly a robot's velocity can change, in (m/s²)²
+ANGULAR_ACCELERATION_NOISE = 180.0 ** 2 # How quickly a robot's turning rate can change, in (degrees/s²)²
+MAX_EXTRAPOLATION = 0.2 # Furthest ahead of the last measurement a pose is extrapolated, in seconds (a few frames)
+
+"""
+Time to extrapolate over, from the last measurement to query_time, limited to 0 to MAX_EXTRAPOLATION seconds
+
+A constant-velocity model is only good for a few frames, so a query far in the future (or a client with a skewed
+clock) gets the pose at the limit rather than one that has drifted off the arena. Poses are never wound back
+before the last measurement.
+"""
+def extrapolation_time(query_time, timestamp):
+    return min(max(query_time - timestamp, 0.0), MAX_EXTRAPOLATION)
+
+class ConstantVelocityFilter:
+    """
+    One-dimensional Kalman filter with a constant-velocity model
+
+    State is (value, rate), with covariance [[p00, p01], [p01, p11]].
+
+    measurement_noise -- variance of each measurement
+    process_noise     -- spectral density of the (unmodelled) acceleration
+    circular          -- treat the value as an angle in degrees, wrapped to [-180, 180]
+    """
+    def __init__(self, value, measurement_noise, process_noise, circular=False):
+        self.value = value
+        self.rate = 0.0
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        self.circular = circular
+
+        # Start with the measurement's uncertainty in the value and no idea of the rate
+        self.p00 = measurement_noise
+        self.p01 = 0.0
+        self.p11 = process_noise
+
+    def predict(self, dt):
+        self.value = self.value + self.rate * dt
+        if self.circular:
+            self.value = angles.normalize(self.value, -180, 180)
+
+        q = self.process_noise
+        self.p00 = self.p00 + dt * (2 * self.p01 + dt * self.p11) + q * dt ** 3 / 3
+        self.p01 = self.p01 + dt * self.p11 + q * dt ** 2 / 2
+        self.p11 = self.p11 + q * dt
+
+    def update(self, measurement):
+        innovation = measurement - self.value
+        if self.circular:
+            innovation = angles.normalize(innovation, -180, 180)
+
+        s = self.p00 + self.measurement_noise
+        k0 = self.p00 / s
+        k1 = self.p01 / s
+
+        self.value = self.value + k0 * innovation
+        self.rate = self.rate + k1 * innovation
+        if self.circular:
+            self.value = angles.normalize(self.value, -180, 180)
+
+        self.p11 = self.p11 - k1 * self.p01
+        self.p01 = self.p01 - k0 * self.p01
+        self.p00 = self.p00 - k0 * self.p00
+
+    """
+    The value dt seconds after the last update, without changing the filter
+    """
+    def extrapolate(self, dt):
+        value = self.value + self.rate * dt
+        if self.circular:
+            value = angles.normalize(value, -180, 180)
+        return value
+
+
+class PoseFilter:
+    """
+    Smooths a tag's position and orientation, and estimates its linear and angular velocity
+
+    x, y and orientation are filtered independently with constant-velocity models, timed by the capture
+    timestamps of the frames the tag was seen in.
+
+    x, y        -- measured position in metres
+    orientation -- measured orientation in degrees
+    timestamp   -- capture time of the measurement, in seconds
+    """
+    def __init__(self, x, y, orientation, timestamp):
+        self.x = ConstantVelocityFilter(x, POSITION_NOISE, ACCELERATION_NOISE)
+        self.y = ConstantVelocityFilter(y, POSITION_NOISE, ACCELERATION_NOISE)
+        self.orientation = ConstantVelocityFilter(orientation, ORIENTATION_NOISE, ANGULAR_ACCELERATION_NOISE, circular=True)
+        self.timestamp = timestamp
+
+    def update(self, x, y, orientation, timestamp):
+        dt = timestamp - self.timestamp
+        if dt > 0:
+            self.x.predict(dt)
+            self.y.predict(dt)
+            self.orientation.predict(dt)
+            self.timestamp = timestamp
+
+        self.x.update(x)
+        self.y.update(y)
+        self.orientation.update(orientation)
+
+    """
+    Returns (x, y, orientation) extrapolated to query_time, at most MAX_EXTRAPOLATION seconds ahead
+    """
+    def predict(self, query_time):
+        dt = extrapolation_time(query_time, self.timestamp)
+        return self.x.extrapolate(dt), self.y.extrapolate(dt), self.orientation.extrapolate(dt)
+
+    """
+    Returns (x, y, angular) velocity in m/s and degrees/s
+    """
+    def velocity(self):
+        return self.x.rate, self.y.rate, self.orientation.rate
+
+    """
+    Returns a PoseEstimate of the filter's current state, which stays the same as the filter keeps updating
+    """
+    def estimate(self):
+        return PoseEstimate(self)
+
+
+class PoseEstimate:
+    """
+    A PoseFilter's pose and velocity at one moment, with the same predict() and velocity() as the filter
+
+    Used for world snapshots, so that other threads can extrapolate poses while the filter itself is updated.
+    """
+    __slots__ = ("x", "y", "orientation", "velocity_x", "velocity_y", "angular_velocity", "timestamp")
+
+    def __init__(self, pose_filter):
+        self.x = pose_filter.x.value
+        self.y = pose_filter.y.value
+        self.orientation = pose_filter.orientation.value
+        self.velocity_x = pose_filter.x.rate
+        self.velocity_y = pose_filter.y.rate
+        self.angular_velocity = pose_filter.orientation.rate
+        self.timestamp = pose_filter.timestamp
+
+    def predict(self, query_time):
+        dt = extrapolation_time(query_time, self.timestamp)
+        orientation = angles.normalize(self.orientation + self.angular_velocity * dt, -180, 180)
+        return self.x + self.velocity_x * dt, self.y + self.velocity_y * dt, orientation
+
+    def velocity(self):
+        return self.velocity_x, self.velocity_y, self.angular_velocity
@@ -0,0 +1,299 @@
+import asyncio
+import collections
+import json
+import traceback
+import websockets
+
+"""
+Encodes a get_robots reply as JSON, including its world's header (frame ID, capture and publish times)
+"""
+def encode_json(reply, header):
+    return json.dumps(dict(reply, **header))
+
+
+class ReplyCache:
+    """
+    The newest world's get_robots reply, encoded once and then sent as-is to every client asking
+    for the same frame
+
+    Only used from the websocket server's event loop, so it needs no lock.
+
+    encode -- function of (reply, world header) giving the message to send, JSON by default
+    """
+    def __init__(self, encode=encode_json):
+        self.encode = encode
+        self.snapshot = None # World the cached reply was encoded from
+        self.encoded = None
+        self.hits = 0 # Replies served from the cache
+        self.misses = 0 # Replies that had to be encoded
+
+    """
+    Returns the encoded get_robots reply for snapshot, including its header
+    """
+    def get(self, snapshot):
+        if snapshot is not self.snapshot:
+            self.encoded = self.encode(snapshot.robots_reply, snapshot.header)
+            self.snapshot = snapshot
+            self.misses += 1
+        else:
+            self.hits += 1
+        return self.encoded
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else None}
+
+
+"""
+Whether a reply field differs by more than its tolerance, comparing numbers within tolerance and everything else exactly
+
+tolerances -- dictionary of field name to the largest change in that field that is not sent; numbers in fields not
+              in it must match exactly. Fields nested in dictionaries are looked up by their own name.
+name       -- name of the field being compared
+"""
+def changed(old, new, tolerances, name=None):
+    if isinstance(new, dict):
+        return (not isinstance(old, dict) or old.keys() != new.keys()
+                or any(changed(old[key], value, tolerances, key) for key, value in new.items()))
+    if isinstance(new, (int, float)) and isinstance(old, (int, float)) and not isinstance(new, bool):
+        return abs(new - old) > tolerances.get(name, 0)
+    return new != old
+
+
+class DeltaEncoder:
+    """
+    Encodes one client's get_robots replies as deltas: only the robots and fields that changed since a frame the
+    client already has, plus the robots that have gone
+
+    Deltas are worked out against what the client was actually sent, not the world at that frame, so changes
+    smaller than a tolerance cannot build up unseen over many frames.
+
+    A delta reply has a "base" (the frame it applies to), the changed fields of each changed robot under its
+    ID, and a "removed" list of IDs. A keyframe is an ordinary, complete reply, with no "base".
+
+    tolerances        -- default largest change that is not sent, by field name (see changed); fields with different
+                         units, such as angles in degrees and distances in metres, need tolerances of their own
+    history           -- number of recent frames a client can ask for a delta from; older bases get a keyframe
+    keyframe_interval -- if given, send a keyframe after this many deltas in a row
+    """
+    def __init__(self, tolerances=None, history=10, keyframe_interval=None):
+        self.tolerances = {} if tolerances is None else tolerances
+        self.history = history
+        self.keyframe_interval = keyframe_interval
+        self.views = collections.OrderedDict() # Frame ID to the reply the client has after applying that frame
+        self.last = None # Frame ID of the latest reply encoded
+        self.deltas_in_a_row = 0
+
+    """
+    Returns the reply for a frame as a dictionary, encoded against base if the client still has it
+
+    reply     -- full get_robots reply (filtered or not) for the frame
+    header    -- header of the world the reply describes, with its frame ID
+    base      -- frame ID of the last reply the client applied, or None for a keyframe
+    tolerances -- largest change that is not sent, by field name, if not the default
+    """
+    def encode(self, reply, header, base=None, tolerances=None):
+        frame_id = header["frame"]
+        tolerances = self.tolerances if tolerances is None else tolerances
+        keyframe_due = self.keyframe_interval is not None and self.deltas_in_a_row >= self.keyframe_interval
+
+        if base is None or base not in self.views or keyframe_due:
+            view = reply
+            message = dict(reply, **header)
+            self.deltas_in_a_row = 0
+        else:
+            old = self.views[base]
+            view = dict(old)
+            message = dict(header, base=base, removed=[id for id in old if id not in reply])
+            for id in message["removed"]:
+                del view[id]
+            for id, robot in reply.items():
+                if id not in old:
+                    update = robot
+                else:
+                    update = {key: value for key, value in robot.items()
+                              if key not in old[id] or changed(old[id][key], value, tolerances, key)}
+                    if not update:
+                        continue
+                message[id] = update
+                view[id] = dict(old.get(id, {}), **update)
+            self.deltas_in_a_row += 1
+
+        self.views[frame_id] = view
+        self.last = frame_id
+        while len(self.views) > self.history:
+            self.views.popitem(last=False)
+        return message
+
+    """
+    Makes the next reply encoded against self.last a keyframe, e.g. for a subscriber that lost track
+    """
+    def force_keyframe(self):
+        self.last = None
+
+
+class Subscriber:
+    """
+    One client's subscription to the world snapshots the tracker publishes
+
+    Holds only the newest snapshot not yet sent (a latest-wins queue of one), so a slow client skips frames
+    instead of holding up the tracker or other clients.
+
+    If a snapshot cannot be encoded or sent, the error is printed, the client is sent an error message and the
+    subscription ends, to be dropped by Subscriptions at the next snapshot.
+
+    websocket -- the client's connection
+    encode    -- function that turns a snapshot into the message to send
+    rate      -- maximum snapshots per second, or None for every frame
+    """
+    def __init__(self, websocket, encode, rate=None):
+        self.websocket = websocket
+        self.encode = encode
+        self.rate = rate
+        self.latest = None # Newest snapshot not yet sent
+        self.ready = asyncio.Event()
+        self.sent = 0 # Snapshots sent
+        self.dropped = 0 # Snapshots replaced by a newer one before they were sent
+        self.failed = False # Whether the subscription ended with an error
+        self.task = asyncio.ensure_future(self.run())
+
+    """
+    Called from the event loop for every published snapshot
+    """
+    def offer(self, snapshot):
+        if self.latest is not None:
+            self.dropped += 1
+        self.latest = snapshot
+        self.ready.set()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        next_send = 0
+        try:
+            while True:
+                await self.ready.wait()
+
+                # At a limited rate, newer snapshots keep replacing the waiting one until the next send is due
+                if self.rate is not None:
+                    if next_send > loop.time():
+                        await asyncio.sleep(next_send - loop.time())
+                    next_send = loop.time() + 1 / self.rate
+
+                snapshot = self.latest
+                self.latest = None
+                self.ready.clear()
+
+                await self.websocket.send(self.encode(snapshot))
+                self.sent += 1
+        except websockets.ConnectionClosed:
+            pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed = True
+            print("Error pushing to a subscriber:")
+            traceback.print_exc()
+            try:
+                await self.websocket.send(json.dumps({"subscribed": False, "error": f"subscription ended: {e!r}"}))
+            except websockets.ConnectionClosed:
+                pass
+
+    def close(self):
+        self.task.cancel()
+
+
+class Subscriptions:
+    """
+    Every client's subscription, fed with each snapshot the tracker publishes
+
+    loop -- the event loop the websocket server runs on
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.subscribers = set()
+        self.closed_sent = 0 # Totals for subscriptions that have ended
+        self.closed_dropped = 0
+        self.closed_failed = 0
+
+    """
+    Hands a newly published snapshot to every subscriber. Safe to call from any thread, e.g. the publish stage.
+    """
+    def publish(self, snapshot):
+        self.loop.call_soon_threadsafe(self.deliver, snapshot)
+
+    def deliver(self, snapshot):
+        for subscriber in list(self.subscribers):
+            if subscriber.task.done(): # Its client has gone, or it ended with an error
+                self.unsubscribe(subscriber)
+            else:
+                subscriber.offer(snapshot)
+
+    """
+    Starts pushing snapshots to a client; see Subscriber
+    """
+    def subscribe(self, websocket, encode, rate=None):
+        subscriber = Subscriber(websocket, encode, rate)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            subscriber.close()
+            self.subscribers.remove(subscriber)
+            self.closed_sent += subscriber.sent
+            self.closed_dropped += subscriber.dropped
+            self.closed_failed += subscriber.failed
+
+    def get_stats(self):
+        return {"subscribers": len(self.subscribers),
+                "sent": self.closed_sent + sum(subscriber.sent for subscriber in self.subscribers),
+                "dropped": self.closed_dropped + sum(subscriber.dropped for subscriber in self.subscribers),
+                "failed": self.closed_failed + sum(subscriber.failed for subscriber in self.subscribers)}
+
+
+"""
+Reads the rate from a subscribe request: "every_frame" (or true) for every frame, otherwise snapshots per second
+
+Raises ValueError for anything else.
+"""
+def parse_rate(value):
+    if value is True or value == "every_frame":
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"subscription rate must be a number or \"every_frame\", not {value!r}")
+    rate = float(value)
+    if not rate > 0: # Also refuses NaN
+        raise ValueError(f"subscription rate must be positive, not {value}")
+    return rate
+
+
+"""
+Reads the tolerances of a delta request: the largest change that is not sent, by field name
+
+Returns defaults with the tolerances the client gave in place of their defaults. Raises ValueError unless value is a
+dictionary of field names in defaults to numbers that are not negative.
+"""
+def parse_tolerances(value, defaults):
+    if not isinstance(value, dict):
+        raise ValueError(f"tolerance must map field names to tolerances, e.g. {defaults}, not {value!r}")
+    tolerances = dict(defaults)
+    for name, tolerance in value.items():
+        if name not in defaults:
+            raise ValueError(f"unknown tolerance field {name!r}, expected some of {list(defaults)}")
+        if isinstance(tolerance, bool) or not isinstance(tolerance, (int, float)) or not tolerance >= 0: # Also NaN
+            raise ValueError(f"tolerance of {name} must be a number that is not negative, not {tolerance!r}")
+        tolerances[name] = float(tolerance)
+    return tolerances
+
+
+"""
+Reads the frame ID a delta request is based on, or None for a keyframe
+
+Raises ValueError for anything else.
+"""
+def parse_since(value):
+    if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+        raise ValueError(f"since must be the frame ID of a reply, not {value!r}")
+    return value
@@ -19,6 +19,11 @@ import angles
 import colorama
 from colorama import Fore
 
+try:
+    import wire # Needs NumPy; only used for the binary encoding
+except ImportError:
+    wire = None
+
 """
 This function is the main loop of your application. You can make any changes you want throughout this 
 file, but most of your game logic will be located in here.
@@ -41,6 +46,8 @@ def main_loop():
     # This is stored in the global variable active_robots, a map of id -> instances of the Robot class (defined lower in this file) 
     print(Fore.GREEN + "[INFO]: Requesting data from tracking server")
     loop.run_until_complete(get_server_data())
+    if server_data_age is not None:
+        print(Fore.GREEN + f"[INFO]: Server data is {server_data_age * 1000:.0f} ms old (frame {server_frame})")
 
     # Request sensor data from detected robots
     # This augments the Robot instances with their battery level and the values from each robot's proximity sensors
@@ -56,7 +63,9 @@ def main_loop():
     print()
 
     # Sleep until next control cycle. We use 0.1 seconds by default so as to not flood the network.
-    time.sleep(0.1)
+    # When subscribed, the server's pushes set the pace instead.
+    if server_subscription is None:
+        time.sleep(0.1)
 
 
 
@@ -260,6 +269,9 @@ class Robot:
         self.tasks = {}
 
         self.orientation = 0 # Our orientation from "EAST". 180 to -180, with positive being clockwise.
+        self.velocity = {"x": 0, "y": 0, "angular": 0} # Estimated by the server, in m/s and degrees/s
+        self.pose_age = 0 # Seconds between the server last seeing this robot's tag and the frame it described
+        self.data_age = 0 # Seconds between the camera capturing that frame and us receiving the server's data about it
         self.neighbours = {} # All other robots in the area (see format, above)
         self.role = 'NOMAD' # Will be NOMAD, DEFENDER, MID_FIELD, STRIKER
         self.team = 'UNASSIGNED' # Will be UNASSIGNED, RED, BLUE
@@ -300,12 +312,24 @@ ids = []
 server_address = server_york
 server_port = 6000
 robot_port = 6000
+server_subscription = 10 # Have the server push its data at most this many times a second ("every_frame" for every
+                         # camera frame), rather than asking for it every control cycle; None to ask instead
+server_encoding = "json" # Or "binary" for the server's compact binary replies (see wire.py; needs NumPy)
+server_deltas = True # Ask the server for only what changed since the last reply (JSON encoding only)
 
 if len(server_address) == 0:
-    raise Exception(f"Enter local tracking server address on line {inspect.currentframe().f_lineno - 6}, "
+    raise Exception(f"Enter local tracking server address on line {inspect.currentframe().f_lineno - 8}, "
                     f"then re-run this script.")
 
+if server_encoding == "binary" and wire is None:
+    raise Exception("The binary server encoding needs NumPy; install it or set server_encoding to \"json\".")
+
 server_connection = None
+server_state = {} # Latest server reply, with any deltas applied, and its frame ID
+server_frame = None # None until a complete reply (keyframe) has been applied
+server_keyframe_requested = False # Whether we have asked a subscription for a keyframe and are waiting for it
+server_clock_offset = 0 # Server's clock minus ours, in seconds, from the clock-offset handshake
+server_data_age = None # Seconds between the camera capturing the latest server data and us receiving it
 colorama.init(autoreset=True)
 
 
@@ -341,12 +365,52 @@ async def connect_to_server():
 
     if awake:
         print("Server is awake")
-        global server_connection
+        global server_connection, server_subscription
         server_connection = connection
+
+        await sync_clock(connection)
+
+        if server_encoding != "json":
+            await connection.send(json.dumps({"encoding": server_encoding}))
+            reply = json.loads(await connection.recv())
+            if reply.get("encoding") != server_encoding:
+                print(f"Server refused encoding {server_encoding}: {reply.get('error')}")
+
+        if server_subscription is not None:
+            message = {"subscribe": server_subscription, "ids": robot_ids}
+            if server_deltas and server_encoding == "json":
+                message["delta"] = True
+            await connection.send(json.dumps(message))
+            reply = json.loads(await connection.recv())
+            if not reply.get("subscribed"):
+                print(f"Server refused subscription: {reply.get('error')}")
+                server_subscription = None # Ask for data instead
     else:
         print("Server did not respond")
 
 
+# Work out the offset between the server's clock and ours, so the capture and publish times in its replies can be
+# compared with our own. Each round trip gives an estimate that is out by at most half the round trip time, so the
+# estimate from the quickest of several is kept.
+async def sync_clock(connection, rounds=5):
+    global server_clock_offset
+
+    best_round_trip = None
+    for i in range(rounds):
+        sent = time.time()
+        await connection.send(json.dumps({"clock": sent}))
+        reply = json.loads(await connection.recv())
+        received = time.time()
+
+        round_trip = received - sent
+        if "server_time" in reply and (best_round_trip is None or round_trip < best_round_trip):
+            best_round_trip = round_trip
+            server_clock_offset = reply["server_time"] - (sent + received) / 2
+
+    if best_round_trip is not None:
+        print(f"Server clock offset {server_clock_offset * 1000:.1f} ms (round trip {best_round_trip * 1000:.1f} ms)")
+
+
 # Connect to websocket server running on each of the robots
 async def connect_to_robots():
     for id in active_robots.keys():
@@ -416,19 +480,84 @@ async def message_robots(ids, function):
     await asyncio.gather(*tasks)
 
 
+# Bring our copy of the server's data up to date with a reply, which is either complete or, if it has a "base",
+# only what changed since that frame. Returns None for a delta that doesn't build on our copy, e.g. after a missed
+# reply; server_frame is then None until a complete reply arrives.
+def apply_server_reply(reply_json):
+    global server_state, server_frame, server_keyframe_requested, server_subscription
+
+    if isinstance(reply_json, bytes): # Binary encoding
+        reply = wire.decode_reply(reply_json)
+    else:
+        reply = json.loads(reply_json)
+
+    if "error" in reply:
+        print(f"Server error: {reply['error']}")
+        if reply.get("subscribed") is False: # The server ended our subscription, so ask for data from now on
+            server_subscription = None
+        return None
+
+    if "base" in reply:
+        if reply["base"] != server_frame:
+            if server_frame is not None:
+                print(f"Server sent changes since frame {reply['base']}, but we have frame {server_frame}; "
+                      f"waiting for a complete reply")
+            server_frame = None
+            return None
+        state = dict(server_state)
+        for id in reply["removed"]:
+            state.pop(str(id), None)
+        for k, v in reply.items():
+            if k.isdigit():
+                state[k] = dict(state.get(k, {}), **v)
+    else:
+        state = {k: v for (k, v) in reply.items() if k.isdigit()}
+        server_keyframe_requested = False
+
+    server_state = state
+    server_frame = reply.get("frame")
+    return dict(state, frame=server_frame, captured=reply.get("captured"), published=reply.get("published"))
+
+
 # Get robots' virtual sensor data from the tracking server, for our active robots
 async def get_server_data():
     try:
-        global ids
-        message = {"get_robots": True}
+        global ids, server_data_age, server_keyframe_requested
 
-        # Send request for data and wait for reply
-        await server_connection.send(json.dumps(message))
-        reply_json = await server_connection.recv()
-        reply = json.loads(reply_json)
+        if server_subscription is None:
+            message = {"get_robots": True, "ids": robot_ids} # Only our robots; add e.g. "fields": ["pose", "ball"] to trim further
+            if server_deltas and server_encoding == "json":
+                message["since"] = server_frame
+
+            # Send request for data and wait for reply
+            await server_connection.send(json.dumps(message))
+            reply = apply_server_reply(await server_connection.recv())
+        else:
+            # Wait for the server to push new data, then catch up to the newest if several arrived since the last
+            # cycle. Every push is applied in turn, as each delta builds on the one before.
+            reply = apply_server_reply(await server_connection.recv())
+            while True:
+                try:
+                    reply = apply_server_reply(await asyncio.wait_for(server_connection.recv(), timeout=0.001)) or reply
+                except asyncio.TimeoutError:
+                    break
+
+            # Our copy fell out of step with the server's deltas, so ask for a complete reply to start again from.
+            # (When polling, asking "since" None does the same.)
+            if server_frame is None and not server_keyframe_requested:
+                await server_connection.send(json.dumps({"keyframe": True}))
+                server_keyframe_requested = True
+
+        if reply is None: # Nothing new we can use this cycle
+            return
+
+        # How old the data is, from the camera capturing its frame (in the server's clock) until now (in ours)
+        if reply["captured"] is not None:
+            server_data_age = time.time() + server_clock_offset - reply["captured"]
 
         # Filter reply from the server, based on our active robots of interest
-        filtered_reply = {int(k): v for (k, v) in reply.items() if int(k) in active_robots.keys()}
+        # Robot IDs are the numeric keys; the others (e.g. "frame") describe the reply itself
+        filtered_reply = {int(k): v for (k, v) in reply.items() if k.isdigit() and int(k) in active_robots.keys()}
         ids = list(filtered_reply.keys())
 
         #pprint.PrettyPrinter(indent=4).pprint(reply)
@@ -440,6 +569,9 @@ async def get_server_data():
         for id, robot in filtered_reply.items():
             #print(f"Updating robot {id}")
             active_robots[id].orientation = robot["orientation"]
+            active_robots[id].velocity = robot["velocity"]
+            active_robots[id].pose_age = robot["pose_age"]
+            active_robots[id].data_age = server_data_age
             active_robots[id].role = robot["role"]
             active_robots[id].team = robot["team"]
             active_robots[id].remaining_time = robot["remaining_time"]
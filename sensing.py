@@ -0,0 +1,18 @@
+import numpy as np
+
+"""
+Range and relative bearing from every observer to every target, worked out for all pairs at once
+
+observers    -- (N, 2) array of observer positions
+orientations -- (N,) array of observer orientations, in degrees
+targets      -- (M, 2) array of target positions
+
+Returns (ranges, bearings), both (N, M) arrays. Ranges are in the units of the positions; bearings are in
+degrees relative to each observer's orientation, normalised to [-180, 180) like angles.normalize().
+"""
+def rangesAndBearings(observers, orientations, targets):
+    offsets = targets[np.newaxis, :, :] - observers[:, np.newaxis, :]
+    ranges = np.hypot(offsets[:, :, 0], offsets[:, :, 1])
+    bearings = np.degrees(np.arctan2(offsets[:, :, 1], offsets[:, :, 0])) - orientations[:, np.newaxis]
+    bearings = (bearings + 180) % 360 - 180
+    return ranges, bearings
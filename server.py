@@ -1,19 +1,33 @@
 #!/usr/bin/env python3
 
-from pynput import keyboard
 import math
+import queue
 import threading
 import asyncio
 import websockets
 import json
+import numpy as np
 from camera import *
+from detection import make_detector
+from pipeline import LatestQueue, Frame, Stage, drain, report
+from stats import LatencyHistogram, ServerStats
+from pose_filter import PoseFilter
+from replies import DeltaEncoder, ReplyCache, Subscriptions, encode_json, parse_rate, parse_since, parse_tolerances
+from tags import TagBatch
+from sensing import rangesAndBearings
 from vector2d import Vector2D
-import itertools
 import random
 import angles
+import wire
 import time
 from math import sqrt
 from ballgame_roles import *
+import argparse
+
+try:
+    from pynput import keyboard
+except ImportError: # pynput needs a display, so may be missing on a headless tracking box
+    keyboard = None
 
 red = (0, 0, 255)
 green = (0, 255, 0)
@@ -28,38 +42,73 @@ grey = (100, 100, 100)
 
 PUCK_ID = 1
 GAME_TIME = 5 * 60
+THREADED_CAPTURE = True # Read the camera on its own thread and always track the newest frame
+DETECTION_MODE = "incremental" # "full", "incremental" (search around last known tag positions), "tiled" (multi-process)
+                               # or "pyramid" (detect at reduced resolution, refine corners at full resolution)
+FULL_SCAN_INTERVAL = 15 # Frames between full-frame scans in incremental detection mode
+DETECTION_TILES = (2, 2) # Columns and rows of tiles in tiled detection mode
+TILE_OVERLAP = 160 # Pixels shared between neighbouring tiles; must be larger than a tag
+DETECTION_SCALE = 0.5 # Downscale factor for the detection pass in pyramid detection mode
+STATS_INTERVAL = 10 # Seconds between pipeline throughput reports
+FILTER_POSES = False # Serve filtered poses instead of raw tag positions (velocities are always filtered)
+ROBOT_TTL = 1.0 # Seconds a robot is kept after its tag was last seen
+MAX_QUERY_OFFSET = 1.0 # Furthest a get_robots "time" may be from the frame's capture time, in seconds
+# Default largest change in each reply number left out of a delta reply, by field name. Angles are in degrees and
+# distances in metres; numbers not listed, such as remaining_time, are sent whenever they change.
+DELTA_TOLERANCES = {
+    "orientation": 0.5, "bearing": 0.5, "angular": 0.5, # Degrees, or degrees per second
+    "range": 0.01, "x": 0.01, "y": 0.01, # Metres, or metres per second
+    "pose_age": 0.01, # Seconds
+    "progress_through_zone": 0.01, # Fraction of the zone
+}
+DELTA_HISTORY = 10 # Recent frames per client that delta replies can be based on; older bases get a keyframe
+DELTA_KEYFRAME_INTERVAL = 100 # Delta pushes to a subscriber between keyframes
+
+# Fields of a get_robots reply, by the group a client can ask for
+FIELD_GROUPS = {
+    "pose": ["orientation", "velocity", "pose_age"],
+    "neighbours": ["players"],
+    "ball": ["ball"],
+    "goals": ["their_goal", "our_goal"],
+    "zone": ["role", "team", "remaining_time", "progress_through_zone"],
+}
+
+# Encodings a client can ask for its get_robots replies to be sent in (see wire.py for the binary layout)
+ENCODINGS = {
+    "json": encode_json,
+    "binary": wire.encode,
+}
+
+# Operator commands, by the name accepted over the websocket and the key they are bound to
+COMMANDS = {
+    "pause": "p",
+    "print_zones": "l",
+    "build_zones": "b",
+    "assign_teams": "t",
+    "reset": "r",
+    "randomise_starting_positions": "x",
+    "blue_score_down": "[",
+    "blue_score_up": "]",
+    "red_score_down": ",",
+    "red_score_up": ".",
+}
 # random.seed(1)
 
-class Tag:
-    def __init__(self, id, raw_tag):
-        self.id = id
-        self.raw_tag = raw_tag
-        self.corners = raw_tag.tolist()[0]
-
-        # Individual corners (e.g. tl = top left corner in relation to the tag, not the camera)
-        self.tl = Vector2D(int(self.corners[0][0]), int(self.corners[0][1])) # Top left
-        self.tr = Vector2D(int(self.corners[1][0]), int(self.corners[1][1])) # Top right
-        self.br = Vector2D(int(self.corners[2][0]), int(self.corners[2][1])) # Bottom right
-        self.bl = Vector2D(int(self.corners[3][0]), int(self.corners[3][1])) # Bottom left
-
-        # Calculate centre of the tag
-        self.centre = Vector2D(int((self.tl.x + self.tr.x + self.br.x + self.bl.x) / 4),
-                               int((self.tl.y + self.tr.y + self.br.y + self.bl.y) / 4))
-
-        # Calculate centre of top of tag
-        self.front = Vector2D(int((self.tl.x + self.tr.x) / 2),
-                              int((self.tl.y + self.tr.y) / 2))
-
-        # Calculate orientation of tag
-        self.forward = math.atan2(self.front.y - self.centre.y, self.front.x - self.centre.x) # Forward vector
-        self.angle = math.degrees(self.forward) # Angle between forward vector and x-axis
-
 class Robot:
-    def __init__(self, tag, position):
+    """
+    A tracked robot, kept from frame to frame
+
+    Unlike Tag, which is a view into one frame's TagBatch, a Robot is a full object: its pose filter, team, role
+    and zone progress carry over between frames. Only its tag is replaced each frame.
+    """
+    def __init__(self, tag, position, orientation, timestamp, sequence=0):
         self.tag = tag
         self.id = tag.id
         self.position = position
-        self.orientation = tag.angle
+        self.orientation = orientation
+        self.last_seen = timestamp # Capture time of the last frame the robot's tag was seen in
+        self.last_seen_frame = sequence # Sequence number of that frame
+        self.filter = PoseFilter(position.x, position.y, orientation, timestamp) # Smoothed pose and velocity
         self.sensor_range = 0.3 # 30cm sensing radius
         self.neighbours = {}
 
@@ -69,6 +118,8 @@ class Robot:
         self.team = Team.UNASSIGNED
         self.role = Role.NOMAD
         self.ball = None
+        self.strike_goal = None
+        self.defend_goal = None
 
 
 class Ball:
@@ -87,8 +138,8 @@ class Zone:
 
     """
     def __init__(self, x, y, width, height):
-        self.de_jure_robots = []
-        self.rule_breakers = []
+        self.de_jure_robots = set()
+        self.rule_breakers = set()
 
         self.x1 = x
         self.x2 = x + width
@@ -118,7 +169,7 @@ class Zone:
 
 
     def addDeJure(self, robot):
-        self.de_jure_robots.append(robot)
+        self.de_jure_robots.add(robot)
 
     def contains(self, ball):
         ball_x = ball.tag.centre.x
@@ -130,14 +181,16 @@ class Zone:
             return True
         return False
 
-    def buildDeJure(self, robots, red_role, zones):
-        alldejures = []
-        for zone in zones:
-            alldejures += zone.de_jure_robots
+    """
+    Makes the robots inside the zone that don't already belong to a zone belong to this one
 
+    assigned -- IDs of robots that already belong to a zone; updated with the robots added to this zone
+    """
+    def buildDeJure(self, robots, red_role, assigned):
         for id, robot in robots.items():
-            if (self.x1 <= robot.tag.centre.x <= self.x2) and id not in alldejures:
-                self.de_jure_robots.append(id)
+            if (self.x1 <= robot.tag.centre.x <= self.x2) and id not in assigned:
+                self.de_jure_robots.add(id)
+                assigned.add(id)
                 if (robot.team == Team.RED):
                     robot.role = red_role
                 elif (robot.team == Team.BLUE):
@@ -154,18 +207,6 @@ class Zone:
     def getZone(self):
         return (self.x1, self.x2)
 
-    def checkRobots(self, robots):
-        self.rule_breakers = []
-
-        for id, robot in robots.items():
-            if id in self.de_jure_robots:
-
-                if self.x1 > robot.tag.centre.x or robot.tag.centre.x > self.x2:
-
-                    self.rule_breakers.append(id)
-
-        return robots
-
     def assignTeam(self, robots, team):
 
         for id, robot in robots.items():
@@ -186,6 +227,7 @@ class Goal:
         self.score = 0
 
         self.centre = Vector2D((self.x2 - self.x1)/2 + self.x1, (self.y2 - self.y1)/2 + self.y1)
+        self.position = None # Centre in arena coordinates (metres), set once the arena is calibrated
 
     def check(self, ball):
         ball_x = ball.tag.centre.x
@@ -200,6 +242,82 @@ class Goal:
         return False
 
 
+class RobotState:
+    """
+    Copy of a robot's state at the end of one frame
+
+    Only takes references to values the world-model stage replaces rather than changes (positions, readings and
+    the neighbours dictionary are rebuilt every frame), so making one is cheap and it never changes afterwards.
+    """
+    __slots__ = ("id", "tag", "position", "orientation", "estimate", "last_seen", "team", "role", "distance",
+                 "ball", "strike_goal", "defend_goal", "neighbours")
+
+    def __init__(self, robot):
+        self.id = robot.id
+        self.tag = robot.tag
+        self.position = robot.position
+        self.orientation = robot.orientation
+        self.estimate = robot.filter.estimate() # Filtered pose and velocity, for extrapolating
+        self.last_seen = robot.last_seen
+        self.team = robot.team
+        self.role = robot.role
+        self.distance = robot.distance
+        self.ball = robot.ball
+        self.strike_goal = robot.strike_goal
+        self.defend_goal = robot.defend_goal
+        self.neighbours = robot.neighbours
+
+
+class GameState:
+    """
+    Copy of the game's state at the end of one frame, as the render stage draws it
+
+    The timer, scores and rule breakers are copied, and the ball's tag, reset zone and starting positions are
+    replaced rather than changed by the world-model stage, so like a RobotState it never changes afterwards.
+    """
+    __slots__ = ("timer_status", "timer_text", "timer_color", "red_score", "blue_score", "rule_breakers",
+                 "reset_zone", "starting_positions", "ball_tag")
+
+    def __init__(self, tracker):
+        self.timer_status = tracker.timer.status
+        self.timer_text = tracker.timer.getString()
+        self.timer_color = tracker.timer.getColor()
+        self.red_score = tracker.red_goal.score
+        self.blue_score = tracker.blue_goal.score
+        self.rule_breakers = frozenset(tracker.rule_breakers)
+        self.reset_zone = tracker.reset_zone if tracker.gameState == 1 else None # Only while waiting for the ball
+        self.starting_positions = [zone.starting_position for zone in tracker.zones]
+        self.ball_tag = tracker.ball.tag
+
+
+class World:
+    """
+    Output of the world-model stage: a snapshot of the world at the end of one frame
+
+    Nothing in a World changes once it has been published, so the render and publish stages and the websocket
+    handler can read it while the world-model stage moves on to the next frame.
+
+    frame     -- the Frame the world was updated from
+    robots    -- the tracked robots, as RobotStates
+    detected  -- whether any tags were detected in the frame
+    time_left -- seconds left in the game
+    ball      -- ball position in metres
+    game      -- GameState to draw, if the arena is calibrated
+    """
+    def __init__(self, frame, robots, detected, time_left=0, ball=None, game=None):
+        self.frame = frame
+        self.frame_id = frame.sequence
+        self.robots = {id: RobotState(robot) for id, robot in robots.items()}
+        self.detected = detected
+        self.time_left = time_left
+        self.ball = ball
+        self.game = game
+        self.robots_reply = {} # get_robots reply for this world, filled in by the publish stage before publishing
+
+        # Sent with every reply worked out from this world; "published" is filled in by the publish stage
+        self.header = {"frame": self.frame_id, "captured": frame.timestamp, "published": None}
+
+
 class SensorReading:
     def __init__(self, range, bearing, orientation=0, workers=0):
         self.range = range
@@ -208,6 +326,66 @@ class SensorReading:
         self.workers = workers
 
 
+"""
+Range (in metres) and bearing (in degrees, relative to orientation) from a robot at (x, y) to target
+"""
+def rangeAndBearing(x, y, orientation, target):
+    range = math.hypot(target.x - x, target.y - y)
+    absolute_bearing = math.degrees(math.atan2(target.y - y, target.x - x))
+    relative_bearing = absolute_bearing - orientation
+    return range, angles.normalize(relative_bearing, -180, 180)
+
+"""
+Fills in every robot's neighbour, ball and goal readings from one set of range and bearing matrices
+
+robots    -- dictionary of robots by ID
+ball      -- ball position in metres
+red_goal  -- red goal centre in metres
+blue_goal -- blue goal centre in metres
+"""
+def senseRobots(robots, ball, red_goal, blue_goal):
+    if not robots:
+        return
+
+    ids = list(robots.keys())
+    members = list(robots.values())
+    positions = np.array([(robot.position.x, robot.position.y) for robot in members])
+    orientations = np.array([robot.orientation for robot in members])
+    landmarks = np.array([(ball.x, ball.y), (red_goal.x, red_goal.y), (blue_goal.x, blue_goal.y)])
+
+    # Converted to lists once, as indexing Python lists is much cheaper than indexing arrays element by element
+    (ranges, bearings) = rangesAndBearings(positions, orientations, positions)
+    ranges = ranges.tolist()
+    bearings = bearings.tolist()
+    (landmark_ranges, landmark_bearings) = rangesAndBearings(positions, orientations, landmarks)
+    landmark_ranges = landmark_ranges.tolist()
+    landmark_bearings = landmark_bearings.tolist()
+    orientations = orientations.tolist()
+
+    for i, robot in enumerate(members):
+        neighbours = {} # Built afresh, so robots that have been evicted are no longer anyone's neighbour
+        robot_ranges = ranges[i]
+        robot_bearings = bearings[i]
+
+        for j, other_id in enumerate(ids):
+            if i != j:  # Don't check this robot against itself
+                neighbours[other_id] = SensorReading(robot_ranges[j], robot_bearings[j], orientations[j])
+
+        (ball_range, goal1_range, goal2_range) = landmark_ranges[i]
+        (ball_bearing, goal1_bearing, goal2_bearing) = landmark_bearings[i]
+        robot.neighbours = neighbours
+        robot.ball = SensorReading(ball_range, ball_bearing)
+        goal1 = SensorReading(goal1_range, goal1_bearing)
+        goal2 = SensorReading(goal2_range, goal2_bearing)
+
+        if robot.team == Team.BLUE:
+            robot.strike_goal = goal1
+            robot.defend_goal = goal2
+        else:
+            robot.strike_goal = goal2
+            robot.defend_goal = goal1
+
+
 class TimerStatus(Enum):
     STOPPED = 0
     STARTED = 1
@@ -274,10 +452,24 @@ class Timer:
 class Tracker(threading.Thread):
 
 
-    def __init__(self):
+    """
+    headless     -- don't open a preview window or listen to the keyboard, unless preview_rate is set
+    preview_rate -- maximum preview frames per second (0 for every frame)
+    source       -- None for the live camera, or a video file or directory of images to replay
+    realtime     -- replay recordings at their recorded rate rather than as fast as possible
+    """
+    def __init__(self, headless=False, preview_rate=0, source=None, realtime=True):
 
         threading.Thread.__init__(self)
-        self.camera = Camera()
+        self.headless = headless
+        self.preview_rate = preview_rate
+        # The detector comes first, so any worker processes it starts are not created while the camera thread runs
+        self.detector = make_detector(DETECTION_MODE, full_scan_interval=FULL_SCAN_INTERVAL,
+                                      tiles=DETECTION_TILES, overlap=TILE_OVERLAP, scale=DETECTION_SCALE)
+        self.camera = make_source(source, realtime, threaded=THREADED_CAPTURE)
+        self.realtime = realtime or source is None
+        self.finished = threading.Event() # Set at the end of a recorded frame source, or to shut the tracker down
+        self.end_of_source = False # Whether the recording being replayed has run out
         self.calibrated = False
         self.num_corner_tags = 0
         self.min_x = 0 # In pixels
@@ -287,110 +479,174 @@ class Tracker(threading.Thread):
         self.centre = Vector2D(0, 0) # In metres
         self.corner_distance_metres = 2.06 # Euclidean distance between corner tags in metres
         self.corner_distance_pixels = 0
+        self.homography = None # Perspective transform from pixels to arena coordinates in metres
+        self.frame_timestamp = 0 # Capture time of the frame being processed
+        self.frame_sequence = 0 # Camera sequence number of the frame being processed
         self.scale_factor = 0
         self.robots = {}
+        self.evicted = {} # (team, role) of evicted robots by ID, given back if their tags are seen again
+        self.world = None # Newest output of the world-model stage
+        self.snapshot = None # Newest published World, with its get_robots reply; replaced, never changed
+        self.subscriptions = None # Clients the websocket server pushes every published World to
+        self.pending_commands = queue.Queue() # Operator commands, applied by the world-model stage
+        self.stages = []
+        self.latency = {"processArUco": LatencyHistogram(), # Steps within the world-model stage
+                        "processRobots": LatencyHistogram(),
+                        "processGame": LatencyHistogram()}
 
         self.red_goal = None
         self.blue_goal = None
         self.ball = None
         self.zones = []
+        self.rule_breakers = set() # IDs of robots outside the zone they belong to, in any zone
         self.gameState = 0
         self.timer = Timer(GAME_TIME)
         self.roboteams = {}
 
 
 
-        listener = keyboard.Listener(
-            on_press=self.on_press)
-        listener.start()
+        if keyboard is not None and not self.headless:
+            listener = keyboard.Listener(
+                on_press=self.on_press)
+            listener.start()
 
     def on_press(self, key):
         try:
-            if key.char == 'p':
-                if self.timer.status == TimerStatus.PAUSED:
-                    self.timer.unpause()
-                else:
-                    self.timer.pause()
-            if key.char == 'l':
-
-                for zone in self.zones:
-                    print(zone.rule_breakers, zone.x1, zone.x2)
-                    print(zone.de_jure_robots)
-                    for id, robot in self.robots.items():
-                        print(id, robot.role)
-            if key.char == 'b':
-                newzones = []
-                zone_role = 0
-                for zone in self.zones:
-                    zone.de_jure_robots = []
-                    self.robots = zone.buildDeJure(self.robots, Role(zone_role), newzones)
-                    zone_role += 1
-                    newzones.append(zone)
-                self.zones = newzones
-            if key.char == 't':
-                self.robots = self.zones[0].assignTeam(self.robots, Team.RED)
-                self.robots = self.zones[len(self.zones)-1].assignTeam(self.robots, Team.BLUE)
-
-            if key.char == 'r':
-                self.timer = Timer(GAME_TIME)
-                # self.timer.start()
-                # self.timer.pause()
-                self.red_goal.score = 0
-                self.blue_goal.score = 0
-                self.gameState = 1
-                self.reset_zone = Zone((self.max_x - self.min_x) / 2 - 75 + self.min_x,
-                                       (self.max_y - self.min_y) / 2 + self.min_y - 75, 150, 150)
-                self.robots = {}
-                for zone in self.zones:
-                    zone.de_jure_robots = []
-
-            if key.char == 'x':
-                for zone in self.zones:
-                    zone.starting_position = zone.randomise_starting_positions()
-
-            if key.char == '[':
-                self.blue_goal.score -= 1
-            elif key.char == ']':
-                self.blue_goal.score += 1
-            elif key.char == ',':
-                self.red_goal.score -= 1
-            elif key.char == '.':
-                self.red_goal.score += 1
+            self.command(key.char)
         except AttributeError as e:
             print('special key {0} pressed'.format(
                 key))
             print(e)
+
+    """
+    Queues an operator command for the world-model stage, returning whether it was recognised
+
+    Commands come from the keyboard listener and the websocket server, but change the robots and zones the
+    world-model stage is working on, so they are only applied by that stage, between frames (see applyCommands).
+
+    key -- the key bound to the command, or its name in COMMANDS
+
+    Raises ValueError if key is not a string.
+    """
+    def command(self, key):
+        if not isinstance(key, str):
+            raise ValueError(f"command must be a string, not {key!r}")
+        key = COMMANDS.get(key, key)
+        if key not in COMMANDS.values():
+            return False
+        self.pending_commands.put(key)
+        return True
+
+    """
+    Runs the operator commands queued since the last frame
+    """
+    def applyCommands(self):
+        while True:
+            try:
+                key = self.pending_commands.get_nowait()
+            except queue.Empty:
+                return
+            self.runCommand(key)
+
+    def runCommand(self, key):
+        if key == 'p':
+            if self.timer.status == TimerStatus.PAUSED:
+                self.timer.unpause()
+            else:
+                self.timer.pause()
+        if key == 'l':
+
+            for zone in self.zones:
+                print(zone.rule_breakers, zone.x1, zone.x2)
+                print(zone.de_jure_robots)
+                for id, robot in self.robots.items():
+                    print(id, robot.role)
+        if key == 'b':
+            assigned = set()
+            zone_role = 0
+            for zone in self.zones:
+                zone.de_jure_robots = set()
+                self.robots = zone.buildDeJure(self.robots, Role(zone_role), assigned)
+                zone_role += 1
+        if key == 't':
+            self.robots = self.zones[0].assignTeam(self.robots, Team.RED)
+            self.robots = self.zones[len(self.zones)-1].assignTeam(self.robots, Team.BLUE)
+
+        if key == 'r':
+            self.timer = Timer(GAME_TIME)
+            # self.timer.start()
+            # self.timer.pause()
+            self.red_goal.score = 0
+            self.blue_goal.score = 0
+            self.gameState = 1
+            self.reset_zone = Zone((self.max_x - self.min_x) / 2 - 75 + self.min_x,
+                                   (self.max_y - self.min_y) / 2 + self.min_y - 75, 150, 150)
+            self.robots = {}
+            self.evicted = {}
+            for zone in self.zones:
+                zone.de_jure_robots = set()
+
+        if key == 'x':
+            for zone in self.zones:
+                zone.starting_position = zone.randomise_starting_positions()
+
+        if key == '[':
+            self.blue_goal.score -= 1
+        elif key == ']':
+            self.blue_goal.score += 1
+        elif key == ',':
+            self.red_goal.score -= 1
+        elif key == '.':
+            self.red_goal.score += 1
+
     """
     processes raw tags and updates self.robots to contain a dictionary of all visible robots and their IDs
     
     tag_ids
     raw_tags -- 
+    timestamp -- capture time of the frame the tags were detected in
+    sequence  -- sequence number of that frame
     List reserved_tags -- List of tags the process should skip (E.g. The corner tags and the ball)
     """
-    def processArUco(self, tag_ids, raw_tags):
-        for id, raw_tag in zip(tag_ids, raw_tags):
-
-            tag = Tag(id, raw_tag)
-
-            if self.calibrated:
-                if (tag.id == self.ball.id):
-                    position = Vector2D(tag.centre.x / self.scale_factor,
-                                        tag.centre.y / self.scale_factor)
-                    self.ball.position = position
-                    self.ball.tag = tag
-
-                if (tag.id not in [0, self.ball.id]):  # Reserved tag ID for corners and for ball
-                    position = Vector2D(tag.centre.x / self.scale_factor,
-                                        tag.centre.y / self.scale_factor)  # Convert pixel coordinates to metres
-                    if (tag.id in self.robots.keys()):
-                        self.robots[tag.id].position = position
-                        self.robots[id].orientation = tag.angle
-                        self.robots[id].tag = tag
+    def processArUco(self, tag_ids, raw_tags, timestamp, sequence=0):
+        tags = TagBatch(tag_ids, raw_tags)
+
+        if not self.calibrated:  # Only calibrate the first time all four corner tags are detected
+            self.calibrate(tags)
+            if not self.calibrated:
+                return
+
+        # Convert pixel coordinates to metres and headings to arena coordinates, all tags at once
+        (positions, headings) = tags.transform(self.homography)
+        positions = positions.tolist()
+        headings = headings.tolist()
+
+        for index, id in enumerate(tags.ids_list):
+
+            (x, y) = positions[index]
+
+            if (id == self.ball.id):
+                self.ball.position = Vector2D(x, y)
+                self.ball.tag = tags.tag(index)
+
+            if (id not in [0, self.ball.id]):  # Reserved tag ID for corners and for ball
+                if (id in self.robots.keys()):
+                    robot = self.robots[id]
+                    robot.tag = tags.tag(index)
+                    robot.last_seen = timestamp
+                    robot.last_seen_frame = sequence
+                    robot.filter.update(x, y, headings[index], timestamp)
+                    if FILTER_POSES:
+                        robot.position = Vector2D(robot.filter.x.value, robot.filter.y.value)
+                        robot.orientation = robot.filter.orientation.value
                     else:
-                        self.robots[id] = Robot(tag, position)
+                        robot.position = Vector2D(x, y)
+                        robot.orientation = headings[index]
+                else:
+                    self.robots[id] = Robot(tags.tag(index), Vector2D(x, y), headings[index], timestamp, sequence)
+                    if id in self.evicted: # Back after being hidden; keep the team and role the operator gave it
+                        (self.robots[id].team, self.robots[id].role) = self.evicted.pop(id)
 
-            else:  # Only calibrate the first time two corner tags are detected
-                self.calibrate(tag)
     """
     Defines an amount of uniformly sized, uniformly spaced Zones equal to the zone_amount
     
@@ -417,15 +673,16 @@ class Tracker(threading.Thread):
     
     image -- camera image for the zones to be drawn on top of.
     """
-    def drawZones(self, image):
+    def drawZones(self, image, game):
         colors = [red, grey, blue]
         for zone_index in range(len(self.zones)):
             zone = self.zones[zone_index]
             cv2.rectangle(image, (int(zone.x1), zone.y1), (int(zone.x2), zone.y2), colors[zone_index % len(colors)], 3, lineType=cv2.LINE_AA)
 
-            if self.timer.status == TimerStatus.STOPPED:
-                cv2.circle(image, (int(zone.starting_position[0]), int(zone.starting_position[1])), 25, red, -1, lineType=cv2.LINE_AA)
-                cv2.circle(image, (int(self.min_x + self.max_x - zone.starting_position[0]), int(self.min_y + self.max_y - zone.starting_position[1])), 25, blue, -1, lineType=cv2.LINE_AA)
+            if game.timer_status == TimerStatus.STOPPED:
+                starting_position = game.starting_positions[zone_index]
+                cv2.circle(image, (int(starting_position[0]), int(starting_position[1])), 25, red, -1, lineType=cv2.LINE_AA)
+                cv2.circle(image, (int(self.min_x + self.max_x - starting_position[0]), int(self.min_y + self.max_y - starting_position[1])), 25, blue, -1, lineType=cv2.LINE_AA)
 
 
     def defineGoals(self, goal_width, goal_height):
@@ -436,6 +693,10 @@ class Tracker(threading.Thread):
         x = self.max_x - goal_width
         self.blue_goal = Goal(int(x), int(y), goal_width, goal_height)
 
+        # Goal centres never move, so they are only converted to metres once
+        self.red_goal.position = self.toArena(self.red_goal.centre.x, self.red_goal.centre.y)
+        self.blue_goal.position = self.toArena(self.blue_goal.centre.x, self.blue_goal.centre.y)
+
     def drawGoals(self, image):
         cv2.rectangle(image, (self.red_goal.x1, self.red_goal.y1), (self.red_goal.x2, self.red_goal.y2), red,
                       3, lineType=cv2.LINE_AA)
@@ -444,47 +705,71 @@ class Tracker(threading.Thread):
 
 
     """
-    Calibrates the play area ready for a match
-    
-    tag -- a tag of ID=0
-    """
-    def calibrate(self, tag):
-        if tag.id == PUCK_ID:
-            self.ball = Ball(Vector2D(0, 0), tag)
-
-        if tag.id == 0:  # Reserved tag ID for corners
-
-            if self.num_corner_tags == 0:  # Record the first corner tag detected
-                self.min_x = tag.centre.x
-                self.max_x = tag.centre.x
-                self.min_y = tag.centre.y
-                self.max_y = tag.centre.y
-            else:  # Set min/max boundaries of arena based on second corner tag detected
+    Calibrates the play area ready for a match, once the ball and all four corner tags are seen in one frame
 
-                if tag.centre.x < self.min_x:
-                    self.min_x = tag.centre.x
-                if tag.centre.x > self.max_x:
-                    self.max_x = tag.centre.x
-                if tag.centre.y < self.min_y:
-                    self.min_y = tag.centre.y
-                if tag.centre.y > self.max_y:
-                    self.max_y = tag.centre.y
+    Fits a perspective transform (homography) from the corner tags' pixel positions to the arena in metres, so
+    that positions near the edges of the arena are not distorted by the camera's perspective. The arena is
+    scaled so that the distance between opposite corner tags is corner_distance_metres.
 
-                self.corner_distance_pixels = math.dist([self.min_x, self.min_y], [self.max_x,
-                                                                                   self.max_y])  # Euclidean distance between corner tags in pixels
-                self.scale_factor = self.corner_distance_pixels / self.corner_distance_metres
-                x = ((self.max_x - self.min_x) / 2) / self.scale_factor  # Convert to metres
-                y = ((self.max_y - self.min_y) / 2) / self.scale_factor  # Convert to metres
-                self.centre = Vector2D(x, y)
-
-                self.defineZones(3)
-                self.defineGoals(int((self.max_x - self.min_x) / 7), int((self.max_y - self.min_y) / 2))
+    tags -- TagBatch of the tags detected in a frame
+    """
+    def calibrate(self, tags):
+        for index, id in enumerate(tags.ids_list):
+            if id == PUCK_ID:
+                self.ball = Ball(Vector2D(0, 0), tags.tag(index))
+
+        corners = tags.raw_corners[tags.ids == 0].mean(axis=1)  # Reserved tag ID for corners
+        self.num_corner_tags = len(corners)
+        if self.num_corner_tags != 4 or self.ball is None:
+            return
+
+        # Order the corners: top left has the smallest x + y, bottom right the largest; top right has the
+        # smallest y - x, bottom left the largest
+        total = corners.sum(axis=1)
+        difference = corners[:, 1] - corners[:, 0]
+        corners = np.array([corners[np.argmin(total)], corners[np.argmin(difference)],
+                            corners[np.argmax(total)], corners[np.argmax(difference)]], dtype=np.float32)
+
+        # Min/max boundaries of the arena in pixels
+        self.min_x = int(corners[:, 0].min())
+        self.max_x = int(corners[:, 0].max())
+        self.min_y = int(corners[:, 1].min())
+        self.max_y = int(corners[:, 1].max())
+
+        self.corner_distance_pixels = math.dist([self.min_x, self.min_y], [self.max_x, self.max_y])  # Euclidean distance between corner tags in pixels
+        self.scale_factor = self.corner_distance_pixels / self.corner_distance_metres  # Pixels per metre
+
+        # Map the corners onto a rectangle in metres, with the same origin and scale as the camera image
+        arena = np.array([[self.min_x, self.min_y], [self.max_x, self.min_y],
+                          [self.max_x, self.max_y], [self.min_x, self.max_y]], dtype=np.float32) / self.scale_factor
+        self.homography = cv2.getPerspectiveTransform(corners, arena)
+        self.centre = self.toArena((self.min_x + self.max_x) / 2, (self.min_y + self.max_y) / 2)
+
+        self.defineZones(3)
+        self.defineGoals(int((self.max_x - self.min_x) / 7), int((self.max_y - self.min_y) / 2))
+
+        self.calibrated = True
 
+    """
+    Converts one point from pixels to arena coordinates in metres
+    """
+    def toArena(self, x, y):
+        (x, y, w) = self.homography @ (x, y, 1)
+        return Vector2D(float(x / w), float(y / w))
 
-                self.calibrated = True
+    """
+    Forgets robots whose tags have not been seen for more than ROBOT_TTL seconds
 
+    Their team and role are set once by the operator, so they are kept in self.evicted and given back if the
+    robot is seen again (e.g. after being hidden by a hand placing the ball).
 
-            self.num_corner_tags = self.num_corner_tags + 1
+    timestamp -- capture time of the current frame
+    """
+    def evictRobots(self, timestamp):
+        expired = [id for id, robot in self.robots.items() if timestamp - robot.last_seen > ROBOT_TTL]
+        for id in expired:
+            self.evicted[id] = (self.robots[id].team, self.robots[id].role)
+            del self.robots[id]
 
     """
         Backend processing for the robots.
@@ -493,59 +778,55 @@ class Tracker(threading.Thread):
     """
 
     def processRobots(self):
-        for id, robot in self.robots.items():
-
-            for other_id, other_robot in self.robots.items():
-
-                if id != other_id:  # Don't check this robot against itself
-
-                    range = robot.position.distance_to(other_robot.position)
-
-                    absolute_bearing = math.degrees(math.atan2(other_robot.position.y - robot.position.y,
-                                                               other_robot.position.x - robot.position.x))
-                    relative_bearing = absolute_bearing - robot.orientation
-                    normalised_bearing = angles.normalize(relative_bearing, -180, 180)
-                    robot.neighbours[other_id] = SensorReading(range, normalised_bearing, other_robot.orientation)
-
-            range = robot.position.distance_to(self.ball.position)
-            absolute_bearing = math.degrees(math.atan2(self.ball.position.y - robot.position.y,
-                                                       self.ball.position.x - robot.position.x))
-            relative_bearing = absolute_bearing - robot.orientation
-            normalised_bearing = angles.normalize(relative_bearing, -180, 180)
-            robot.ball = SensorReading(range, normalised_bearing)
+        senseRobots(self.robots, self.ball.position, self.red_goal.position, self.blue_goal.position)
+        self.processZones()
 
+    """
+    Classifies every robot's x-position against every zone's bounds in one step, then works out each zone's
+    rule breakers and each robot's progress through the zone it belongs to
+    """
+    def processZones(self):
+        if not self.robots or not self.zones:
             for zone in self.zones:
-                if id in zone.de_jure_robots:
-                    robot.distance = (robot.tag.centre.x - zone.x1) / zone.width
-                    if self.robots[id].team == Team.BLUE:
-                        robot.distance = 1 - robot.distance
-                    break
-            else:
-                robot.distance = 0  # this is not special its just here to hopefully avoid future errors
-
-
-            range = robot.position.distance_to(self.red_goal.centre / self.scale_factor)
-            absolute_bearing = math.degrees(math.atan2((self.red_goal.centre.y / self.scale_factor) - robot.position.y,
-                                                       (self.red_goal.centre.x / self.scale_factor) - robot.position.x))
-            relative_bearing = absolute_bearing - robot.orientation
-            normalised_bearing = angles.normalize(relative_bearing, -180, 180)
-            goal1 = SensorReading(range, normalised_bearing)
-
-            range = robot.position.distance_to(self.blue_goal.centre / self.scale_factor)
-            absolute_bearing = math.degrees(math.atan2((self.blue_goal.centre.y / self.scale_factor) - robot.position.y,
-                                                       (self.blue_goal.centre.x / self.scale_factor) - robot.position.x))
-            relative_bearing = absolute_bearing - robot.orientation
-            normalised_bearing = angles.normalize(relative_bearing, -180, 180)
-            goal2 = SensorReading(range, normalised_bearing)
-
-            if robot.team == Team.BLUE:
-                robot.strike_goal = goal1
-                robot.defend_goal = goal2
-            else:
-                robot.strike_goal = goal2
-                robot.defend_goal = goal1
-
-
+                zone.rule_breakers = set()
+            self.rule_breakers = set()
+            for robot in self.robots.values():
+                robot.distance = 0
+            return
+
+        ids = list(self.robots.keys())
+        robots = list(self.robots.values())
+        xs = np.array([robot.tag.centre.x for robot in robots], dtype=np.float64)
+        starts = np.array([zone.x1 for zone in self.zones], dtype=np.float64)
+        ends = np.array([zone.x2 for zone in self.zones], dtype=np.float64)
+        widths = np.array([zone.width for zone in self.zones], dtype=np.float64)
+
+        # Index of the zone each robot belongs to, or -1
+        zone_of = {}
+        for index, zone in enumerate(self.zones):
+            for id in zone.de_jure_robots:
+                zone_of[id] = index
+        home = np.array([zone_of.get(id, -1) for id in ids])
+        belongs = home >= 0
+        home = np.maximum(home, 0) # So that robots without a zone can still index the arrays below
+
+        inside = (starts[home] <= xs) & (xs <= ends[home])
+        breaking = belongs & ~inside
+
+        progress = (xs - starts[home]) / widths[home]
+        blue = np.array([robot.team == Team.BLUE for robot in robots])
+        progress = np.where(blue, 1 - progress, progress)
+        progress = np.where(belongs, progress, 0)  # this is not special its just here to hopefully avoid future errors
+
+        for robot, distance in zip(robots, progress.tolist()):
+            robot.distance = distance
+
+        rule_breakers = [set() for zone in self.zones]
+        for i in np.flatnonzero(breaking).tolist():
+            rule_breakers[int(home[i])].add(ids[i])
+        for zone, breakers in zip(self.zones, rule_breakers):
+            zone.rule_breakers = breakers
+        self.rule_breakers = set().union(*rule_breakers)
 
     """
     Draws bounding box of the arena.
@@ -558,10 +839,12 @@ class Tracker(threading.Thread):
     """
     Responsible for drawing any UI element associated with the robots.
     
-    image -- The camera image for the robots to be drawn onto
+    image         -- The camera image for the robots to be drawn onto
+    robots        -- The robots to draw, as published by the world-model stage
+    rule_breakers -- IDs of the robots to mark as outside their zone
     """
-    def drawRobots(self, image):
-        for id, robot in self.robots.items():
+    def drawRobots(self, image, robots, rule_breakers):
+        for id, robot in robots.items():
 
             # Draw tag
             tag = robot.tag
@@ -583,12 +866,7 @@ class Tracker(threading.Thread):
 
             # Draw tag ID
 
-            for zone in self.zones:
-                if id in zone.rule_breakers:
-                    text2 = "X"
-                    break
-            else:
-                text2 = ""
+            text2 = "X" if id in rule_breakers else ""
 
             text = robot.role.name
             # text3 = str(round(robot.distance, 2))
@@ -619,45 +897,42 @@ class Tracker(threading.Thread):
                      lineType=cv2.LINE_AA)
 
 
-    def drawBall(self, image):
-        cv2.circle(image, (self.ball.tag.centre.x, self.ball.tag.centre.y), 5, red, -1, lineType=cv2.LINE_AA)
+    def drawBall(self, image, tag):
+        cv2.circle(image, (tag.centre.x, tag.centre.y), 5, red, -1, lineType=cv2.LINE_AA)
 
         text = "BALL"
         font = cv2.FONT_HERSHEY_SIMPLEX
         font_scale = 1.5
         thickness = 4
         textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
-        position = (int(self.ball.tag.centre.x - textsize[0] / 2), int(self.ball.tag.centre.y + textsize[1] / 2))
+        position = (int(tag.centre.x - textsize[0] / 2), int(tag.centre.y + textsize[1] / 2))
 
         cv2.putText(image, text, position, font, font_scale, white, thickness * 3, cv2.LINE_AA)
         cv2.putText(image, text, position, font, font_scale, green, thickness, cv2.LINE_AA)
 
 
-    def processGame(self, image):
-        newzones = []
-        for zone in self.zones:
-            zone.checkRobots(self.robots)
-            newzones.append(zone)
-        self.zones = newzones
-
+    def processGame(self):
         if self.timer.status != TimerStatus.PAUSED and self.timer.status != TimerStatus.COMPLETE:
             if self.blue_goal.check(self.ball) or self.red_goal.check(self.ball):
                 self.timer.pause()
                 self.gameState = 1
                 self.reset_zone = Zone((self.max_x - self.min_x)/2 - 75 + self.min_x, (self.max_y - self.min_y)/2 + self.min_y - 75, 150, 150)
         if (self.timer.status == TimerStatus.PAUSED or self.timer.status == TimerStatus.STOPPED) and self.gameState == 1:
-            cv2.rectangle(image, (int(self.reset_zone.x1), int(self.reset_zone.y1)),
-                          (int(self.reset_zone.x2), int(self.reset_zone.y2)),
-                          green, 2, lineType=cv2.LINE_AA)
             if self.reset_zone.contains(self.ball):
                 self.timer.unpause()
                 self.gameState = 0
-        elif self.timer.status == TimerStatus.COMPLETE:
-            if self.blue_goal.score > self.red_goal.score:
+
+    def drawGame(self, image, game):
+        if (game.timer_status == TimerStatus.PAUSED or game.timer_status == TimerStatus.STOPPED) and game.reset_zone is not None:
+            cv2.rectangle(image, (int(game.reset_zone.x1), int(game.reset_zone.y1)),
+                          (int(game.reset_zone.x2), int(game.reset_zone.y2)),
+                          green, 2, lineType=cv2.LINE_AA)
+        elif game.timer_status == TimerStatus.COMPLETE:
+            if game.blue_score > game.red_score:
                 # red wins
                 text = "RED WINS"
                 tcolor = red
-            elif self.red_goal.score > self.blue_goal.score:
+            elif game.red_score > game.blue_score:
                 # blue wins
                 text = "BLUE WINS"
                 tcolor = blue
@@ -680,142 +955,526 @@ class Tracker(threading.Thread):
             cv2.putText(image, text, position, font, font_scale * 3, tcolor, thickness * 3, cv2.LINE_AA)
             cv2.putText(image, text, position, font, font_scale * 3, black, thickness, cv2.LINE_AA)
 
-    def run(self):
-        while True:        
-            image = self.camera.get_frame()
-            overlay = image.copy()
-            
-            aruco_dictionary = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_100)
-            aruco_parameters = cv2.aruco.DetectorParameters_create()
-
-            (raw_tags, tag_ids, rejected) = cv2.aruco.detectMarkers(image, aruco_dictionary, parameters=aruco_parameters)
+    """
+    Capture stage: waits for a frame newer than the last one; in threaded capture mode older frames are dropped
+    """
+    def capture(self, item):
+        image, timestamp, sequence, dropped = self.camera.get_frame(block=True)
+        if image is None: # End of a recording
+            self.end_of_source = True
+            self.finished.set()
+            return None
+        return Frame(image, timestamp, sequence)
 
-            # self.robots = {} # Clear dictionary every frame in case robots have disappeared
+    """
+    Detection stage
+    """
+    def detect(self, frame):
+        (frame.raw_tags, frame.tag_ids) = self.detector.detect(frame.image)
+        return frame
 
-            # Check whether any tags were detected in this camera frame
-            if tag_ids is not None and len(tag_ids.tolist()) > 0:
+    """
+    World-model stage: updates robots, virtual sensors and the game from the detected tags
+    """
+    def updateWorld(self, frame):
+        self.applyCommands()
 
-                tag_ids = list(itertools.chain(*tag_ids))
-                tag_ids = [int(id) for id in tag_ids] # Convert from numpy.int32 to int
+        tag_ids = frame.tag_ids
+        detected = False
 
-                # Process raw ArUco output
-                self.processArUco(tag_ids, raw_tags)
+        # Check whether any tags were detected in this camera frame
+        if tag_ids is not None and len(tag_ids) > 0:
 
-                # Draw boundary of virtual environment based on corner tag positions
-                self.drawBoundingBox(image)
+            # Process raw ArUco output
+            start = time.perf_counter()
+            self.processArUco(tag_ids, frame.raw_tags, frame.timestamp, frame.sequence)
+            self.latency["processArUco"].record(time.perf_counter() - start)
 
-                # Process and draw robots
+            if self.calibrated:
+                detected = True
+                start = time.perf_counter()
                 self.processRobots()
+                self.latency["processRobots"].record(time.perf_counter() - start)
 
+                start = time.perf_counter()
+                self.timer.update()
+                self.processGame()
+                self.latency["processGame"].record(time.perf_counter() - start)
 
+        # Robots that have left the arena or lost their tag are dropped, rather than served with a stale pose forever
+        self.evictRobots(frame.timestamp)
 
-                self.drawZones(image)
-                self.drawGoals(image)
+        self.frame_timestamp = frame.timestamp
+        self.frame_sequence = frame.sequence
+        ball = self.ball.position if self.ball is not None else None
+        game = GameState(self) if detected else None # Only drawn once the arena is calibrated
+        self.world = World(frame, self.robots, detected, self.timer.time_left, ball, game)
+        return self.world
 
-                self.timer.update()
-                self.drawBall(image)
-                self.drawRobots(image)
-                self.processGame(image)
+    """
+    Render stage: draws the newest world state and shows it
+
+    Everything that changes during a game is drawn from the World, never from the tracker, which the world-model
+    stage is already updating for the next frame. Only the arena, zone and goal outlines, which are fixed at
+    calibration, come from the tracker.
+    """
+    def render(self, world):
+        image = world.frame.image
+        game = world.game
+
+        if world.detected:
+            overlay = image.copy()
 
-                cv2.circle(image, (int(self.red_goal.centre.x), int(self.red_goal.centre.y)), 5, red, -1, lineType=cv2.LINE_AA)
-                cv2.circle(image, (int(self.blue_goal.centre.x), int(self.blue_goal.centre.y)), 5, blue, -1,
-                           lineType=cv2.LINE_AA)
+            # Draw boundary of virtual environment based on corner tag positions
+            self.drawBoundingBox(image)
 
-                text = f"Time: {self.timer.getString()}"
-                red_sc = str(self.blue_goal.score) # THIS IS CORRECT
-                blu_sc = str(self.red_goal.score)
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                font_scale = 2
-                thickness = 5
-                textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
-                position = (790, 60)
-                cv2.putText(image, text, position, font, font_scale, self.timer.getColor(), thickness * 3, cv2.LINE_AA)
-                cv2.putText(image, text, position, font, font_scale, black, thickness, cv2.LINE_AA)
+            self.drawZones(image, game)
+            self.drawGoals(image)
 
-                cv2.putText(image, blu_sc, (self.blue_goal.x2 - 40, 1000), font, font_scale * 2, white, thickness * 3, cv2.LINE_AA)
-                cv2.putText(image, red_sc, (self.red_goal.x1 - 40, 1000), font, font_scale * 2, white, thickness * 3, cv2.LINE_AA)
+            self.drawBall(image, game.ball_tag)
+            self.drawRobots(image, world.robots, game.rule_breakers)
+            self.drawGame(image, game)
 
-                cv2.putText(image, blu_sc, (self.blue_goal.x2 - 40, 1000), font, font_scale * 2, blue, thickness,
-                            cv2.LINE_AA)
-                cv2.putText(image, red_sc, (self.red_goal.x1 - 40, 1000), font, font_scale * 2, red, thickness,
-                            cv2.LINE_AA)
+            cv2.circle(image, (int(self.red_goal.centre.x), int(self.red_goal.centre.y)), 5, red, -1, lineType=cv2.LINE_AA)
+            cv2.circle(image, (int(self.blue_goal.centre.x), int(self.blue_goal.centre.y)), 5, blue, -1,
+                       lineType=cv2.LINE_AA)
 
-                # Transparency for overlaid augments
-                alpha = 0.3
-                image = cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0)
+            text = f"Time: {game.timer_text}"
+            red_sc = str(game.blue_score) # THIS IS CORRECT
+            blu_sc = str(game.red_score)
+            font = cv2.FONT_HERSHEY_SIMPLEX
+            font_scale = 2
+            thickness = 5
+            textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
+            position = (790, 60)
+            cv2.putText(image, text, position, font, font_scale, game.timer_color, thickness * 3, cv2.LINE_AA)
+            cv2.putText(image, text, position, font, font_scale, black, thickness, cv2.LINE_AA)
 
-            window_name = 'SwarmHack'
+            cv2.putText(image, blu_sc, (self.blue_goal.x2 - 40, 1000), font, font_scale * 2, white, thickness * 3, cv2.LINE_AA)
+            cv2.putText(image, red_sc, (self.red_goal.x1 - 40, 1000), font, font_scale * 2, white, thickness * 3, cv2.LINE_AA)
 
-            # screen = screeninfo.get_monitors()[0]
-            # width, height = screen.width, screen.height
-            # image = cv2.resize(image, (width, height))
-            # cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
-            # cv2.setWindowProperty(window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+            cv2.putText(image, blu_sc, (self.blue_goal.x2 - 40, 1000), font, font_scale * 2, blue, thickness,
+                        cv2.LINE_AA)
+            cv2.putText(image, red_sc, (self.red_goal.x1 - 40, 1000), font, font_scale * 2, red, thickness,
+                        cv2.LINE_AA)
 
-            cv2.imshow(window_name, image)
+            # Transparency for overlaid augments
+            alpha = 0.3
+            image = cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0)
 
-            # TODO: Fix quitting with Q (necessary for fullscreen mode)
+        window_name = 'SwarmHack'
 
+        # screen = screeninfo.get_monitors()[0]
+        # width, height = screen.width, screen.height
+        # image = cv2.resize(image, (width, height))
+        # cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
+        # cv2.setWindowProperty(window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
 
-            if cv2.waitKey(1) == ord('q'):
-                sys.exit(1)
+        cv2.imshow(window_name, image)
+
+        # Quitting with Q stops the whole tracker; this is a stage thread, so exiting here would only stop the preview
+        if cv2.waitKey(1) == ord('q'):
+            self.finished.set()
+
+    """
+    Builds the get_robots reply for a world state
+
+    world      -- the world state to describe
+    query_time -- if given, every robot's pose is extrapolated to this time (seconds since the epoch) with its
+                  pose filter, and orientations, ranges and bearings are worked out from the extrapolated poses
+    ids        -- if given, only describe the robots with these IDs
+    fields     -- if given, only work out these groups of fields (see FIELD_GROUPS)
+
+    Each robot's pose_age is how long before the world's frame (or query_time) its tag was last seen, in seconds.
+    """
+    def buildRobotsReply(self, world, query_time=None, ids=None, fields=None):
+        reference_time = query_time if query_time is not None else world.frame.timestamp
+        groups = FIELD_GROUPS.keys() if fields is None else set(fields)
+        robots = world.robots if ids is None else {id: world.robots[id] for id in ids if id in world.robots}
+
+        if query_time is not None:
+            poses = {} # Extrapolated poses, worked out only for the robots that need them
+            red_goal = self.red_goal.position
+            blue_goal = self.blue_goal.position
 
-async def handler(websocket):
-    async for packet in websocket:
-        message = json.loads(packet)
-        
-        # Process any requests received
         reply = {}
-        send_reply = False
-        if tracker.calibrated:
-            if "check_awake" in message:
-                reply["awake"] = True
-                send_reply = True
+        for id, robot in robots.items():
 
-            if "get_robots" in message:
-                send_reply = True
-                for id, robot in tracker.robots.items():
+            orientation = robot.orientation
+            if query_time is not None:
+                if id not in poses:
+                    poses[id] = robot.estimate.predict(query_time)
+                (x, y, orientation) = poses[id]
+
+            reply[id] = {}
+
+            if "pose" in groups:
+                (velocity_x, velocity_y, angular_velocity) = robot.estimate.velocity()
+                reply[id]["orientation"] = round(orientation, 2)
+                reply[id]["velocity"] = {"x": round(velocity_x, 3), "y": round(velocity_y, 3), "angular": round(angular_velocity, 2)}
+                reply[id]["pose_age"] = round(max(reference_time - robot.last_seen, 0), 3)
+
+            if "zone" in groups:
+                reply[id]["role"] = robot.role.name
+                reply[id]["team"] = robot.team.name
+                reply[id]["remaining_time"] = int(world.time_left)
+                reply[id]["progress_through_zone"] = round(robot.distance, 2)
+
+            if "ball" in groups:
+                ball = robot.ball
+                if query_time is not None:
+                    ball = SensorReading(*rangeAndBearing(x, y, orientation, world.ball))
+
+                reply[id]["ball"] = {}
+                reply[id]["ball"]["range"] = round(ball.range, 2)
+                reply[id]["ball"]["bearing"] = round(ball.bearing, 2)
+
+            if "goals" in groups:
+                strike_goal = robot.strike_goal
+                defend_goal = robot.defend_goal
+                if query_time is not None:
+                    goal1 = SensorReading(*rangeAndBearing(x, y, orientation, red_goal))
+                    goal2 = SensorReading(*rangeAndBearing(x, y, orientation, blue_goal))
+                    if robot.team == Team.BLUE:
+                        strike_goal = goal1
+                        defend_goal = goal2
+                    else:
+                        strike_goal = goal2
+                        defend_goal = goal1
+
+                reply[id]["their_goal"] = {}
+                reply[id]["their_goal"]["range"] = round(strike_goal.range, 2)
+                reply[id]["their_goal"]["bearing"] = round(strike_goal.bearing, 2)
+
+                reply[id]["our_goal"] = {}
+                reply[id]["our_goal"]["range"] = round(defend_goal.range, 2)
+                reply[id]["our_goal"]["bearing"] = round(defend_goal.bearing, 2)
 
-                    reply[id] = {}
-                    reply[id]["orientation"] = round(robot.orientation, 2)
-                    reply[id]["role"] = robot.role.name
-                    reply[id]["team"] = robot.team.name
-                    reply[id]["players"] = {}
-                    reply[id]["remaining_time"] = int(tracker.timer.time_left)
-                    reply[id]["progress_through_zone"] = round(robot.distance, 2)
+            if "neighbours" in groups:
+                reply[id]["players"] = {}
 
-                    reply[id]["ball"] = {}
-                    reply[id]["ball"]["range"] = round(robot.ball.range, 2)
-                    reply[id]["ball"]["bearing"] = round(robot.ball.bearing, 2)
+                for neighbour_id, neighbour in robot.neighbours.items():
 
-                    reply[id]["their_goal"] = {}
-                    reply[id]["their_goal"]["range"] = round(robot.strike_goal.range, 2)
-                    reply[id]["their_goal"]["bearing"] = round(robot.strike_goal.bearing, 2)
+                    if neighbour_id not in world.robots: # Seen for the first time in a frame after this one
+                        continue
+                    neighbour_robot = world.robots[neighbour_id]
 
-                    reply[id]["our_goal"] = {}
-                    reply[id]["our_goal"]["range"] = round(robot.defend_goal.range, 2)
-                    reply[id]["our_goal"]["bearing"] = round(robot.defend_goal.bearing, 2)
+                    if query_time is not None:
+                        if neighbour_id not in poses:
+                            poses[neighbour_id] = neighbour_robot.estimate.predict(query_time)
+                        (neighbour_x, neighbour_y, neighbour_orientation) = poses[neighbour_id]
+                        neighbour = SensorReading(*rangeAndBearing(x, y, orientation, Vector2D(neighbour_x, neighbour_y)),
+                                                  neighbour_orientation)
 
-                    for neighbour_id, neighbour in robot.neighbours.items():
+                    reply[id]["players"][neighbour_id] = {}
+                    reply[id]["players"][neighbour_id]["team"] = neighbour_robot.team.name
+                    reply[id]["players"][neighbour_id]["role"] = neighbour_robot.role.name
+                    reply[id]["players"][neighbour_id]["range"] = round(neighbour.range, 2)
+                    reply[id]["players"][neighbour_id]["bearing"] = round(neighbour.bearing, 2)
+                    reply[id]["players"][neighbour_id]["orientation"] = round(neighbour.orientation, 2)
+
+        return reply
+
+    """
+    Picks robots and groups of fields out of a full get_robots reply, without working anything out again
 
-                        neighbour_robot = tracker.robots[neighbour_id]
-                        reply[id]["players"][neighbour_id] = {}
-                        reply[id]["players"][neighbour_id]["team"] = neighbour_robot.team.name
-                        reply[id]["players"][neighbour_id]["role"] = neighbour_robot.role.name
-                        reply[id]["players"][neighbour_id]["range"] = round(neighbour.range, 2)
-                        reply[id]["players"][neighbour_id]["bearing"] = round(neighbour.bearing, 2)
-                        reply[id]["players"][neighbour_id]["orientation"] = round(neighbour.orientation, 2)
+    reply  -- a reply from buildRobotsReply, for every robot and field
+    ids    -- if given, only the robots with these IDs
+    fields -- if given, only these groups of fields (see FIELD_GROUPS)
+    """
+    def selectRobotsReply(self, reply, ids=None, fields=None):
+        if ids is not None:
+            reply = {id: reply[id] for id in ids if id in reply}
+        if fields is None:
+            return dict(reply)
+
+        keys = [key for group in fields for key in FIELD_GROUPS[group]]
+        return {id: {key: robot[key] for key in keys} for id, robot in reply.items()}
+
+    """
+    Publish stage: builds the get_robots reply for the newest world state, then publishes the world with a
+    single reference assignment, so the websocket handler always answers from one complete frame
+    """
+    def publish(self, world):
+        world.robots_reply = self.buildRobotsReply(world)
+        world.header["published"] = time.time()
+        self.snapshot = world
 
+        if self.subscriptions is not None and self.calibrated:
+            self.subscriptions.publish(world)
 
-            # Send reply, if requested
+    """
+    Throughput, dropped frames and latency histograms for every pipeline stage and the world-model steps
+    """
+    def get_stats(self):
+        stages = {stage.name: stage.get_stats() for stage in self.stages}
+        queue_drops = sum(stage.input.dropped for stage in self.stages
+                          if stage.name in ("detect", "world") and stage.input is not None)
+        return {"fps": stages["world"]["fps"] if "world" in stages else 0,
+                "frame": self.frame_sequence,
+                "dropped_frames": self.camera.frames_dropped + queue_drops,
+                "stages": stages,
+                "world": {name: histogram.get_stats() for name, histogram in self.latency.items()},
+                "detector": self.detector.get_stats()}
+
+    """
+    Runs capture, detection, world model, rendering and publishing as separate stages, connected by
+    latest-wins queues, so pose updates never wait on rendering
+    """
+    def run(self):
+        # When replaying a recording as fast as possible, every frame is tracked rather than only the newest
+        frames = LatestQueue(lossless=not self.realtime)
+        detections = LatestQueue(lossless=not self.realtime)
+        worlds_to_render = LatestQueue()
+        worlds_to_publish = LatestQueue()
+
+        # Headless mode skips all drawing, unless a reduced-rate preview was asked for
+        preview = not self.headless or self.preview_rate > 0
+        world_outputs = [worlds_to_render, worlds_to_publish] if preview else [worlds_to_publish]
+
+        self.stages = [Stage("capture", self.capture, None, [frames]),
+                       Stage("detect", self.detect, frames, [detections]),
+                       Stage("world", self.updateWorld, detections, world_outputs),
+                       Stage("publish", self.publish, worlds_to_publish)]
+
+        if preview:
+            self.stages.append(Stage("render", self.render, worlds_to_render, rate=self.preview_rate or None))
+
+        for stage in self.stages:
+            stage.start()
+
+        while not self.finished.wait(STATS_INTERVAL):
+            print(report(self.stages))
+
+        # At the end of a recording, the frames still queued are tracked before stopping
+        if self.end_of_source:
+            drain([stage for stage in self.stages if stage.input is not None])
+
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            stage.join(timeout=1.0) # Let detection finish its frame before the detector is closed
+        self.detector.close()
+        self.camera.release()
+        if self.end_of_source:
+            print("End of recording")
+        print(report(self.stages))
+
+"""
+Reads the optional "ids" and "fields" of a get_robots or subscribe request
+
+Returns (ids, fields), either of which is None if not given. Raises ValueError unless ids is a list of robot IDs
+and fields a list of names in FIELD_GROUPS.
+"""
+def parse_filters(message):
+    ids = message.get("ids")
+    fields = message.get("fields")
+
+    if ids is not None:
+        if not isinstance(ids, list) or any(isinstance(id, bool) or not isinstance(id, (int, str)) for id in ids):
+            raise ValueError(f"ids must be a list of robot IDs, not {ids!r}")
+        ids = [int(id) for id in ids]
+    if fields is not None:
+        if not isinstance(fields, list) or not all(isinstance(group, str) for group in fields):
+            raise ValueError(f"fields must be a list of field group names, not {fields!r}")
+        unknown = [group for group in fields if group not in FIELD_GROUPS]
+        if unknown:
+            raise ValueError(f"unknown field groups {unknown}, expected some of {list(FIELD_GROUPS)}")
+
+    return ids, fields
+
+
+"""
+Reads the "time" of a get_robots request, which must be within MAX_QUERY_OFFSET seconds of frame_time
+
+Poses are extrapolated to it, so a time from a badly skewed clock is refused rather than answered with
+poses that are far off. Raises ValueError.
+"""
+def parse_query_time(value, frame_time):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"time must be a number of seconds since the epoch, not {value!r}")
+    if abs(value - frame_time) > MAX_QUERY_OFFSET:
+        raise ValueError(f"time {value} is {value - frame_time:+.3f} s from the latest frame; "
+                         f"check the client's clock (see the clock-offset handshake)")
+    return float(value)
+
+
+async def handler(websocket):
+    server_stats.clients += 1
+    subscriber = None # This client's subscription, if it has one
+    encoding = "json" # How get_robots replies are sent to this client, see ENCODINGS
+    deltas = DeltaEncoder(DELTA_TOLERANCES, DELTA_HISTORY) # What this client has been sent in reply to get_robots
+    subscription_deltas = None # What this client's subscription has pushed, if it pushes deltas
+    try:
+        async for packet in websocket:
+            start = time.perf_counter()
+            try:
+                message = json.loads(packet)
+                if not isinstance(message, dict):
+                    raise ValueError(f"expected a JSON object of requests, not {type(message).__name__}")
+            except ValueError as e: # Including malformed JSON
+                await websocket.send(json.dumps({"error": str(e)}))
+                continue
+
+            # Everything about the world in this reply comes from one snapshot, however many frames go by
+            snapshot = tracker.snapshot
+
+            # Plain get_robots requests, by far the most common, get the same encoded reply as every other
+            # client asking during this frame
+            if tracker.calibrated and snapshot is not None and message.keys() == {"get_robots"}:
+                await websocket.send(reply_caches[encoding].get(snapshot))
+                server_stats.requests += 1
+                server_stats.handler.record(time.perf_counter() - start)
+                continue
+
+            # Process any requests received
+            reply = {}
+            send_reply = False
+            robots_message = None # get_robots reply, sent on its own when not JSON
+
+            # Clients ask for a different encoding of get_robots replies in their first message, before subscribing.
+            # Everything else is always JSON.
+            if "encoding" in message:
+                if isinstance(message["encoding"], str) and message["encoding"] in ENCODINGS:
+                    encoding = message["encoding"]
+                else:
+                    reply["error"] = f"unknown encoding {message['encoding']}, expected one of {list(ENCODINGS)}"
+                reply["encoding"] = encoding
+                send_reply = True
+
+            # Clock-offset handshake: echo the client's send time along with ours, so the client can work out the
+            # offset between the clocks from the round trip
+            if "clock" in message:
+                reply["clock"] = message["clock"]
+                reply["server_time"] = time.time()
+                send_reply = True
+
+            if "get_stats" in message:
+                reply["stats"] = tracker.get_stats()
+                reply["stats"]["server"] = server_stats.get_stats()
+                reply["stats"]["reply_cache"] = {name: cache.get_stats() for name, cache in reply_caches.items()}
+                reply["stats"]["subscriptions"] = tracker.subscriptions.get_stats()
+                send_reply = True
+
+            # Push every new frame's get_robots reply to the client, at most at the rate asked for
+            if "subscribe" in message:
+                try:
+                    rate = parse_rate(message["subscribe"])
+                    (ids, fields) = parse_filters(message)
+                    if message.get("delta"): # Each push only has what changed since the one before
+                        if encoding != "json":
+                            raise ValueError("delta replies are only sent as JSON")
+                        tolerances = parse_tolerances(message.get("tolerance", {}), DELTA_TOLERANCES)
+                        encoder = DeltaEncoder(tolerances, DELTA_HISTORY, DELTA_KEYFRAME_INTERVAL)
+                        encode = lambda snapshot, ids=ids, fields=fields, encoder=encoder: json.dumps(encoder.encode(
+                            tracker.selectRobotsReply(snapshot.robots_reply, ids, fields), snapshot.header, encoder.last))
+                    elif ids is None and fields is None:
+                        encode = reply_caches[encoding].get # Shared by every client subscribed to the full reply
+                    else:
+                        encode = lambda snapshot, ids=ids, fields=fields, encode_reply=ENCODINGS[encoding]: encode_reply(
+                            tracker.selectRobotsReply(snapshot.robots_reply, ids, fields), snapshot.header)
+                    if subscriber is not None:
+                        tracker.subscriptions.unsubscribe(subscriber)
+                    subscriber = tracker.subscriptions.subscribe(websocket, encode, rate)
+                    subscription_deltas = encoder if message.get("delta") else None
+                    reply["subscribed"] = message["subscribe"]
+                except ValueError as e:
+                    reply["subscribed"] = False
+                    reply["error"] = str(e)
+                send_reply = True
+
+            # A delta subscriber that lost track of the pushes asks for the next one to be complete. No reply, so
+            # nothing but pushes arrives on the subscription.
+            if "keyframe" in message and subscription_deltas is not None:
+                subscription_deltas.force_keyframe()
+
+            if "unsubscribe" in message and subscriber is not None:
+                tracker.subscriptions.unsubscribe(subscriber)
+                subscriber = None
+                subscription_deltas = None
+                reply["subscribed"] = False
+                send_reply = True
+
+            if tracker.calibrated and snapshot is not None:
+                if "check_awake" in message:
+                    reply["awake"] = True
+                    send_reply = True
+
+                if "command" in message:
+                    reply["command"] = message["command"]
+                    try:
+                        reply["accepted"] = tracker.command(message["command"])
+                    except ValueError as e:
+                        reply["accepted"] = False
+                        reply["error"] = str(e)
+                    send_reply = True
+
+                if "get_robots" in message:
+                    try:
+                        (ids, fields) = parse_filters(message)
+                        if "time" in message: # Poses extrapolated to the time the client asked for
+                            query_time = parse_query_time(message["time"], snapshot.frame.timestamp)
+                            robots = tracker.buildRobotsReply(snapshot, query_time, ids, fields)
+                        else:
+                            robots = tracker.selectRobotsReply(snapshot.robots_reply, ids, fields)
+                        if "since" in message: # Only what changed since the frame the client last applied
+                            if encoding != "json":
+                                raise ValueError("delta replies are only sent as JSON")
+                            tolerances = parse_tolerances(message["tolerance"], DELTA_TOLERANCES) if "tolerance" in message else None
+                            reply.update(deltas.encode(robots, snapshot.header, parse_since(message["since"]), tolerances))
+                            send_reply = True
+                        elif encoding == "json":
+                            reply.update(robots)
+                            send_reply = True
+                        else:
+                            robots_message = ENCODINGS[encoding](robots, snapshot.header)
+                    except ValueError as e:
+                        reply["error"] = str(e)
+                        send_reply = True
+
+
+            # Send reply, if requested, saying which frame it was worked out from and when
             if send_reply:
+                if snapshot is not None:
+                    reply.update(snapshot.header)
                 await websocket.send(json.dumps(reply))
+            if robots_message is not None:
+                await websocket.send(robots_message)
+            if send_reply or robots_message is not None:
+                server_stats.requests += 1
+                server_stats.handler.record(time.perf_counter() - start)
+    finally:
+        if subscriber is not None:
+            tracker.subscriptions.unsubscribe(subscriber)
+        server_stats.clients -= 1
 
 
 # TODO: Handle Ctrl+C signals
 if __name__ == "__main__":
-    global tracker
-    tracker = Tracker()
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument("--headless", action="store_true",
+        help="don't open a preview window or listen to the keyboard; send operator commands over the websocket")
+
+    ap.add_argument("--preview-rate", type=float,
+        default=0,
+        help="maximum preview frames per second, e.g. 5 for a reduced-rate preview in headless mode (default: every frame)")
+
+    ap.add_argument("--source", type=str,
+        default=None,
+        help="video file or directory of images to track instead of the live camera")
+
+    ap.add_argument("--fast", action="store_true",
+        help="replay --source as fast as possible instead of at its recorded frame rate")
+
+    args = ap.parse_args()
+
+    global tracker, server_stats, reply_caches
+    server_stats = ServerStats()
+    reply_caches = {name: ReplyCache(encode) for name, encode in ENCODINGS.items()}
+    tracker = Tracker(headless=args.headless, preview_rate=args.preview_rate, source=args.source, realtime=not args.fast)
+    loop = asyncio.get_event_loop()
+    tracker.subscriptions = Subscriptions(loop)
     tracker.start()
 
     ##
@@ -826,6 +1485,11 @@ if __name__ == "__main__":
     start_server = websockets.serve(ws_handler=handler, host=None, port=6000)
     # start_server = websockets.serve(ws_handler=handler, host="144.32.165.233", port=6000)
 
-    loop = asyncio.get_event_loop()
     loop.run_until_complete(start_server)
-    loop.run_forever()
+    try:
+        # Serve until the tracker finishes, at the end of a recording, or until Ctrl+C
+        loop.run_until_complete(loop.run_in_executor(None, tracker.finished.wait))
+    finally:
+        # Stop the pipeline, which closes the detector and frees its worker processes and shared memory
+        tracker.finished.set()
+        tracker.join()
@@ -7,14 +7,19 @@ import threading
 import asyncio
 import websockets
 import json
+from aggregates import findAggregates
 from camera import *
+from detection import make_detector
+from pipeline import LatestQueue, Frame, Stage, drain, report
+from replies import ReplyCache, Subscriptions, parse_rate
+from spatial import SpatialGrid
+from tags import TagBatch
 from vector2d import Vector2D
-import itertools
 import random
 import angles
 import time
 import math
-import numpy as np
+import argparse
 
 red = (0, 0, 255)
 green = (0, 255, 0)
@@ -24,29 +29,15 @@ yellow = (50, 255, 255)
 black = (0, 0, 0)
 white = (255, 255, 255)
 
-class Tag:
-    def __init__(self, id, raw_tag):
-        self.id = id
-        self.raw_tag = raw_tag
-        self.corners = raw_tag.tolist()[0]
-
-        # Individual corners (e.g. tl = top left corner in relation to the tag, not the camera)
-        self.tl = Vector2D(int(self.corners[0][0]), int(self.corners[0][1])) # Top left
-        self.tr = Vector2D(int(self.corners[1][0]), int(self.corners[1][1])) # Top right
-        self.br = Vector2D(int(self.corners[2][0]), int(self.corners[2][1])) # Bottom right
-        self.bl = Vector2D(int(self.corners[3][0]), int(self.corners[3][1])) # Bottom left
-
-        # Calculate centre of the tag
-        self.centre = Vector2D(int((self.tl.x + self.tr.x + self.br.x + self.bl.x) / 4),
-                               int((self.tl.y + self.tr.y + self.br.y + self.bl.y) / 4))
-
-        # Calculate centre of top of tag
-        self.front = Vector2D(int((self.tl.x + self.tr.x) / 2),
-                              int((self.tl.y + self.tr.y) / 2))
-
-        # Calculate orientation of tag
-        self.forward = math.atan2(self.front.y - self.centre.y, self.front.x - self.centre.x) # Forward vector
-        self.angle = math.degrees(self.forward) # Angle between forward vector and x-axis
+THREADED_CAPTURE = True # Read the camera on its own thread and always track the newest frame
+DETECTION_MODE = "incremental" # "full", "incremental" (search around last known tag positions), "tiled" (multi-process)
+                               # or "pyramid" (detect at reduced resolution, refine corners at full resolution)
+FULL_SCAN_INTERVAL = 15 # Frames between full-frame scans in incremental detection mode
+DETECTION_TILES = (2, 2) # Columns and rows of tiles in tiled detection mode
+TILE_OVERLAP = 160 # Pixels shared between neighbouring tiles; must be larger than a tag
+DETECTION_SCALE = 0.5 # Downscale factor for the detection pass in pyramid detection mode
+STATS_INTERVAL = 10 # Seconds between pipeline throughput reports
+GRID_CELL_SIZE = 0.15 # Metres; the robots' sensor range, so neighbour queries only look at adjacent grid cells
 
 class Robot:
     def __init__(self, tag, position):
@@ -59,10 +50,40 @@ class Robot:
         self.tasks = {}
 
 class SensorReading:
-    def __init__(self, range, bearing, orientation=0):
+    def __init__(self, range, bearing, orientation=0, workers=0):
         self.range = range
         self.bearing = bearing
         self.orientation = orientation
+        self.workers = workers
+
+class World:
+    """
+    Output of the world-model stage
+
+    A snapshot of one frame: the robots are created afresh every frame, so nothing in a World changes once it has
+    been published.
+
+    frame                  -- the Frame the world was updated from
+    robots                 -- the robots seen in the frame
+    detected               -- whether any tags were detected in the frame
+    aggregate_circles      -- (centre, radius) of each aggregate, in metres
+    current_max_aggregates -- size of the biggest aggregate in the frame
+    total_max_time         -- time spent at the biggest aggregate size so far
+    result                 -- the score, formatted for display
+    """
+    def __init__(self, frame, robots, detected, aggregate_circles, current_max_aggregates, total_max_time, result):
+        self.frame = frame
+        self.frame_id = frame.sequence
+        self.robots = robots
+        self.detected = detected
+        self.aggregate_circles = aggregate_circles
+        self.current_max_aggregates = current_max_aggregates
+        self.total_max_time = total_max_time
+        self.result = result
+        self.robots_reply = {} # get_robots reply for this world, filled in by the publish stage before publishing
+
+        # Sent with every reply worked out from this world; "published" is filled in by the publish stage
+        self.header = {"frame": self.frame_id, "captured": frame.timestamp, "published": None}
 
 class Task:
     def __init__(self, id, workers, position, radius, time_limit):
@@ -78,9 +99,19 @@ class Task:
 
 class Tracker(threading.Thread):
 
-    def __init__(self):
+    """
+    source   -- None for the live camera, or a video file or directory of images to replay
+    realtime -- replay recordings at their recorded rate rather than as fast as possible
+    """
+    def __init__(self, source=None, realtime=True):
         threading.Thread.__init__(self)
-        self.camera = Camera()
+        # The detector comes first, so any worker processes it starts are not created while the camera thread runs
+        self.detector = make_detector(DETECTION_MODE, full_scan_interval=FULL_SCAN_INTERVAL,
+                                      tiles=DETECTION_TILES, overlap=TILE_OVERLAP, scale=DETECTION_SCALE)
+        self.camera = make_source(source, realtime, threaded=THREADED_CAPTURE)
+        self.realtime = realtime or source is None
+        self.finished = threading.Event() # Set at the end of a recorded frame source, or to shut the tracker down
+        self.end_of_source = False # Whether the recording being replayed has run out
         self.calibrated = False
         self.num_corner_tags = 0 # Needs to be defined
         self.min_x = 0 # In pixels
@@ -90,10 +121,16 @@ class Tracker(threading.Thread):
         self.centre = Vector2D(0, 0) # In metres
         self.corner_distance_metres = 2.06 # Euclidean distance between corner tags in metres
         self.corner_distance_pixels = 0
+        self.frame_timestamp = 0 # Capture time of the frame being processed
+        self.frame_sequence = 0 # Camera sequence number of the frame being processed
         self.scale_factor = 0.0
         self.robots = {}
+        self.grid = SpatialGrid(GRID_CELL_SIZE) # Robot positions, rebuilt every frame
+        self.max_sensor_range = 0.0 # Longest sensor range of the robots in the grid, in metres
         self.tasks = {}
-        self.list_aggregates = []
+        self.aggregates = [] # Aggregates in the current frame, biggest first
+        self.aggregate_circles = [] # (centre, radius) of each aggregate, in metres
+        self.current_max_aggregates = 0
         self.max_aggregates = 0
         self.aggregation_times = {}
         
@@ -110,403 +147,502 @@ class Tracker(threading.Thread):
 
         self.experiment_time = 30
 
+        self.world = None # Newest output of the world-model stage
+        self.snapshot = None # Newest published World, with its get_robots reply; replaced, never changed
+        self.subscriptions = None # Clients the websocket server pushes every published World to
+        self.stages = []
+
+    """
+    Converts raw tags into robots, calibrating the arena from the corner tags first
+    """
+    def processTags(self, tag_ids, raw_tags):
+        tags = TagBatch(tag_ids, raw_tags)
+        positions = None
+
+        for index, id in enumerate(tags.ids_list):
+
+            tag = tags.tag(index)
+
+            if self.calibrated:
+                if positions is None:
+                    positions = (tags.centres / self.scale_factor).tolist() # Convert pixel coordinates to metres, all tags at once
+                if tag.id != 0: # Reserved tag ID for corners
+                    self.robots[id] = Robot(tag, Vector2D(*positions[index]))
+            else: # Only calibrate the first time two corner tags are detected
+
+                if tag.id == 0: # Reserved tag ID for corners
+
+                    if self.num_corner_tags == 0: # Record the first corner tag detected
+                        self.min_x = tag.centre.x
+                        self.max_x = tag.centre.x
+                        self.min_y = tag.centre.y
+                        self.max_y = tag.centre.y
+
+                    else: # Set min/max boundaries of arena based on second corner tag detected
+
+                        if tag.centre.x < self.min_x:
+                            self.min_x = tag.centre.x
+                        if tag.centre.x > self.max_x:
+                            self.max_x = tag.centre.x
+                        if tag.centre.y < self.min_y:
+                            self.min_y = tag.centre.y
+                        if tag.centre.y > self.max_y:
+                            self.max_y = tag.centre.y
+
+                        self.corner_distance_pixels = math.dist([self.min_x, self.min_y], [self.max_x, self.max_y]) # Euclidean distance between corner tags in pixels
+                        self.scale_factor = self.corner_distance_pixels / self.corner_distance_metres
+                        x = ((self.max_x - self.min_x) / 2) / self.scale_factor # Convert to metres
+                        y = ((self.max_y - self.min_y) / 2) / self.scale_factor # Convert to metres
+                        self.centre = Vector2D(x, y)
+                        self.calibrated = True
+
+                    self.num_corner_tags = self.num_corner_tags + 1
+
+    """
+    Builds each robot's neighbours
+    """
+    def processRobots(self):
+        self.grid.build((id, robot.position) for id, robot in self.robots.items())
+        self.max_sensor_range = max([robot.sensor_range for robot in self.robots.values()], default=0.0)
+
+        for id, robot in self.robots.items():
+
+            for other_id, range in self.grid.query(robot.position, robot.sensor_range):
+
+                if id != other_id: # Don't check this robot against itself
+
+                    other_robot = self.robots[other_id]
+                    absolute_bearing = math.degrees(math.atan2(other_robot.position.y - robot.position.y, other_robot.position.x - robot.position.x))
+                    relative_bearing = absolute_bearing - robot.orientation
+                    normalised_bearing = angles.normalize(relative_bearing, -180, 180)
+                    robot.neighbours[other_id] = SensorReading(range, normalised_bearing, other_robot.orientation)
+
+    """
+    Works out the centre and radius of each aggregate, and keeps track of the biggest aggregate over time
+    """
+    def processAggregates(self):
+
+        # ------------------------ Seongin -------------------------------------------
+        # Aggregates are the connected components of the neighbour graph; the biggest one drives the score
+        self.aggregates = findAggregates(self.robots)
+        self.aggregate_circles = [(aggregate.centre, aggregate.radius) for aggregate in self.aggregates]
+
+        current_max_aggregates = len(self.aggregates[0]) if self.aggregates else 0
+        if current_max_aggregates > 0:
+            if current_max_aggregates >= self.max_aggregates and self.is_max == False: # when current size of aggregate is larger or equal than previous ones.
+                #print(f"self.max_aggregates: {self.max_aggregates}, current_max_aggregates: {current_max_aggregates}")
+                #print(f"Max activated")
+                if current_max_aggregates > self.max_aggregates: # When we get bigger cluster, we reset the total max aggregation time, and start counting new time
+                    self.total_max_time = 0.0
+                self.max_aggregates = current_max_aggregates
+                self.is_max = True
+                self.max_timer = time.time()
+
+            elif current_max_aggregates == self.max_aggregates and self.is_max == True: # Stable state of the cluster, only time will be accumulated
+                #print(f"self.max_aggregates: {self.max_aggregates}, current_max_aggregates: {current_max_aggregates}")
+                self.tmp_max_time = time.time() - self.max_timer # duration of the aggregation
+                #print(self.tmp_max_time)
+                #print(f"counting tmp_max_time")
+            elif current_max_aggregates != self.max_aggregates and self.is_max == True: # when the aggregate changes either in a decreasing or increasing manner
+                #print(f"self.max_aggregates: {self.max_aggregates}, current_max_aggregates: {current_max_aggregates}")
+                self.is_max = False
+                self.max_end_time = time.time()
+                self.total_max_time += self.tmp_max_time
+                self.tmp_max_time = 0.0
+
+                #print(f"max finished")
+
+            #print(f"duration of agg:  {self.max_timer - self.max_end_time }")
+
+        self.current_max_aggregates = current_max_aggregates
+
+        # For the score
+        self.result = (self.max_aggregates * 0.8) + ((self.total_max_time + self.tmp_max_time) * 0.2) # Caculate the result
+        self.result = "{:.2f}".format(self.result)
+
+    """
+    Creates new tasks, checks which robots are at each task, and removes completed or failed tasks
+    """
+    def processTasks(self):
+        # Create any new tasks, if necessary
+        while len(self.tasks) < 3:
+            id = self.task_counter
+            placed = False
+            while not placed:
+                overlaps = False
+                workers = random.randint(1, 5)
+                radius = math.sqrt(workers) * 0.1
+                min_x_metres = self.min_x / self.scale_factor
+                max_x_metres = self.max_x / self.scale_factor
+                min_y_metres = self.min_y / self.scale_factor
+                max_y_metres = self.max_y / self.scale_factor
+                x = random.uniform(min_x_metres + radius, max_x_metres - radius)
+                y = random.uniform(min_y_metres + radius, max_y_metres - radius)
+                position = Vector2D(x, y) # In metres
+
+                for other_task in self.tasks.values():
+                    overlap = radius + other_task.radius
+                    if position.distance_to(other_task.position) < overlap:
+                        overlaps = True
+
+                if not overlaps:
+                    placed = True
+
+            time_limit = 20 * workers # 20 seconds per robot
+            self.tasks[id] = Task(id, workers, position, radius, time_limit)
+            self.task_counter = self.task_counter + 1
+
+        # Iterate over tasks
+        for task_id, task in self.tasks.items():
+
+            task.robots = []
+
+            # Check whether robot is within range, looking only at robots close enough to sense or work on the task
+            for robot_id, distance in self.grid.query(task.position, max(task.radius, self.max_sensor_range)):
+                robot = self.robots[robot_id]
+
+                if distance < robot.sensor_range:
+
+                    absolute_bearing = math.degrees(math.atan2(task.position.y - robot.position.y, task.position.x - robot.position.x))
+                    relative_bearing = absolute_bearing - robot.orientation
+                    normalised_bearing = angles.normalize(relative_bearing, -180, 180)
+
+                    robot.tasks[task_id] = SensorReading(distance, normalised_bearing, workers=task.workers)
+
+                if distance < task.radius:
+                    task.robots.append(robot_id)
+
+            # print(f"Task {task_id} - workers: {task.workers}, robots: {task.robots}")
+
+            if len(task.robots) >= task.workers:
+                task.completed = True
+
+            # Update task timer
+            time_now = time.time()
+            task.elapsed_time = time_now - task.start_time
+            if task.elapsed_time > 1:
+                task.start_time = time_now
+                task.counter = task.counter - 1
+                if task.counter <= 1:
+                    task.failed = True
+
+        # Delete completed tasks
+        for task_id in list(self.tasks.keys()):
+            task = self.tasks[task_id]
+            if task.completed:
+                self.score = self.score + task.workers
+                del self.tasks[task_id]
+            elif task.failed:
+                del self.tasks[task_id]
+
+    """
+    Capture stage: waits for a frame newer than the last one; in threaded capture mode older frames are dropped
+    """
+    def capture(self, item):
+        image, timestamp, sequence, dropped = self.camera.get_frame(block=True)
+        if image is None: # End of a recording
+            self.end_of_source = True
+            self.finished.set()
+            return None
+        return Frame(image, timestamp, sequence)
+
+    """
+    Detection stage
+    """
+    def detect(self, frame):
+        (frame.raw_tags, frame.tag_ids) = self.detector.detect(frame.image)
+        return frame
+
+    """
+    World-model stage: robots, neighbours, aggregates, tasks and score for one frame
+    """
+    def updateWorld(self, frame):
+        #print(f"time.time() - start_time: {time.time() - start_time}")
+        print(f"self.total_max_time: {self.total_max_time + self.tmp_max_time}")
+
+        tag_ids = frame.tag_ids
+        detected = False
+
+        self.robots = {} # Clear dictionary every frame in case robots have disappeared
+
+        # Check whether any tags were detected in this camera frame
+        if tag_ids is not None and len(tag_ids) > 0:
+
+            #print(f"tag_ids: {tag_ids}")
+            # Process raw ArUco output
+            self.processTags(tag_ids, frame.raw_tags)
+
+            if self.calibrated:
+                detected = True
+                self.processRobots()
+                self.processAggregates()
+                self.processTasks()
+
+        self.frame_timestamp = frame.timestamp
+        self.frame_sequence = frame.sequence
+        self.world = World(frame, self.robots, detected, self.aggregate_circles, self.current_max_aggregates,
+                           self.total_max_time, self.result)
+        return self.world
+
+    """
+    Render stage: draws the newest world state and shows it
+    """
+    def render(self, world):
+        image = world.frame.image
+
+        if world.detected:
+            overlay = image.copy()
+
+            # Draw boundary of virtual environment based on corner tag positions
+            cv2.rectangle(image, (self.min_x, self.min_y), (self.max_x, self.max_y), green, 1, lineType=cv2.LINE_AA)
+
+            for id, robot in world.robots.items():
+
+                # Draw tag
+                tag = robot.tag
+
+                # Draw border of tag
+                cv2.line(image, (tag.tl.x, tag.tl.y), (tag.tr.x, tag.tr.y), green, 1, lineType=cv2.LINE_AA)
+                cv2.line(image, (tag.tr.x, tag.tr.y), (tag.br.x, tag.br.y), green, 1, lineType=cv2.LINE_AA)
+                cv2.line(image, (tag.br.x, tag.br.y), (tag.bl.x, tag.bl.y), green, 1, lineType=cv2.LINE_AA)
+                cv2.line(image, (tag.bl.x, tag.bl.y), (tag.tl.x, tag.tl.y), green, 1, lineType=cv2.LINE_AA)
+
+                # Draw circle on centre point
+                cv2.circle(image, (tag.centre.x, tag.centre.y), 5, red, -1, lineType=cv2.LINE_AA)
+
+                # Draw robot's sensor range
+                sensor_range_pixels = int(robot.sensor_range * self.scale_factor)
+                cv2.circle(overlay, (tag.centre.x, tag.centre.y), sensor_range_pixels, magenta, -1, lineType=cv2.LINE_AA)
+
+                # Draw lines between robots if they are within sensor range
+                for neighbour_id in robot.neighbours.keys():
+                    neighbour = world.robots[neighbour_id]
+                    cv2.line(image, (tag.centre.x, tag.centre.y), (neighbour.tag.centre.x, neighbour.tag.centre.y), black, 10, lineType=cv2.LINE_AA)
+                    cv2.line(image, (tag.centre.x, tag.centre.y), (neighbour.tag.centre.x, neighbour.tag.centre.y), cyan, 3, lineType=cv2.LINE_AA)
+
+            for id, robot in world.robots.items():
+
+                tag = robot.tag
+
+                # Draw line from centre point to front of tag
+                forward_point = ((tag.front - tag.centre) * 2) + tag.centre
+                cv2.line(image, (tag.centre.x, tag.centre.y), (forward_point.x, forward_point.y), black, 10, lineType=cv2.LINE_AA)
+                cv2.line(image, (tag.centre.x, tag.centre.y), (forward_point.x, forward_point.y), green, 3, lineType=cv2.LINE_AA)
+
+                # Draw tag ID
+                text = str(tag.id)
+                font = cv2.FONT_HERSHEY_SIMPLEX
+                font_scale = 1.5
+                thickness = 4
+                textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
+                position = (int(tag.centre.x - textsize[0]/2), int(tag.centre.y + textsize[1]/2))
+                cv2.putText(image, text, position, font, font_scale, black, thickness * 3, cv2.LINE_AA)
+                cv2.putText(image, text, position, font, font_scale, white, thickness, cv2.LINE_AA)
+
+            # ------------------------ Seongin -------------------------------------------
+            for pos_center, radius in world.aggregate_circles:
+                cv2.circle(image, (int(pos_center[0] * self.scale_factor), int(pos_center[1] *self.scale_factor)), int(radius * self.scale_factor), yellow, 3, lineType=cv2.LINE_AA)
+
+            # ------------------------ Seongin -------------------------------------------
+            total_time = "{:.2f}".format(world.total_max_time)
+            text = f"Size of the biggest aggregate: {world.current_max_aggregates}, total max time: {world.total_max_time}"
+            font = cv2.FONT_HERSHEY_SIMPLEX
+            font_scale = 2
+            thickness = 5
+            textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
+            position = (10, 60)
+            cv2.putText(image, text, position, font, font_scale, black, thickness * 3, cv2.LINE_AA)
+            cv2.putText(image, text, position, font, font_scale, green, thickness, cv2.LINE_AA)
+
+            # For the score
+            text = f"The Score is: {world.result}"
+            font = cv2.FONT_HERSHEY_SIMPLEX
+            font_scale = 3
+            thickness = 7
+            textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
+            position = (10, 900)
+            cv2.putText(image, text, position, font, font_scale, black, thickness * 3, cv2.LINE_AA)
+            cv2.putText(image, text, position, font, font_scale, yellow, thickness, cv2.LINE_AA)
+
+
+
+            # Transparency for overlaid augments
+            alpha = 0.3
+            image = cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0)
+
+        window_name = 'SwarmHack'
+
+        # screen = screeninfo.get_monitors()[0]
+        # width, height = screen.width, screen.height
+        # image = cv2.resize(image, (width, height))
+        # cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
+        # cv2.setWindowProperty(window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+
+        cv2.imshow(window_name, image)
+
+        # Quitting with Q stops the whole tracker; this is a stage thread, so exiting here would only stop the preview
+        if cv2.waitKey(1) == ord('q'):
+            self.finished.set()
+
+    """
+    Publish stage: builds the get_robots reply for the newest world state, then publishes the world with a
+    single reference assignment, so the websocket handler always answers from one complete frame
+    """
+    def publish(self, world):
+        reply = {}
+        for id, robot in world.robots.items():
+            reply[id] = {}
+            reply[id]["orientation"] = robot.orientation
+            reply[id]["neighbours"] = {}
+            reply[id]["tasks"] = {}
+
+            for neighbour_id, neighbour in robot.neighbours.items():
+                reply[id]["neighbours"][neighbour_id] = {}
+                reply[id]["neighbours"][neighbour_id]["range"] = neighbour.range
+                reply[id]["neighbours"][neighbour_id]["bearing"] = neighbour.bearing
+                reply[id]["neighbours"][neighbour_id]["orientation"] = neighbour.orientation
+
+            for task_id, task in robot.tasks.items():
+                reply[id]["tasks"][task_id] = {}
+                reply[id]["tasks"][task_id]["range"] = task.range
+                reply[id]["tasks"][task_id]["bearing"] = task.bearing
+                reply[id]["tasks"][task_id]["workers"] = task.workers
+
+        world.robots_reply = reply
+        world.header["published"] = time.time()
+        self.snapshot = world
+
+        if self.subscriptions is not None and self.calibrated:
+            self.subscriptions.publish(world)
+
+    """
+    Runs capture, detection, world model, rendering and publishing as separate stages, connected by
+    latest-wins queues, so pose updates never wait on rendering
+    """
     def run(self):
         start_time = time.time()
         self.team_name = input(f"Please enter your team name ^_^: ")
-        while True: #(time.time() - start_time < self.experiment_time):
-            #print(f"time.time() - start_time: {time.time() - start_time}")        
-            print(f"self.total_max_time: {self.total_max_time + self.tmp_max_time}")
-            image = self.camera.get_frame()
-            overlay = image.copy()
-            
-            aruco_dictionary = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_100)
-            aruco_parameters = cv2.aruco.DetectorParameters_create()
-
-            (raw_tags, tag_ids, rejected) = cv2.aruco.detectMarkers(image, aruco_dictionary, parameters=aruco_parameters)
-
-
-            
-            self.robots = {} # Clear dictionary every frame in case robots have disappeared
-
-            # Check whether any tags were detected in this camera frame
-            if tag_ids is not None and len(tag_ids.tolist()) > 0:
-
-                tag_ids = list(itertools.chain(*tag_ids))
-                tag_ids = [int(id) for id in tag_ids] # Convert from numpy.int32 to int
-                #print(f"tag_ids: {tag_ids}")
-                # Process raw ArUco output
-                for id, raw_tag in zip(tag_ids, raw_tags):
-
-                    tag = Tag(id, raw_tag)
-
-                    if self.calibrated:
-                        if tag.id != 0: # Reserved tag ID for corners
-                            position = Vector2D(tag.centre.x / self.scale_factor, tag.centre.y / self.scale_factor) # Convert pixel coordinates to metres
-                            self.robots[id] = Robot(tag, position)
-                    else: # Only calibrate the first time two corner tags are detected
-                       
-                        if tag.id == 0: # Reserved tag ID for corners
-
-                            if self.num_corner_tags == 0: # Record the first corner tag detected
-                                self.min_x = tag.centre.x
-                                self.max_x = tag.centre.x
-                                self.min_y = tag.centre.y
-                                self.max_y = tag.centre.y
-
-                            else: # Set min/max boundaries of arena based on second corner tag detected
-
-                                if tag.centre.x < self.min_x:
-                                    self.min_x = tag.centre.x
-                                if tag.centre.x > self.max_x:
-                                    self.max_x = tag.centre.x
-                                if tag.centre.y < self.min_y:
-                                    self.min_y = tag.centre.y
-                                if tag.centre.y > self.max_y:
-                                    self.max_y = tag.centre.y
-
-                                self.corner_distance_pixels = math.dist([self.min_x, self.min_y], [self.max_x, self.max_y]) # Euclidean distance between corner tags in pixels
-                                self.scale_factor = self.corner_distance_pixels / self.corner_distance_metres
-                                x = ((self.max_x - self.min_x) / 2) / self.scale_factor # Convert to metres
-                                y = ((self.max_y - self.min_y) / 2) / self.scale_factor # Convert to metres
-                                self.centre = Vector2D(x, y)
-                                self.calibrated = True
-
-                            self.num_corner_tags = self.num_corner_tags + 1
-
-                if self.calibrated:
-
-                    # Draw boundary of virtual environment based on corner tag positions
-                    cv2.rectangle(image, (self.min_x, self.min_y), (self.max_x, self.max_y), green, 1, lineType=cv2.LINE_AA)
-            
-                    # Process robots
-                    self.list_aggregates = [] # Initialise list_aggregates
-                    for id, robot in self.robots.items():
-
-                        for other_id, other_robot in self.robots.items():
-
-                            if id != other_id: # Don't check this robot against itself
-
-                                range = robot.position.distance_to(other_robot.position)
-
-                                if range < robot.sensor_range:
-
-                                    absolute_bearing = math.degrees(math.atan2(other_robot.position.y - robot.position.y, other_robot.position.x - robot.position.x))
-                                    relative_bearing = absolute_bearing - robot.orientation
-                                    normalised_bearing = angles.normalize(relative_bearing, -180, 180)
-                                    robot.neighbours[other_id] = SensorReading(range, normalised_bearing, other_robot.orientation)
-
-                        # Draw tag
-                        tag = robot.tag
-
-                        # Draw border of tag
-                        cv2.line(image, (tag.tl.x, tag.tl.y), (tag.tr.x, tag.tr.y), green, 1, lineType=cv2.LINE_AA)
-                        cv2.line(image, (tag.tr.x, tag.tr.y), (tag.br.x, tag.br.y), green, 1, lineType=cv2.LINE_AA)
-                        cv2.line(image, (tag.br.x, tag.br.y), (tag.bl.x, tag.bl.y), green, 1, lineType=cv2.LINE_AA)
-                        cv2.line(image, (tag.bl.x, tag.bl.y), (tag.tl.x, tag.tl.y), green, 1, lineType=cv2.LINE_AA)
-                        
-                        # Draw circle on centre point
-                        cv2.circle(image, (tag.centre.x, tag.centre.y), 5, red, -1, lineType=cv2.LINE_AA)
-
-                        # Draw robot's sensor range
-                        sensor_range_pixels = int(robot.sensor_range * self.scale_factor)
-                        cv2.circle(overlay, (tag.centre.x, tag.centre.y), sensor_range_pixels, magenta, -1, lineType=cv2.LINE_AA)
-
-                        # Draw lines between robots if they are within sensor range
-                        # Add the aggregating robot in a list
-
-                        # ------------------------ Seongin -------------------------------------------
-                        for neighbour_id in robot.neighbours.keys():
-                            neighbour = self.robots[neighbour_id]
-                            cv2.line(image, (tag.centre.x, tag.centre.y), (neighbour.tag.centre.x, neighbour.tag.centre.y), black, 10, lineType=cv2.LINE_AA)
-                            cv2.line(image, (tag.centre.x, tag.centre.y), (neighbour.tag.centre.x, neighbour.tag.centre.y), cyan, 3, lineType=cv2.LINE_AA)
-                            is_find_id = False
-                            for list_agg_id, aggregates in enumerate(self.list_aggregates): ##
-                                if id in aggregates:
-                                    is_find_id = True
-                                    if neighbour_id not in aggregates:
-                                        self.list_aggregates[list_agg_id].append(neighbour_id)
-                                    else:
-                                        pass
-                                else:
-                                    pass
-                            if is_find_id == False:
-                                self.list_aggregates.append([id])
-
-                    # ------------------------ Seongin -------------------------------------------
-                    if len(self.list_aggregates) > 1:
-                        for i, aggregates in enumerate(self.list_aggregates):
-                            self.list_aggregates[i].sort() # sort the list to compare with other lists
-                            #print(f"self.list_aggregates[i]: {self.list_aggregates[i]}")
-                        
-                        self.list_aggregates = [ii for n, ii in enumerate(self.list_aggregates) if ii not in self.list_aggregates[:n]] 
-                        is_all_one = True
-                        #print(f"list_aggregates: {self.list_aggregates}")
-                        for i, aggregates in enumerate(self.list_aggregates):
-                            #print(f"len(aggregates): {len(aggregates)}")
-                            if len(aggregates) > 1:
-                                is_all_one = False
-                                #print(f"is_all_one: {is_all_one}")
-                        if is_all_one == True:
-                            self.list_aggregates = [np.array(self.list_aggregates).squeeze().tolist()]
-                    
-
-                    # print(f"list_aggregates: {self.list_aggregates}")
-                    # print(f"self.robots: {self.robots}")
-                    
-                            
-                    for id, robot in self.robots.items():
-
-                        tag = robot.tag
-
-                        # Draw line from centre point to front of tag
-                        forward_point = ((tag.front - tag.centre) * 2) + tag.centre
-                        cv2.line(image, (tag.centre.x, tag.centre.y), (forward_point.x, forward_point.y), black, 10, lineType=cv2.LINE_AA)
-                        cv2.line(image, (tag.centre.x, tag.centre.y), (forward_point.x, forward_point.y), green, 3, lineType=cv2.LINE_AA)
-
-                        # Draw tag ID
-                        text = str(tag.id)
-                        font = cv2.FONT_HERSHEY_SIMPLEX
-                        font_scale = 1.5
-                        thickness = 4
-                        textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
-                        position = (int(tag.centre.x - textsize[0]/2), int(tag.centre.y + textsize[1]/2))
-                        cv2.putText(image, text, position, font, font_scale, black, thickness * 3, cv2.LINE_AA)
-                        cv2.putText(image, text, position, font, font_scale, white, thickness, cv2.LINE_AA)
-                    
-                    # TODO I need to fix a bug. when the list changes it does not work. 
-
-                    # ------------------------ Seongin -------------------------------------------
-                    for i, aggregates in enumerate(self.list_aggregates):
-                        x_s = []
-                        y_s = []
-                        for id in aggregates:
-                            x_s.append(self.robots[id].position.x)
-                            y_s.append(self.robots[id].position.y)
-                        pos_center = [sum(x_s)/len(x_s), sum(y_s)/len(y_s)]
-                        radius = max([math.sqrt((x-pos_center[0])**2 + (y-pos_center[1])**2) for x, y in zip(x_s, y_s)])
-                        
-                        #print(f"x_s: {x_s}")
-                        #print(f"pos_centre: {pos_center}")
-                        #print(f"radius: {radius}")
-
-                        cv2.circle(image, (int(pos_center[0] * self.scale_factor), int(pos_center[1] *self.scale_factor)), int(radius * self.scale_factor), yellow, 3, lineType=cv2.LINE_AA)
-                    
-                    # ------------------------ Seongin -------------------------------------------
-                    current_max_aggregates = max([len(i) for i in self.list_aggregates]) if len(self.list_aggregates) != 0 else 0
-                    if current_max_aggregates > 0:
-                        if current_max_aggregates >= self.max_aggregates and self.is_max == False: # when current size of aggregate is larger or equal than previous ones. 
-                            #print(f"self.max_aggregates: {self.max_aggregates}, current_max_aggregates: {current_max_aggregates}")
-                            #print(f"Max activated")
-                            if current_max_aggregates > self.max_aggregates: # When we get bigger cluster, we reset the total max aggregation time, and start counting new time
-                                self.total_max_time = 0.0
-                            self.max_aggregates = current_max_aggregates
-                            self.is_max = True
-                            self.max_timer = time.time()
-                            
-                        elif current_max_aggregates == self.max_aggregates and self.is_max == True: # Stable state of the cluster, only time will be accumulated
-                            #print(f"self.max_aggregates: {self.max_aggregates}, current_max_aggregates: {current_max_aggregates}")
-                            self.tmp_max_time = time.time() - self.max_timer # duration of the aggregation
-                            #print(self.tmp_max_time)
-                            #print(f"counting tmp_max_time") 
-                        elif current_max_aggregates != self.max_aggregates and self.is_max == True: # when the aggregate changes either in a decreasing or increasing manner
-                            #print(f"self.max_aggregates: {self.max_aggregates}, current_max_aggregates: {current_max_aggregates}")
-                            self.is_max = False
-                            self.max_end_time = time.time() 
-                            self.total_max_time += self.tmp_max_time
-                            self.tmp_max_time = 0.0
-                            
-                            #print(f"max finished")
-                        
-                        #print(f"duration of agg:  {self.max_timer - self.max_end_time }") 
-                        
-                    # Create any new tasks, if necessary
-                    while len(self.tasks) < 3:
-                        id = self.task_counter
-                        placed = False
-                        while not placed:
-                            overlaps = False
-                            workers = random.randint(1, 5)
-                            radius = math.sqrt(workers) * 0.1
-                            min_x_metres = self.min_x / self.scale_factor
-                            max_x_metres = self.max_x / self.scale_factor
-                            min_y_metres = self.min_y / self.scale_factor
-                            max_y_metres = self.max_y / self.scale_factor
-                            x = random.uniform(min_x_metres + radius, max_x_metres - radius)
-                            y = random.uniform(min_y_metres + radius, max_y_metres - radius)
-                            position = Vector2D(x, y) # In metres
-
-                            for other_task in self.tasks.values():
-                                overlap = radius + other_task.radius
-                                if position.distance_to(other_task.position) < overlap:
-                                    overlaps = True
-                            
-                            if not overlaps:
-                                placed = True
-
-                        time_limit = 20 * workers # 20 seconds per robot
-                        self.tasks[id] = Task(id, workers, position, radius, time_limit)
-                        self.task_counter = self.task_counter + 1
-
-                    # Iterate over tasks
-                    for task_id, task in self.tasks.items():
-
-                        task.robots = []
-
-                        # Check whether robot is within range
-                        for robot_id, robot in self.robots.items():
-                            distance = task.position.distance_to(robot.position)
-
-                            if distance < robot.sensor_range:
-
-                                absolute_bearing = math.degrees(math.atan2(task.position.y - robot.position.y, task.position.x - robot.position.x))
-                                relative_bearing = absolute_bearing - robot.orientation
-                                normalised_bearing = angles.normalize(relative_bearing, -180, 180)
-
-                                robot.tasks[task_id] = SensorReading(distance, normalised_bearing)
-
-                            if distance < task.radius:
-                                task.robots.append(robot_id)
-
-                        # print(f"Task {task_id} - workers: {task.workers}, robots: {task.robots}")
-                            
-                        if len(task.robots) >= task.workers:
-                            task.completed = True
-
-                        pixel_radius = int(task.radius * self.scale_factor)
-                        x = int(task.position.x * self.scale_factor)
-                        y = int(task.position.y * self.scale_factor)
-
-                        # Draw task timer
-                        time_now = time.time()
-                        task.elapsed_time = time_now - task.start_time
-                        if task.elapsed_time > 1:
-                            task.start_time = time_now
-                            task.counter = task.counter - 1
-                            if task.counter <= 1:
-                                task.failed = True
-                        #cv2.circle(overlay, (x, y), int((pixel_radius / task.time_limit) * task.counter), cyan, -1, lineType=cv2.LINE_AA)
-
-                        colour = red
-
-                        # Draw task boundary
-                        #cv2.circle(image, (x, y), pixel_radius, black, 10, lineType=cv2.LINE_AA)
-                        #cv2.circle(image, (x, y), pixel_radius, colour, 5, lineType=cv2.LINE_AA)
-
-                        # Draw task ID
-                        # text = str(task.workers)
-                        # font = cv2.FONT_HERSHEY_SIMPLEX
-                        # font_scale = 1.5
-                        # thickness = 4
-                        # textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
-                        # position = (int(x - textsize[0]/2), int(y + textsize[1]/2))
-                        # cv2.putText(image, text, position, font, font_scale, black, thickness * 3, cv2.LINE_AA)
-                        # cv2.putText(image, text, position, font, font_scale, colour, thickness, cv2.LINE_AA)
-
-                    # Delete completed tasks
-                    for task_id in list(self.tasks.keys()):
-                        task = self.tasks[task_id]
-                        if task.completed:
-                            self.score = self.score + task.workers
-                            del self.tasks[task_id]
-                        elif task.failed:
-                            del self.tasks[task_id]
-
-                    # ------------------------ Seongin -------------------------------------------
-                    total_time = "{:.2f}".format(self.total_max_time + self.tmp_max_time)
-                    text = f"Size of the biggest aggregate: {current_max_aggregates}, total max time: {self.total_max_time}"
-                    font = cv2.FONT_HERSHEY_SIMPLEX
-                    font_scale = 2
-                    thickness = 5
-                    textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
-                    position = (10, 60)
-                    cv2.putText(image, text, position, font, font_scale, black, thickness * 3, cv2.LINE_AA)
-                    cv2.putText(image, text, position, font, font_scale, green, thickness, cv2.LINE_AA)
-
-                    # For the score
-                    self.result = (self.max_aggregates * 0.8) + ((self.total_max_time + self.tmp_max_time) * 0.2) # Caculate the result
-                    self.result = "{:.2f}".format(self.result)
-
-                    text = f"The Score is: {self.result}"
-                    font = cv2.FONT_HERSHEY_SIMPLEX
-                    font_scale = 3
-                    thickness = 7
-                    textsize = cv2.getTextSize(text, font, font_scale, thickness)[0]
-                    position = (10, 900)
-                    cv2.putText(image, text, position, font, font_scale, black, thickness * 3, cv2.LINE_AA)
-                    cv2.putText(image, text, position, font, font_scale, yellow, thickness, cv2.LINE_AA)
-
-                    
-
-                    # Transparency for overlaid augments
-                    alpha = 0.3
-                    image = cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0)
-
-            window_name = 'SwarmHack'
-
-            # screen = screeninfo.get_monitors()[0]
-            # width, height = screen.width, screen.height
-            # image = cv2.resize(image, (width, height))
-            # cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
-            # cv2.setWindowProperty(window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
-
-            cv2.imshow(window_name, image)
-
-            # TODO: Fix quitting with Q (necessary for fullscreen mode)
-            if cv2.waitKey(1) == ord('q'):
-                sys.exit()
 
-        self.total_max_time += self.tmp_max_time; 
-        print(f"Team: {self.team_name}, Size of Aggregate: {self.max_aggregates}, Aggregate Time: {self.total_max_time}, and their score {self.result}") 
+        # When replaying a recording as fast as possible, every frame is tracked rather than only the newest
+        frames = LatestQueue(lossless=not self.realtime)
+        detections = LatestQueue(lossless=not self.realtime)
+        worlds_to_render = LatestQueue()
+        worlds_to_publish = LatestQueue()
 
-async def handler(websocket):
-    print("starting handler")
-    async for packet in websocket:
-        print("received packet")
-        print(packet)
-        message = json.loads(packet)
-
-        print(message)
-        
-        # Process any requests received
-        reply = {}
-        send_reply = False
+        self.stages = [Stage("capture", self.capture, None, [frames]),
+                       Stage("detect", self.detect, frames, [detections]),
+                       Stage("world", self.updateWorld, detections, [worlds_to_render, worlds_to_publish]),
+                       Stage("render", self.render, worlds_to_render),
+                       Stage("publish", self.publish, worlds_to_publish)]
 
-        if "check_awake" in message:
-            print("CHECK AWAKE")
-            reply["awake"] = True
-            send_reply = True
+        for stage in self.stages:
+            stage.start()
 
-        if "get_robots" in message:
+        while not self.finished.wait(STATS_INTERVAL): #(time.time() - start_time < self.experiment_time):
+            print(report(self.stages))
 
-            for id, robot in tracker.robots.items():
-                reply[id] = {}
-                reply[id]["orientation"] = robot.orientation
-                reply[id]["neighbours"] = {}
-                reply[id]["tasks"] = {}
+        # At the end of a recording, the frames still queued are tracked before stopping
+        if self.end_of_source:
+            drain([stage for stage in self.stages if stage.input is not None])
 
-                for neighbour_id, neighbour in robot.neighbours.items():
-                    reply[id]["neighbours"][neighbour_id] = {}
-                    reply[id]["neighbours"][neighbour_id]["range"] = neighbour.range
-                    reply[id]["neighbours"][neighbour_id]["bearing"] = neighbour.bearing
-                    reply[id]["neighbours"][neighbour_id]["orientation"] = neighbour.orientation
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            stage.join(timeout=1.0) # Let detection finish its frame before the detector is closed
+        self.detector.close()
+        self.camera.release()
+        print(report(self.stages))
 
-                for task_id, task in robot.tasks.items():
-                    reply[id]["tasks"][task_id] = {}
-                    reply[id]["tasks"][task_id]["range"] = task.range
-                    reply[id]["tasks"][task_id]["bearing"] = task.bearing
-                    reply[id]["tasks"][task_id]["workers"] = task.workers
-
-            send_reply = True
+        self.total_max_time += self.tmp_max_time; 
+        print(f"Team: {self.team_name}, Size of Aggregate: {self.max_aggregates}, Aggregate Time: {self.total_max_time}, and their score {self.result}") 
 
-        # Send reply, if requested
-        if send_reply:
-            await websocket.send(json.dumps(reply))
+async def handler(websocket):
+    print("starting handler")
+    subscriber = None # This client's subscription, if it has one
+    try:
+        async for packet in websocket:
+            print("received packet")
+            print(packet)
+            try:
+                message = json.loads(packet)
+                if not isinstance(message, dict):
+                    raise ValueError(f"expected a JSON object of requests, not {type(message).__name__}")
+            except ValueError as e: # Including malformed JSON
+                await websocket.send(json.dumps({"error": str(e)}))
+                continue
+
+            print(message)
+
+            snapshot = tracker.snapshot # Read once, so the whole reply comes from one frame
+
+            # Process any requests received
+            reply = {}
+            send_reply = False
+
+            if "check_awake" in message:
+                print("CHECK AWAKE")
+                reply["awake"] = True
+                send_reply = True
+
+            # Clock-offset handshake: echo the client's send time along with ours, so the client can work out the
+            # offset between the clocks from the round trip
+            if "clock" in message:
+                reply["clock"] = message["clock"]
+                reply["server_time"] = time.time()
+                send_reply = True
+
+            if "get_robots" in message:
+                if snapshot is not None:
+                    reply.update(snapshot.robots_reply)
+                send_reply = True
+
+            # Push every new frame's get_robots reply to the client, at most at the rate asked for
+            if "subscribe" in message:
+                try:
+                    rate = parse_rate(message["subscribe"])
+                    if subscriber is not None:
+                        tracker.subscriptions.unsubscribe(subscriber)
+                    subscriber = tracker.subscriptions.subscribe(websocket, reply_cache.get, rate)
+                    reply["subscribed"] = message["subscribe"]
+                except ValueError as e:
+                    reply["subscribed"] = False
+                    reply["error"] = str(e)
+                send_reply = True
+
+            if "unsubscribe" in message and subscriber is not None:
+                tracker.subscriptions.unsubscribe(subscriber)
+                subscriber = None
+                reply["subscribed"] = False
+                send_reply = True
+
+            # Send reply, if requested, saying which frame it was worked out from and when
+            if send_reply:
+                if snapshot is not None:
+                    reply.update(snapshot.header)
+                await websocket.send(json.dumps(reply))
+    finally:
+        if subscriber is not None:
+            tracker.subscriptions.unsubscribe(subscriber)
 
 
 # TODO: Handle Ctrl+C signals
 if __name__ == "__main__":
-    global tracker
-    tracker = Tracker()
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument("--source", type=str,
+        default=None,
+        help="video file or directory of images to track instead of the live camera")
+
+    ap.add_argument("--fast", action="store_true",
+        help="replay --source as fast as possible instead of at its recorded frame rate")
+
+    args = ap.parse_args()
+
+    global tracker, reply_cache
+    tracker = Tracker(source=args.source, realtime=not args.fast)
+    reply_cache = ReplyCache()
+    loop = asyncio.get_event_loop()
+    tracker.subscriptions = Subscriptions(loop)
     tracker.start()
 
     ##
@@ -514,9 +650,14 @@ if __name__ == "__main__":
     #   sudo iptables -t nat -A PREROUTING -p tcp --dport 80 -j REDIRECT --to-port 6000
     # Alternatively, change the port below to 80 and run this Python script as root.
     ##
-    #start_server = websockets.serve(ws_handler=handler, host=None, port=6000)
+    start_server = websockets.serve(ws_handler=handler, host=None, port=6000)
     # start_server = websockets.serve(ws_handler=handler, host="144.32.165.233", port=6000)
 
-    #loop = asyncio.get_event_loop()
-    #loop.run_until_complete(start_server)
-    #loop.run_forever()
+    loop.run_until_complete(start_server)
+    try:
+        # Serve until the tracker finishes, at the end of a recording, or until Ctrl+C
+        loop.run_until_complete(loop.run_in_executor(None, tracker.finished.wait))
+    finally:
+        # Stop the pipeline, which closes the detector and frees its worker processes and shared memory
+        tracker.finished.set()
+        tracker.join()
@@ -0,0 +1,45 @@
+import math
+
+class SpatialGrid:
+    """
+    Uniform grid of 2D positions, for finding everything within a short range of a point
+
+    The grid is rebuilt from scratch every frame, which costs one dictionary insert per position. A query only
+    looks at the cells that overlap its circle, so with a cell size close to the query radius each query checks
+    a 3x3 block of cells rather than every position.
+
+    cell_size -- width and height of a grid cell, in the units of the positions
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {} # (column, row) -> list of (key, x, y)
+
+    def cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    """
+    Replaces the contents of the grid
+
+    items -- iterable of (key, position), where position has x and y attributes
+    """
+    def build(self, items):
+        self.cells = {}
+        for key, position in items:
+            self.cells.setdefault(self.cell(position.x, position.y), []).append((key, position.x, position.y))
+
+    """
+    Returns a list of (key, distance) for everything strictly closer than radius to position
+    """
+    def query(self, position, radius):
+        (x, y) = (position.x, position.y)
+        (column, row) = self.cell(x, y)
+        span = math.ceil(radius / self.cell_size)
+
+        found = []
+        for i in range(column - span, column + span + 1):
+            for j in range(row - span, row + span + 1):
+                for (key, other_x, other_y) in self.cells.get((i, j), ()):
+                    distance = math.hypot(other_x - x, other_y - y)
+                    if distance < radius:
+                        found.append((key, distance))
+        return found
@@ -0,0 +1,67 @@
+import collections
+import time
+
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000] # Upper bounds of the histogram buckets, in milliseconds
+
+class LatencyHistogram:
+    """
+    Rolling record of the most recent latencies
+
+    Recording is a single deque append, so it is cheap enough to leave on during matches; the histogram and
+    percentiles are only worked out when get_stats() is called.
+
+    size -- number of recent samples kept
+    """
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+
+    """
+    duration -- latency in seconds
+    """
+    def record(self, duration):
+        self.samples.append(duration)
+        self.count += 1
+
+    def get_stats(self):
+        samples = sorted(self.samples)
+        stats = {"count": self.count, "recent": len(samples)}
+
+        if not samples:
+            return stats
+
+        samples_ms = [sample * 1000 for sample in samples]
+
+        buckets = {}
+        index = 0
+        for bound in BUCKETS_MS:
+            start = index
+            while index < len(samples_ms) and samples_ms[index] <= bound:
+                index += 1
+            buckets[f"<={bound}ms"] = index - start
+        buckets[f">{BUCKETS_MS[-1]}ms"] = len(samples_ms) - index
+
+        stats["histogram"] = buckets
+        stats["mean_ms"] = round(sum(samples_ms) / len(samples_ms), 3)
+        stats["p50_ms"] = round(samples_ms[int(len(samples_ms) * 0.5)], 3)
+        stats["p90_ms"] = round(samples_ms[int(len(samples_ms) * 0.9)], 3)
+        stats["p99_ms"] = round(samples_ms[int(len(samples_ms) * 0.99)], 3)
+        stats["max_ms"] = round(samples_ms[-1], 3)
+        return stats
+
+
+class ServerStats:
+    """
+    Counters for the websocket side of a tracking server
+    """
+    def __init__(self):
+        self.clients = 0 # Currently connected clients
+        self.requests = 0 # Requests served since the server started
+        self.handler = LatencyHistogram() # Time taken to answer each request
+        self.start_time = time.time()
+
+    def get_stats(self):
+        return {"clients": self.clients,
+                "requests": self.requests,
+                "uptime": round(time.time() - self.start_time, 1),
+                "handler": self.handler.get_stats()}
@@ -0,0 +1,122 @@
+import numpy as np
+from vector2d import Vector2D
+
+class TagBatch:
+    """
+    Every tag detected in one camera frame, held as arrays
+
+    Centres, fronts and headings of all tags are computed together with a few NumPy operations, rather than
+    tag by tag. Positions are truncated to whole pixels, as the tracker has always done.
+
+    tag_ids  -- tag IDs, as returned by cv2.aruco.detectMarkers or as a list
+    raw_tags -- tag corners, as returned by cv2.aruco.detectMarkers: a sequence of (1, 4, 2) arrays or an (N, 1, 4, 2) array
+    """
+    def __init__(self, tag_ids, raw_tags):
+        if tag_ids is None or len(tag_ids) == 0:
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.raw_corners = np.zeros((0, 4, 2), dtype=np.float32)
+        else:
+            self.ids = np.asarray(tag_ids, dtype=np.int64).ravel()
+            self.raw_corners = np.concatenate(raw_tags).reshape(-1, 4, 2)
+
+        self.ids_list = self.ids.tolist() # As Python ints
+
+        # Corners in order: top left, top right, bottom right, bottom left (in relation to the tag, not the camera)
+        self.corners = self.raw_corners.astype(np.int64)
+
+        # Centre of each tag, and centre of the top of each tag
+        self.centres = (self.corners.sum(axis=1) / 4).astype(np.int64)
+        self.fronts = ((self.corners[:, 0] + self.corners[:, 1]) / 2).astype(np.int64)
+
+        # Orientation of each tag: angle between the forward vector and the x-axis
+        forward = self.fronts - self.centres
+        self.forwards = np.arctan2(forward[:, 1], forward[:, 0]) # In radians
+        self.angles = np.degrees(self.forwards)
+
+    """
+    Positions and orientations of every tag, mapped through a perspective transform in one batch
+
+    Uses the unrounded corners, so positions are not limited to whole pixels.
+
+    homography -- 3x3 perspective transform from pixel coordinates (e.g. to arena coordinates in metres)
+
+    Returns (positions, angles): an (N, 2) array and an (N,) array of angles in degrees in the new coordinates
+    """
+    def transform(self, homography):
+        centres = self.raw_corners.mean(axis=1)
+        fronts = self.raw_corners[:, :2].mean(axis=1)
+        points = np.concatenate([centres, fronts]).astype(np.float64)
+
+        projected = points @ homography[:, :2].T + homography[:, 2]
+        projected = projected[:, :2] / projected[:, 2:]
+
+        (positions, fronts) = (projected[:len(centres)], projected[len(centres):])
+        forward = fronts - positions
+        return positions, np.degrees(np.arctan2(forward[:, 1], forward[:, 0]))
+
+    def __len__(self):
+        return len(self.ids_list)
+
+    def tag(self, index):
+        return Tag(self, index)
+
+
+class Tag:
+    """
+    View of one tag in a TagBatch
+
+    Has the same attributes as the tracker's old per-tag objects, but nothing is computed or allocated until
+    an attribute is used (e.g. when drawing).
+    """
+    __slots__ = ("tags", "index", "id")
+
+    def __init__(self, tags, index):
+        self.tags = tags
+        self.index = index
+        self.id = tags.ids_list[index]
+
+    def corner(self, corner):
+        (x, y) = self.tags.corners[self.index, corner]
+        return Vector2D(int(x), int(y))
+
+    @property
+    def tl(self):
+        return self.corner(0) # Top left
+
+    @property
+    def tr(self):
+        return self.corner(1) # Top right
+
+    @property
+    def br(self):
+        return self.corner(2) # Bottom right
+
+    @property
+    def bl(self):
+        return self.corner(3) # Bottom left
+
+    @property
+    def centre(self):
+        (x, y) = self.tags.centres[self.index]
+        return Vector2D(int(x), int(y))
+
+    @property
+    def front(self):
+        (x, y) = self.tags.fronts[self.index]
+        return Vector2D(int(x), int(y))
+
+    @property
+    def forward(self):
+        return float(self.tags.forwards[self.index])
+
+    @property
+    def angle(self):
+        return float(self.tags.angles[self.index])
+
+    @property
+    def corners(self):
+        return self.tags.raw_corners[self.index].tolist()
+
+    @property
+    def raw_tag(self):
+        return self.tags.raw_corners[self.index].reshape(1, 4, 2)
@@ -0,0 +1,34 @@
+import unittest
+from pose_filter import MAX_EXTRAPOLATION, PoseFilter
+
+class TestPredict(unittest.TestCase):
+    """
+    Extrapolation is limited to MAX_EXTRAPOLATION seconds after the last measurement, and never goes back before it
+    """
+    def setUp(self):
+        self.filter = PoseFilter(0.0, 0.0, 0.0, 100.0)
+        for step in range(1, 11): # Moving at 1 m/s along x and turning at 10 degrees/s
+            self.filter.update(step * 0.1, 0.0, step * 1.0, 100.0 + step * 0.1)
+        self.last_seen = self.filter.timestamp
+
+    def checkLimited(self, query_time, dt):
+        limit = (self.filter.x.extrapolate(dt), self.filter.y.extrapolate(dt), self.filter.orientation.extrapolate(dt))
+        for predictor in (self.filter, self.filter.estimate()):
+            for (value, expected) in zip(predictor.predict(query_time), limit):
+                self.assertAlmostEqual(value, expected)
+
+    def test_far_future(self):
+        self.checkLimited(1e12, MAX_EXTRAPOLATION)
+        (x, y, orientation) = self.filter.predict(1e12)
+        self.assertLess(abs(x - self.filter.x.value), 1.0) # Not kilometres away
+
+    def test_far_past(self):
+        self.checkLimited(0, 0.0)
+
+    def test_within_horizon(self):
+        dt = MAX_EXTRAPOLATION / 2
+        self.checkLimited(self.last_seen + dt, dt)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,9 @@ import math
 class Vector2D:
     """A two-dimensional vector with Cartesian coordinates."""
 
+    # No per-instance __dict__: the tracker creates thousands of these every second
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x, self.y = x, y
 
@@ -67,3 +70,4 @@ class Vector2D:
     def to_polar(self):
         """Return the vector's components in polar coordinates."""
         return self.__abs__(), math.atan2(self.y, self.x)
+
@@ -0,0 +1,160 @@
+import numpy as np
+from ballgame_roles import Role, Team
+
+# Compact binary encoding of get_robots replies, as an alternative to JSON
+#
+# A message is a header, then one fixed-size record per robot, then one fixed-size record per neighbour, with
+# each robot's neighbours in the same order as the robots. All values are little-endian. Roles and teams are
+# sent as their enum values rather than names. Groups of fields that were not asked for are flagged as absent in
+# the header, and their values in the records are NaN (or 255 for codes).
+
+MAGIC = b"SW"
+VERSION = 2
+GROUPS = ["pose", "neighbours", "ball", "goals", "zone"] # Bit i of the header's groups field is GROUPS[i]
+MISSING_CODE = 255
+
+HEADER = np.dtype([("magic", "S2"), ("version", "u1"), ("groups", "u1"), ("frame", "<u4"),
+                   ("captured", "<f8"), ("published", "<f8"), ("robots", "<u2"), ("neighbours", "<u4")])
+
+ROBOT = np.dtype([("id", "<u2"), ("role", "u1"), ("team", "u1"),
+                  ("orientation", "<f4"), ("velocity_x", "<f4"), ("velocity_y", "<f4"), ("angular_velocity", "<f4"),
+                  ("pose_age", "<f4"), ("remaining_time", "<i4"), ("progress_through_zone", "<f4"),
+                  ("ball_range", "<f4"), ("ball_bearing", "<f4"),
+                  ("their_goal_range", "<f4"), ("their_goal_bearing", "<f4"),
+                  ("our_goal_range", "<f4"), ("our_goal_bearing", "<f4"),
+                  ("neighbours", "<u2")])
+
+NEIGHBOUR = np.dtype([("id", "<u2"), ("role", "u1"), ("team", "u1"),
+                      ("range", "<f4"), ("bearing", "<f4"), ("orientation", "<f4")])
+
+ROLE_NAMES = {role.value: role.name for role in Role}
+TEAM_NAMES = {team.value: team.name for team in Team}
+
+"""
+Which groups of fields a get_robots reply contains, judged from its first robot
+"""
+def groups_in(reply):
+    robot = next(iter(reply.values()), None)
+    if robot is None:
+        return []
+    keys = {"pose": "orientation", "neighbours": "players", "ball": "ball", "goals": "their_goal", "zone": "team"}
+    return [group for group in GROUPS if keys[group] in robot]
+
+"""
+Encodes a get_robots reply (as built by the tracker, with integer robot IDs) as bytes
+
+reply  -- dictionary of robot ID to reply fields
+header -- header of the world the reply describes: frame ID, capture and publish times
+"""
+def encode(reply, header):
+    groups = groups_in(reply)
+    num_neighbours = sum(len(robot.get("players", ())) for robot in reply.values())
+
+    record = np.zeros(1, dtype=HEADER)
+    record["magic"] = MAGIC
+    record["version"] = VERSION
+    record["groups"] = sum(1 << GROUPS.index(group) for group in groups)
+    record["frame"] = header["frame"]
+    record["captured"] = header["captured"]
+    record["published"] = header["published"]
+    record["robots"] = len(reply)
+    record["neighbours"] = num_neighbours
+
+    robots = np.zeros(len(reply), dtype=ROBOT)
+    for name in ROBOT.names:
+        if ROBOT[name].kind == "f":
+            robots[name] = np.nan
+    robots["id"] = list(reply.keys())
+    robots["role"] = MISSING_CODE
+    robots["team"] = MISSING_CODE
+    robots["remaining_time"] = -1
+
+    neighbours = np.zeros(num_neighbours, dtype=NEIGHBOUR)
+
+    # Columns are gathered as lists and assigned in one go, which is much faster than filling records one by one
+    values = list(reply.values())
+    if "pose" in groups:
+        robots["orientation"] = [robot["orientation"] for robot in values]
+        robots["velocity_x"] = [robot["velocity"]["x"] for robot in values]
+        robots["velocity_y"] = [robot["velocity"]["y"] for robot in values]
+        robots["angular_velocity"] = [robot["velocity"]["angular"] for robot in values]
+        robots["pose_age"] = [robot["pose_age"] for robot in values]
+    if "zone" in groups:
+        robots["role"] = [Role[robot["role"]].value for robot in values]
+        robots["team"] = [Team[robot["team"]].value for robot in values]
+        robots["remaining_time"] = [robot["remaining_time"] for robot in values]
+        robots["progress_through_zone"] = [robot["progress_through_zone"] for robot in values]
+    if "ball" in groups:
+        robots["ball_range"] = [robot["ball"]["range"] for robot in values]
+        robots["ball_bearing"] = [robot["ball"]["bearing"] for robot in values]
+    if "goals" in groups:
+        robots["their_goal_range"] = [robot["their_goal"]["range"] for robot in values]
+        robots["their_goal_bearing"] = [robot["their_goal"]["bearing"] for robot in values]
+        robots["our_goal_range"] = [robot["our_goal"]["range"] for robot in values]
+        robots["our_goal_bearing"] = [robot["our_goal"]["bearing"] for robot in values]
+    if "neighbours" in groups:
+        robots["neighbours"] = [len(robot["players"]) for robot in values]
+        players = [(int(id), player) for robot in values for id, player in robot["players"].items()]
+        neighbours["id"] = [id for id, player in players]
+        neighbours["role"] = [Role[player["role"]].value for id, player in players]
+        neighbours["team"] = [Team[player["team"]].value for id, player in players]
+        neighbours["range"] = [player["range"] for id, player in players]
+        neighbours["bearing"] = [player["bearing"] for id, player in players]
+        neighbours["orientation"] = [player["orientation"] for id, player in players]
+
+    return record.tobytes() + robots.tobytes() + neighbours.tobytes()
+
+"""
+Decodes a binary get_robots reply straight into NumPy arrays, without building any per-robot objects
+
+Returns (header, robots, neighbours): a HEADER record and ROBOT and NEIGHBOUR record arrays. Robot i's
+neighbours are neighbours[offsets[i]:offsets[i + 1]], where offsets = np.concatenate([[0], np.cumsum(robots["neighbours"])]).
+"""
+def decode(data):
+    header = np.frombuffer(data, dtype=HEADER, count=1)[0]
+    if header["magic"] != MAGIC or header["version"] != VERSION:
+        raise ValueError("not a binary get_robots reply of a known version")
+
+    robots = np.frombuffer(data, dtype=ROBOT, count=int(header["robots"]), offset=HEADER.itemsize)
+    neighbours = np.frombuffer(data, dtype=NEIGHBOUR, count=int(header["neighbours"]),
+                               offset=HEADER.itemsize + robots.nbytes)
+    return header, robots, neighbours
+
+"""
+Decodes a binary get_robots reply into the same dictionary json.loads() gives for the JSON reply
+"""
+def decode_reply(data):
+    (header, robots, neighbours) = decode(data)
+    groups = [group for i, group in enumerate(GROUPS) if header["groups"] & (1 << i)]
+
+    reply = {}
+    start = 0
+    for robot in robots.tolist():
+        fields = dict(zip(ROBOT.names, robot))
+        entry = {}
+        if "pose" in groups:
+            entry["orientation"] = fields["orientation"]
+            entry["velocity"] = {"x": fields["velocity_x"], "y": fields["velocity_y"], "angular": fields["angular_velocity"]}
+            entry["pose_age"] = fields["pose_age"]
+        if "zone" in groups:
+            entry["role"] = ROLE_NAMES[fields["role"]]
+            entry["team"] = TEAM_NAMES[fields["team"]]
+            entry["remaining_time"] = fields["remaining_time"]
+            entry["progress_through_zone"] = fields["progress_through_zone"]
+        if "ball" in groups:
+            entry["ball"] = {"range": fields["ball_range"], "bearing": fields["ball_bearing"]}
+        if "goals" in groups:
+            entry["their_goal"] = {"range": fields["their_goal_range"], "bearing": fields["their_goal_bearing"]}
+            entry["our_goal"] = {"range": fields["our_goal_range"], "bearing": fields["our_goal_bearing"]}
+        if "neighbours" in groups:
+            entry["players"] = {}
+            for (id, role, team, range, bearing, orientation) in neighbours[start:start + fields["neighbours"]].tolist():
+                entry["players"][str(id)] = {"team": TEAM_NAMES[team], "role": ROLE_NAMES[role],
+                                             "range": range, "bearing": bearing, "orientation": orientation}
+            start += fields["neighbours"]
+        reply[str(fields["id"])] = entry
+
+    reply["frame"] = int(header["frame"])
+    reply["captured"] = float(header["captured"])
+    reply["published"] = float(header["published"])
+    return reply